@@ -1,17 +1,27 @@
 from fastapi import APIRouter, HTTPException, Depends
 from typing import Annotated
 
-from backend.core.state_manager import state_manager
-from backend.core.models import Peer, Subnet, Service, Topology
+from backend.core.models import Peer, Topology
 from backend.core.config import verify_token
 from backend.core.lock import lock
 from backend.core.database import db
+from backend.core.intents import intent_log
+from backend.core.journal import undo_journal
+from backend.core.scheduler import write_scheduler
 from backend.core.logger import logger as logging
-from backend.core.lifespan import apply_config_from_database
-from backend.core.wireguard import getPeerInfo
+from backend.core.lifespan import apply_config_from_database, reconcile_from_database, verify_topology_graph
+from backend.core.wireguard import getPeerInfo, key_pool, peer_history, wg_client, wg_telemetry
 
 from backend.core.nftables import (
     backup_dcv_table,
+    compile_stats,
+    conntrack_revoker,
+    ct_fastpath,
+    dcv_mirror,
+    nft_pool,
+    nft_stats,
+    reconcile_stats,
+    subnet_policy,
     connect_subnets_bidirectional_public,
     disconnect_subnets_bidirectional_public,
     grant_admin_subnet_to_subnet, revoke_admin_subnet_to_subnet
@@ -27,7 +37,7 @@ def get_subnets(_: Annotated[str, Depends(verify_token)]):
     """
     try:
         with lock.read_lock():
-            subnets = db.get_all_subnets()
+            subnets = db.graph.subnets()
         logging.info(f"Retrieved {len(subnets)} subnets from the database.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database operation failed: {e}")
@@ -35,92 +45,53 @@ def get_subnets(_: Annotated[str, Depends(verify_token)]):
     return {"subnets": subnets}
 
 
+@router.get("/address_usage", tags=["network"])
+def get_address_usage(_: Annotated[str, Depends(verify_token)]):
+    """
+    Per subnet: the number of host addresses, how many are assigned to peers, how many are free and the used fraction.
+    """
+    try:
+        with lock.read_lock():
+            usage = {subnet.subnet: db.get_subnet_utilization(subnet) for subnet in db.get_all_subnets()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database operation failed: {e}")
+    return {"subnets": usage}
+
+
 @router.get("/topology", tags=["network"])
 def get_topology(_: Annotated[str, Depends(verify_token)]) -> dict[str,Topology]:
-    """Fetch the full topology with granular error logging.
+    """Fetch the full topology.
 
-    Adds defensive try/except blocks around each DB aggregation to help locate
-    intermittent 'tuple index out of range' errors (likely from a malformed row).
+    Subnets, peers, services and links come from the in-memory graph (see db/graph.py), which is
+    only recomputed after a write; the live WireGuard counters are added to copies of the peers.
     """
     try:
         with lock.read_lock():
-            # Base entities
-            try:
-                subnets_fetched = db.get_all_subnets()
-                logging.debug(f"[topology] subnets fetched: {len(subnets_fetched)}")
-            except Exception as e:
-                logging.error("[topology] failed fetching subnets", exc_info=True)
-                raise
-
-            subnets: dict[str, Subnet] = {}
-            peers: dict[str, Peer] = {}
-            services: dict[str, Service] = {}
-            network: dict[str, list[Peer]] = {}
-
-            for subnet in subnets_fetched:
-                try:
-                    peers_in_subnet = db.get_peers_in_subnet(subnet)
-                except Exception as e:
-                    logging.error(f"[topology] failed peers_in_subnet for {subnet.subnet}: {e}", exc_info=True)
-                    raise
-                subnets[subnet.subnet] = subnet
-                network[subnet.subnet] = peers_in_subnet
-
-            try:
-                peers_fetched = db.get_all_peers()
-            except Exception:
-                logging.error("[topology] failed fetching peers", exc_info=True)
-                raise
-            for peer in peers_fetched:
-                try:
-                    getPeerInfo(peer)
-                except Exception as e:
-                    logging.warning(f"[topology] getPeerInfo failed for {peer.username}: {e}")
-                peers[peer.address] = peer
-
-            try:
-                services_fetched = db.get_all_services()
-            except Exception:
-                logging.error("[topology] failed fetching services", exc_info=True)
-                raise
-            for service in services_fetched:
-                services[service.name] = service
-
-            def safe(label, fn):
-                try:
-                    v = fn()
-                    logging.debug(f"[topology] {label} size={len(v)}")
-                    return v
-                except Exception as inner:
-                    logging.error(f"[topology] step {label} failed: {inner}", exc_info=True)
-                    raise
-
-            p2p_links = safe("p2p_links", db.get_links_from_peer_to_peer)
-            service_links = safe("service_links", db.get_links_from_peers_to_service)
-            subnet_links = safe("subnet_links", db.get_links_from_peer_to_subnet)
-            subnet_to_subnet_links = safe("subnet_to_subnet_links", db.get_links_from_subnet_to_subnet)
-            subnet_to_service_links = safe("subnet_to_service_links", db.get_links_from_subnet_to_service)
-            admin_peer_to_peer_links = safe("admin_peer_to_peer_links", db.get_admin_links_from_peer_to_peer)
-            admin_peer_to_subnet_links = safe("admin_peer_to_subnet_links", db.get_admin_links_from_peer_to_subnet)
-            admin_subnet_to_subnet_links = safe("admin_subnet_to_subnet_links", db.get_admin_links_from_subnet_to_subnet)
-
-            topology = Topology(
-                subnets=subnets,
-                peers=peers,
-                services=services,
-                network=network,
-                service_links=service_links,
-                p2p_links=p2p_links,
-                subnet_links=subnet_links,
-                subnet_to_subnet_links=subnet_to_subnet_links,
-                subnet_to_service_links=subnet_to_service_links,
-                admin_peer_to_peer_links=admin_peer_to_peer_links,
-                admin_peer_to_subnet_links=admin_peer_to_subnet_links,
-                admin_subnet_to_subnet_links=admin_subnet_to_subnet_links,
-            )
+            cached = db.graph.topology()
     except Exception as e:
+        logging.error("[topology] failed reading the topology graph", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Topology get failed: {e}")
-    return {"topology": topology}
+    peers: dict[str, Peer] = {}
+    for address, peer in cached.peers.items():
+        peer = peer.model_copy()
+        try:
+            getPeerInfo(peer)
+        except Exception as e:
+            logging.warning(f"[topology] getPeerInfo failed for {peer.username}: {e}")
+        peers[address] = peer
+    return {"topology": cached.model_copy(update={"peers": peers})}
+
+
+@router.get("/topology_check", tags=["debug"])
+def check_topology_graph(_: Annotated[str, Depends(verify_token)]):
+    """
+    Compare the in-memory topology graph with the database; a graph that differs is dropped and reloaded.
+    """
+    try:
+        mismatched = verify_topology_graph()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Topology check failed: {e}")
+    return {"consistent": not mismatched, "mismatched": mismatched}
 
 
 @router.get("/nft_rules", tags=["debug"])
@@ -136,13 +107,91 @@ def get_nft_rules(_: Annotated[str, Depends(verify_token)]):
     return {"nft_rules": rules}
 
 
+@router.get("/peer_report", tags=["network"])
+def get_peer_report(_: Annotated[str, Depends(verify_token)], top: int = 20, idle_days: float = 30, limit: int = 100):
+    """
+    Get the peers that moved the most bytes over the recent sample window (top talkers)
+    and the peers that have not completed a handshake for more than idle_days (at most limit of them).
+    """
+    try:
+        wg_telemetry.refresh()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to collect WireGuard telemetry: {e}")
+    talkers = peer_history.top_talkers(top)
+    idle = wg_telemetry.idle(idle_days * 86400)[:limit]
+    with lock.read_lock():
+        peers = db.get_peers_by_public_keys([key for key, _ in talkers] + [key for key, _ in idle])
+
+    window = peer_history.window_seconds
+    return {
+        "window_seconds": window,
+        "top": [
+            {"username": peers[key].username, "address": peers[key].address, "bytes": int(total),
+             "rate": total / window if window else 0.0}
+            for key, total in talkers if key in peers
+        ],
+        "idle": [
+            {"username": peers[key].username, "address": peers[key].address,
+             "last_handshake": handshake if handshake else -1}
+            for key, handshake in idle if key in peers
+        ],
+    }
+
+
+@router.get("/metrics", tags=["debug"])
+def get_metrics(_: Annotated[str, Depends(verify_token)]):
+    """
+    Get internal performance counters, e.g. nftables round-trips and libnftables context reuse.
+    """
+    return {
+        "nftables": dict(nft_stats),
+        "nft_clients": dict(nft_pool.stats),
+        "nft_mirror": dict(dcv_mirror.stats),
+        "nft_compiler": dict(compile_stats),
+        "nft_reconcile": dict(reconcile_stats),
+        "nft_policy": {
+            "mode": "compiled" if subnet_policy.compiled else "rules",
+            "links": len(subnet_policy.links),
+            "services": len(subnet_policy.services),
+            "elements": subnet_policy.element_count,
+            "ct_mark_fastpath": ct_fastpath.enabled,
+        },
+        "conntrack_revoker": dict(conntrack_revoker.stats),
+        "wg_client": {"backend": wg_client.backend, **wg_client.stats},
+        "wg_telemetry": {"interval": wg_telemetry.interval, "sample_age": wg_telemetry.age, **wg_telemetry.stats},
+        "wg_history": {"samples_per_peer": peer_history.samples, "peers": len(peer_history.rates), **peer_history.stats},
+        "wg_key_pool": {"size": key_pool.size, "available": key_pool.available, **key_pool.stats},
+        "undo_journal": dict(undo_journal.stats),
+        "intent_log": dict(intent_log.stats),
+        "write_scheduler": {"max_size": write_scheduler.max_size, "window": write_scheduler.window,
+                            **write_scheduler.stats, "group_sizes": dict(write_scheduler.group_sizes)},
+        "db_connections": {"read_connections": db.connections.readers, "open_readers": db.connections.open_readers,
+                           "cache_size_kib": db.connections.cache_size_kib, "mmap_size": db.connections.mmap_size,
+                           **db.connections.stats},
+        "topology_graph": {"loaded": db.graph.loaded, **db.graph.counts(), "memory_bytes": db.graph.memory(), **db.graph.stats},
+    }
+
+
+@router.post("/reconcile", tags=["debug"])
+def reconcile_nftables(_: Annotated[str, Depends(verify_token)]):
+    """
+    Repair drift between the nftables table and the database, applying only the difference.
+    """
+    try:
+        drift = reconcile_from_database()
+    except Exception as e:
+        logging.error(f"Failed to reconcile nftables: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to reconcile nftables: {e}")
+    return {"changes": drift, "stats": dict(reconcile_stats)}
+
+
 @router.post("/topology", tags=["network"])
 def upload_topology(topology: Topology, _: Annotated[str, Depends(verify_token)]):
     """
     Upload a new network topology and apply it (DB -> WG + nftables).
     """
     try:
-        with lock.write_lock(), state_manager.saved_state():
+        def write():
             # Clear existing topology
             db.clear_database()
 
@@ -310,6 +359,7 @@ def upload_topology(topology: Topology, _: Annotated[str, Depends(verify_token)]
             # Apply to WG + nftables from DB snapshot
             apply_config_from_database()
 
+        write_scheduler.run(write)
     except HTTPException as e:
         raise HTTPException(status_code=400, detail=f"Invalid topology data: {e}")
     except Exception as e:
@@ -334,7 +384,7 @@ def create_link_between_two_subnets(
     - Members of subnet B can initiate to PUBLIC peers of subnet A.
     """
     try:
-        with lock.write_lock(), state_manager.saved_state():
+        def write():
             subnet_a_obj = db.get_subnet_by_address(subnet_a)
             subnet_b_obj = db.get_subnet_by_address(subnet_b)
             if subnet_a_obj is None:
@@ -348,6 +398,7 @@ def create_link_between_two_subnets(
             # nftables: bidirectional members -> public
             connect_subnets_bidirectional_public(subnet_a_obj.subnet, subnet_b_obj.subnet)
 
+        write_scheduler.run(write)
     except HTTPException as e:
         raise HTTPException(status_code=400, detail=f"Invalid subnet data: {e}")
     except Exception as e:
@@ -363,7 +414,7 @@ def delete_link_between_two_subnets(
     Delete a link between two subnets (undo the members -> public allows both ways).
     """
     try:
-        with lock.write_lock(), state_manager.saved_state():
+        def write():
             subnet_a_obj = db.get_subnet_by_address(subnet_a)
             subnet_b_obj = db.get_subnet_by_address(subnet_b)
             if subnet_a_obj is None:
@@ -377,6 +428,7 @@ def delete_link_between_two_subnets(
             # nftables: remove both directions
             disconnect_subnets_bidirectional_public(subnet_a_obj.subnet, subnet_b_obj.subnet)
 
+        write_scheduler.run(write)
     except HTTPException as e:
         raise HTTPException(status_code=400, detail=f"Invalid subnet data: {e}")
     except Exception as e:
@@ -390,7 +442,7 @@ def update_coordinates(topology: Topology, _: Annotated[str, Depends(verify_toke
     Update coordinates/size/color for subnets and coordinates for peers.
     """
     try:
-        with lock.write_lock(), state_manager.saved_state():
+        def write():
             for subnet in topology.subnets.values():
                 subnet_in_db = db.get_subnet_by_address(subnet.subnet)
                 if subnet_in_db is None:
@@ -413,6 +465,7 @@ def update_coordinates(topology: Topology, _: Annotated[str, Depends(verify_toke
                 peer_in_db.x = peer.x
                 peer_in_db.y = peer.y
                 db.update_peer_coordinates(peer_in_db)
+        write_scheduler.run(write)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Cannot update coordinates: {e}")
 
@@ -422,7 +475,7 @@ def connect_admin_subnet_to_subnet(admin_subnet: str, subnet: str, _: Annotated[
     Connect a subnet to <admin_subnet> another subnet <subnet> with admin privileges, this means that every member of <admin_subnet> can initiate to every member of <subnet>, regardless of public flags.
     """
     try:
-        with lock.write_lock(), state_manager.saved_state():
+        def write():
             subnet_obj = db.get_subnet_by_address(subnet)
             admin_subnet_obj = db.get_subnet_by_address(admin_subnet)
             if subnet_obj is None:
@@ -434,6 +487,7 @@ def connect_admin_subnet_to_subnet(admin_subnet: str, subnet: str, _: Annotated[
             logging.info(f"Connecting admin subnet {admin_subnet_obj.subnet} to subnet {subnet_obj.subnet}")
             grant_admin_subnet_to_subnet(admin_subnet_obj.subnet, subnet_obj.subnet)
 
+        write_scheduler.run(write)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Connecting admin subnet {admin_subnet} to subnet {subnet} failed: {e}")
     return {"message": f"Admin Subnet {admin_subnet} connected to subnet {subnet}"}
@@ -444,7 +498,7 @@ def disconnect_admin_subnet_to_subnet(admin_subnet: str, subnet: str, _: Annotat
     Disconnect a subnet from <admin_subnet> another subnet <subnet> with admin privileges, this means that every member of <admin_subnet> will no longer be able to initiate to every member of <subnet>, unless public flags allow it.
     """
     try:
-        with lock.write_lock(), state_manager.saved_state():
+        def write():
             subnet_obj = db.get_subnet_by_address(subnet)
             admin_subnet_obj = db.get_subnet_by_address(admin_subnet)
             if subnet_obj is None:
@@ -456,6 +510,7 @@ def disconnect_admin_subnet_to_subnet(admin_subnet: str, subnet: str, _: Annotat
             logging.info(f"Disconnecting admin subnet {admin_subnet_obj.subnet} from subnet {subnet_obj.subnet}")
             revoke_admin_subnet_to_subnet(admin_subnet_obj.subnet, subnet_obj.subnet)
 
+        write_scheduler.run(write)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Disconnecting admin subnet {admin_subnet} from subnet {subnet} failed: {e}")
     return {"message": f"Admin Subnet {admin_subnet} disconnected from subnet {subnet}"}
@@ -1,15 +1,16 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
+import time
 from typing import Annotated
 
 from backend.core.config import verify_token, settings
 from backend.core.lock import lock
 from backend.core.database import db
-from backend.core.state_manager import state_manager
+from backend.core.scheduler import write_scheduler
 from backend.core.logger import logger as logging
 from backend.core.models import Peer, Subnet
 import ipaddress
 from backend.core.wireguard import (
-    apply_to_wg_config, generate_keys, generate_wg_config, remove_from_wg_config
+    apply_to_wg_config, generate_keys, generate_wg_config, getPeerInfo, peer_history, remove_from_wg_config
 )
 
 # --- nftables helpers (replace iptables usage) ---
@@ -38,7 +39,8 @@ def create_peer(username: str, subnet: str, _: Annotated[str, Depends(verify_tok
         raise HTTPException(status_code=500, detail="Key generation failed")
     if len(username) <= 0 or len(username) > 15:
         raise HTTPException(status_code=400, detail="Username must be between 1 and 15 characters long")
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
+        nonlocal address
         try:
             # If peer exists, remove it first (DB + WG entry will be replaced)
             old_peer = db.get_peer_by_username(username)
@@ -83,8 +85,9 @@ def create_peer(username: str, subnet: str, _: Annotated[str, Depends(verify_tok
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Database/WG update failed: {e}")
 
-    configuration = generate_wg_config(peer, keys["private_key"])
-    return {"configuration": configuration}
+        configuration = generate_wg_config(peer, keys["private_key"])
+        return {"configuration": configuration}
+    return write_scheduler.run(write)
 
 
 @router.get("/config", tags=["peer"])
@@ -92,7 +95,7 @@ def regenerate_config(username: str, _: Annotated[str, Depends(verify_token)]):
     """
     Rotate keys and regenerate a WireGuard config for the peer.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer = db.get_peer_by_username(username)
             if peer is None:
@@ -113,6 +116,7 @@ def regenerate_config(username: str, _: Annotated[str, Depends(verify_token)]):
             return {"configuration": configuration}
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Config generation failed: {e}")
+    return write_scheduler.run(write)
 
 
 @router.get("/info", tags=["peer"])
@@ -125,6 +129,7 @@ def get_peer_info(username: str, _: Annotated[str, Depends(verify_token)]):
             peer = db.get_peer_by_username(username)
             if peer is None:
                 raise HTTPException(status_code=404, detail="Peer not found")
+        getPeerInfo(peer)
 
         return {
             "username": peer.username,
@@ -134,11 +139,52 @@ def get_peer_info(username: str, _: Annotated[str, Depends(verify_token)]):
             "x": peer.x,
             "y": peer.y,
             "services": peer.services,
+            "tx": peer.tx,
+            "rx": peer.rx,
+            "last_handshake": peer.last_handshake,
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database operation failed: {e}")
 
 
+@router.get("/traffic", tags=["peer"])
+def get_peer_traffic(
+    _: Annotated[str, Depends(verify_token)],
+    username: Annotated[list[str], Query()],
+    resolution: str = "raw",
+    window: int = 3600,
+):
+    """
+    Return the current rx/tx rates (bytes/s) and the traffic history of one or more peers.
+    resolution "raw" returns the in-memory samples as [time, rx rate, tx rate];
+    "1m" and "1h" return the rollups of the last window seconds as [slot start, rx bytes, tx bytes].
+    """
+    resolutions = {"1m": 60, "1h": 3600}
+    if resolution != "raw" and resolution not in resolutions:
+        raise HTTPException(status_code=400, detail="resolution must be one of raw, 1m, 1h")
+    with lock.read_lock():
+        peers = {name: peer for name in dict.fromkeys(username) if (peer := db.get_peer_by_username(name)) is not None}
+    missing = [name for name in username if name not in peers]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Peers not found: {', '.join(missing)}")
+
+    since = time.time() - window
+    keys = [peers[name].public_key for name in username]
+    try:
+        if resolution == "raw":
+            history = {key: peer_history.recent(key, since) for key in keys}
+        else:
+            history = peer_history.rollups(keys, resolutions[resolution], int(since))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read traffic history: {e}")
+
+    result = {}
+    for name, key in zip(username, keys):
+        rx_rate, tx_rate = peer_history.rate(key)
+        result[name] = {"rx_rate": rx_rate, "tx_rate": tx_rate, "history": history.get(key, [])}
+    return {"resolution": resolution, "peers": result}
+
+
 @router.get("/all", tags=["peer"])
 def get_all_peers():
     """
@@ -146,7 +192,7 @@ def get_all_peers():
     """
     with lock.read_lock():
         try:
-            peer_list: list[Peer] = db.get_all_peers()
+            peer_list: list[Peer] = db.graph.peers()
         except Exception as e:
             logging.error(f"Error retrieving peers: {e}")
             raise HTTPException(status_code=500, detail=f"Failed to get peer list: {e}")
@@ -158,7 +204,7 @@ def delete_peer(username: str, _: Annotated[str, Depends(verify_token)]):
     """
     Delete a peer: revoke nftables grants, remove WG entry, and delete from DB.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer = db.get_peer_by_username(username)
             if peer is None:
@@ -169,7 +215,8 @@ def delete_peer(username: str, _: Annotated[str, Depends(verify_token)]):
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to delete peer {username}: {e}")
 
-    return {"message": "Peer removed"}
+        return {"message": "Peer removed"}
+    return write_scheduler.run(write)
 
 
 @router.get("/subnets", tags=["peer"])
@@ -179,10 +226,10 @@ def get_user_subnets(username: str, _: Annotated[str, Depends(verify_token)]):
     """
     with lock.read_lock():
         try:
-            peer = db.get_peer_by_username(username)
+            peer = db.graph.peer_by_username(username)
             if peer is None:
                 raise HTTPException(status_code=404, detail="Peer not found")
-            subnets = db.get_peers_subnets(peer)
+            subnets = db.graph.subnets_containing(peer)
             if subnets is None or len(subnets) == 0:
                 raise HTTPException(status_code=404, detail="Peer is not in any subnet")
             #take the tightest matching subnet as primary
@@ -200,7 +247,7 @@ def get_user_subnets(username: str, _: Annotated[str, Depends(verify_token)]):
                     best_pl = pl
                     best = s
             subnet = best or subnets[0]
-            subnet_links = db.get_links_from_peer_to_subnets(peer)
+            subnet_links = db.graph.linked_subnets(peer)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Database operation failed: {e}")
     return {"subnet": subnet, "links": subnet_links}
@@ -212,7 +259,7 @@ def connect_two_peers(peer1_username: str, peer2_username: str,
     """
     Connect two peers (bidirectional) via nftables p2p links.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer1 = db.get_peer_by_username(peer1_username)
             peer2 = db.get_peer_by_username(peer2_username)
@@ -224,7 +271,8 @@ def connect_two_peers(peer1_username: str, peer2_username: str,
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Connecting the two peers failed: {e}")
-    return {"message": f"Peers {peer1_username} and {peer2_username} connected"}
+        return {"message": f"Peers {peer1_username} and {peer2_username} connected"}
+    return write_scheduler.run(write)
 
 
 @router.delete("/disconnect", tags=["peer"])
@@ -233,7 +281,7 @@ def disconnect_two_peers(peer1_username: str, peer2_username: str,
     """
     Disconnect two peers (remove nftables p2p links and DB edge).
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer1 = db.get_peer_by_username(peer1_username)
             peer2 = db.get_peer_by_username(peer2_username)
@@ -245,7 +293,8 @@ def disconnect_two_peers(peer1_username: str, peer2_username: str,
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Disconnecting the two peers failed: {e}")
-    return {"message": f"Peers {peer1_username} and {peer2_username} disconnected"}
+        return {"message": f"Peers {peer1_username} and {peer2_username} disconnected"}
+    return write_scheduler.run(write)
 
 @router.post("/admin/peer/connect", tags=["peer","admin"])
 def connect_admin_peer_to_peer(admin_username: str, peer_username: str,
@@ -253,7 +302,7 @@ def connect_admin_peer_to_peer(admin_username: str, peer_username: str,
     """
     Connect an admin peer to a regular peer via nftables p2p links.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             admin_peer = db.get_peer_by_username(admin_username)
             peer = db.get_peer_by_username(peer_username)
@@ -265,7 +314,8 @@ def connect_admin_peer_to_peer(admin_username: str, peer_username: str,
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Connecting the two peers failed: {e}")
-    return {"message": f"Admin peer {admin_username} and peer {peer_username} connected"}
+        return {"message": f"Admin peer {admin_username} and peer {peer_username} connected"}
+    return write_scheduler.run(write)
 
 @router.delete("/admin/peer/disconnect", tags=["peer","admin"])
 def disconnect_admin_peer_from_peer(admin_username: str, peer_username: str,
@@ -273,7 +323,7 @@ def disconnect_admin_peer_from_peer(admin_username: str, peer_username: str,
     """
     Disconnect an admin peer from a regular peer (remove nftables p2p links and DB edge).
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             admin_peer = db.get_peer_by_username(admin_username)
             peer = db.get_peer_by_username(peer_username)
@@ -285,7 +335,8 @@ def disconnect_admin_peer_from_peer(admin_username: str, peer_username: str,
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Disconnecting the two peers failed: {e}")
-    return {"message": f"Admin peer {admin_username} and peer {peer_username} disconnected"}
+        return {"message": f"Admin peer {admin_username} and peer {peer_username} disconnected"}
+    return write_scheduler.run(write)
 
 def helper_remove_peer(peer: Peer):
     try:
@@ -1,7 +1,6 @@
 from fastapi import APIRouter, HTTPException, Depends
 from backend.core.config import verify_token
-from backend.core.lock import lock
-from backend.core.state_manager import state_manager
+from backend.core.scheduler import write_scheduler
 from backend.core.database import db
 from backend.core.nftables import grant_service, revoke_service, grant_subnet_service, revoke_subnet_service
 from backend.core.models import Service
@@ -18,7 +17,7 @@ def create_service(service_name:str, department:str, username:str, port:int, pro
     If you wish for selected peers to be able to connect to the service, you need to use the connect endpoint.
     If a peer is connected to a peer with the same address, it will automatically be able to connect to the service.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         old_service = db.get_service_by_name(service_name)
         # database consistency
         try:
@@ -42,14 +41,15 @@ def create_service(service_name:str, department:str, username:str, port:int, pro
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to create service: {e}")
             
-    return {"message": "Service created successfully"}
+        return {"message": "Service created successfully"}
+    return write_scheduler.run(write)
 
 @router.delete("/delete",tags=["service"])
 def delete_service(service_name: str, _: Annotated[str, Depends(verify_token)]):
     """
     Delete a service, all the connections to the service will be removed, and the service will be removed from the database.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             service= db.get_service_by_name(service_name)
             if service is None:
@@ -67,7 +67,8 @@ def delete_service(service_name: str, _: Annotated[str, Depends(verify_token)]):
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Database operation failed: {e}")
-    return {"message": "Service deleted"}
+        return {"message": "Service deleted"}
+    return write_scheduler.run(write)
 
 @router.post("/connect",tags=["service"])
 def service_connect(username: str, service_name: str, _: Annotated[str, Depends(verify_token)]):
@@ -75,7 +76,7 @@ def service_connect(username: str, service_name: str, _: Annotated[str, Depends(
     Connect a peer to a service, provide the username of the peer and the name of the service, if both exists,
     the peer will be added to the users of the service and the link will be allowed in iptables.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer = db.get_peer_by_username(username)
             if peer is None:
@@ -96,7 +97,8 @@ def service_connect(username: str, service_name: str, _: Annotated[str, Depends(
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Connecting peer {username} to {service_name} failed: {e}")
-    return {"message": f"Peer {username} connected to service {service.name}"}
+        return {"message": f"Peer {username} connected to service {service.name}"}
+    return write_scheduler.run(write)
 
 @router.delete("/disconnect",tags=["service"])
 def service_disconnect(username: str, service_name: str, _: Annotated[str, Depends(verify_token)]):
@@ -104,7 +106,7 @@ def service_disconnect(username: str, service_name: str, _: Annotated[str, Depen
     Provide the username of the peer and the name of the service, if both exist, and are linked,
     the peer will be removed from the users of the service and the link will be removed in iptables.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer = db.get_peer_by_username(username)
             if peer is None:
@@ -129,14 +131,15 @@ def service_disconnect(username: str, service_name: str, _: Annotated[str, Depen
     
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to disconnect {username} from {service_name}: {e}")
-    return {"message": f"Peer {username} disconnected from service {service.name}"}
+        return {"message": f"Peer {username} disconnected from service {service.name}"}
+    return write_scheduler.run(write)
         
 @router.post("/subnet/connect",tags=["service","subnets"])
 def connect_subnet_to_service(subnet_address:str, service_name: str, _: Annotated[str, Depends(verify_token)]):
     """
     Connect all peers in a subnet to a service. This will allow all peers in the subnet to connect to the service.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             subnet = db.get_subnet_by_address(subnet_address)
             if subnet is None:
@@ -155,14 +158,15 @@ def connect_subnet_to_service(subnet_address:str, service_name: str, _: Annotate
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to connect subnet {subnet_address} to service {service_name}: {e}")
-    return {"message": f"Subnet {subnet_address} connected to service {service.name}"}
+        return {"message": f"Subnet {subnet_address} connected to service {service.name}"}
+    return write_scheduler.run(write)
 
 @router.delete("/subnet/disconnect",tags=["service","subnets"])
 def disconnect_subnet_from_service(subnet_address:str, service_name: str, _: Annotated[str, Depends(verify_token)]):
     """
     Disconnect all peers in a subnet from a service. This will remove the ability for all peers in the subnet to connect to the service.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             subnet = db.get_subnet_by_address(subnet_address)
             if subnet is None:
@@ -181,4 +185,5 @@ def disconnect_subnet_from_service(subnet_address:str, service_name: str, _: Ann
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to disconnect subnet {subnet_address} from service {service_name}: {e}")
-    return {"message": f"Subnet {subnet_address} disconnected from service {service.name}"}
\ No newline at end of file
+        return {"message": f"Subnet {subnet_address} disconnected from service {service.name}"}
+    return write_scheduler.run(write)
\ No newline at end of file
@@ -1,8 +1,7 @@
 from fastapi import APIRouter, HTTPException, Depends
 from backend.core.config import verify_token
 from backend.core.database import db
-from backend.core.state_manager import state_manager
-from backend.core.lock import lock
+from backend.core.scheduler import write_scheduler
 from backend.core.models import Subnet, Peer
 from backend.core.logger import logger as logging
 from typing import Annotated
@@ -24,7 +23,6 @@ from backend.core.nftables import (
     remove_p2p_link
 )
 from backend.api.peer import helper_remove_peer
-import ipaddress
 
 
 
@@ -36,7 +34,7 @@ def create_subnet(subnet: Subnet, _: Annotated[str, Depends(verify_token)]):
     Create a new subnet.
     This endpoint will add a new subnet to the database, to add peers into this subnet please see the other endpoint.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             db.create_subnet(subnet)
             ensure_subnet(subnet.subnet)
@@ -53,14 +51,15 @@ def create_subnet(subnet: Subnet, _: Annotated[str, Depends(verify_token)]):
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Subnet creation failed: {e}")
     
-    return {"message": "Subnet created"}
+        return {"message": "Subnet created"}
+    return write_scheduler.run(write)
 
 @router.post("/connect",tags=["subnet"])
 def connect_peer_to_subnet(username: str, subnet: str, _: Annotated[str, Depends(verify_token)]):
     """ 
     Makes a peer public inside a specific subnet. A peer being public means that other peers inside the subnet can connect to it and he can connect to other public peers inside that subnet.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer_obj = db.get_peer_by_username(username)
             if peer_obj is None:
@@ -78,14 +77,15 @@ def connect_peer_to_subnet(username: str, subnet: str, _: Annotated[str, Depends
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Connecting peer {username} to subnet {subnet} failed: {e}")
     
-    return {"message": "Peer connected to subnet"}
+        return {"message": "Peer connected to subnet"}
+    return write_scheduler.run(write)
 
 @router.delete("/", tags=["subnet"])
 def delete_subnet(subnet: str, _: Annotated[str, Depends(verify_token)]):
     """
     Deletes a subnet. Also cleans up nftables state for that subnet.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             subnet_obj: Subnet|None = db.get_subnet_by_address(subnet)
             if subnet_obj is None:
@@ -94,7 +94,8 @@ def delete_subnet(subnet: str, _: Annotated[str, Depends(verify_token)]):
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Subnet deletion failed: {e}")
 
-    return {"message": "Subnet deleted"}
+        return {"message": "Subnet deleted"}
+    return write_scheduler.run(write)
 
 @router.delete("/with_peers", tags=["subnet"])
 def delete_subnet_with_peers(subnet: str, token: Annotated[str, Depends(verify_token)]):
@@ -102,7 +103,7 @@ def delete_subnet_with_peers(subnet: str, token: Annotated[str, Depends(verify_t
     Deletes a subnet and all the peers inside it.
     Cleans up nftables grants/links, WireGuard peers, and DB entries.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             subnet_obj: Subnet|None = db.get_subnet_by_address(subnet)
             if subnet_obj is None:
@@ -115,19 +116,12 @@ def delete_subnet_with_peers(subnet: str, token: Annotated[str, Depends(verify_t
                 revoke_public(subnet_obj.subnet, peer.address)
                 del_member(subnet_obj.subnet, peer.address)
             # 1 b) Remove leftover peer in the subnet that didn't have a link to it ( is inside the address range but no link)
-            all_peers = db.get_all_peers()
-            for peer in all_peers:
-                if db.get_links_from_peer_to_subnets(peer).count(subnet_obj) == 0:
-                    # Check if the peer's address is in the subnet range
-                    try:
-                        subnet_network = ipaddress.ip_network(subnet_obj.subnet, strict=False)
-                        peer_ip = ipaddress.ip_address(peer.address)
-                        if peer_ip in subnet_network:
-                            logging.info(f"Removing peer {peer.username} from subnet {subnet_obj.subnet} due to address containment")
-                            revoke_public(subnet_obj.subnet, peer.address)
-                            del_member(subnet_obj.subnet, peer.address)
-                    except ValueError as ve:
-                        logging.warning(f"Invalid IP address or subnet format: {ve}")
+            linked_addresses = {peer.address for peer in peers_in_subnet.get(subnet_obj.subnet, [])}
+            for peer in db.get_peers_in_subnet(subnet_obj):
+                if peer.address not in linked_addresses:
+                    logging.info(f"Removing peer {peer.username} from subnet {subnet_obj.subnet} due to address containment")
+                    revoke_public(subnet_obj.subnet, peer.address)
+                    del_member(subnet_obj.subnet, peer.address)
 
             # 2) Revoke subnet -> service grants for this subnet
             service_links = db.get_links_from_subnet_to_service()
@@ -168,17 +162,9 @@ def delete_subnet_with_peers(subnet: str, token: Annotated[str, Depends(verify_t
                         revoke_admin_peer_to_subnet(peer.address, target_subnet.subnet)
 
             #5 a) Destroy any subnet inside this subnet
-            nested_subnets = db.get_all_subnets()
-            for target_subnet in nested_subnets:
-                try:
-                    # Check if the target_subnet is fully contained within the subnet to be deleted
-                    parent_network = ipaddress.ip_network(subnet_obj.subnet, strict=False)
-                    target_network = ipaddress.ip_network(target_subnet.subnet, strict=False)
-                    if target_network.subnet_of(parent_network) and target_subnet.subnet != subnet_obj.subnet:
-                        logging.info(f"Also deleting nested subnet {target_subnet.subnet} inside {subnet_obj.subnet}")
-                        helper_remove_subnet(target_subnet)
-                except ValueError as ve:
-                    logging.warning(f"Invalid IP address or subnet format when checking nested subnets: {ve}")
+            for target_subnet in db.get_subnets_nested_in(subnet_obj):
+                logging.info(f"Also deleting nested subnet {target_subnet.subnet} inside {subnet_obj.subnet}")
+                helper_remove_subnet(target_subnet)
 
             #5 b) Destroy all peers inside this subnet
             peers_in_subnet = db.get_peers_in_subnet(subnet_obj)
@@ -192,14 +178,15 @@ def delete_subnet_with_peers(subnet: str, token: Annotated[str, Depends(verify_t
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Subnet deletion failed: {e}")
 
-    return {"message": "Subnet and linked peers deleted"}
+        return {"message": "Subnet and linked peers deleted"}
+    return write_scheduler.run(write)
 
 @router.delete("/disconnect", tags=["subnet"])
 def disconnect_peer_from_subnet(username: str, subnet: str, _: Annotated[str, Depends(verify_token)]):
     """
     Removes a peer from a specific subnet.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer: Peer|None = db.get_peer_by_username(username)
             if peer is None:
@@ -218,14 +205,15 @@ def disconnect_peer_from_subnet(username: str, subnet: str, _: Annotated[str, De
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Disconnection of peer {username} from subnet {subnet} failed: {e}")
 
-    return {"message": "Peer disconnected from subnet"}
+        return {"message": "Peer disconnected from subnet"}
+    return write_scheduler.run(write)
 
 @router.post("/admin/connect",tags=["subnet","admin"])
 def admin_connect_peer_to_subnet(admin_username: str, subnet: str, _: Annotated[str, Depends(verify_token)]):
     """ 
     Makes a peer an admin of a specific subnet. An admin peer can connect to any other peer inside the subnet, even if they are not public.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer_obj = db.get_peer_by_username(admin_username)
             if peer_obj is None:
@@ -242,14 +230,15 @@ def admin_connect_peer_to_subnet(admin_username: str, subnet: str, _: Annotated[
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Connecting admin peer {admin_username} to subnet {subnet} failed: {e}")
     
-    return {"message": "Admin peer connected to subnet"}
+        return {"message": "Admin peer connected to subnet"}
+    return write_scheduler.run(write)
 
 @router.delete("/admin/disconnect", tags=["subnet","admin"])
 def admin_disconnect_peer_from_subnet(admin_username: str, subnet: str, _: Annotated[str, Depends(verify_token)]):
     """
     Removes a peer's admin status from a specific subnet.
     """
-    with lock.write_lock(), state_manager.saved_state():
+    def write():
         try:
             peer: Peer|None = db.get_peer_by_username(admin_username)
             if peer is None:
@@ -267,7 +256,8 @@ def admin_disconnect_peer_from_subnet(admin_username: str, subnet: str, _: Annot
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Disconnection of admin peer {admin_username} from subnet {subnet} failed: {e}")
 
-    return {"message": "Admin peer disconnected from subnet"}
+        return {"message": "Admin peer disconnected from subnet"}
+    return write_scheduler.run(write)
 
 def helper_remove_subnet(subnet: Subnet):
     """
@@ -282,19 +272,12 @@ def helper_remove_subnet(subnet: Subnet):
             revoke_public(subnet.subnet, peer.address)
             del_member(subnet.subnet, peer.address)
         # 1 b) Remove leftover peer in the subnet that didn't have a link to it ( is inside the address range but no link)
-        all_peers = db.get_all_peers()
-        for peer in all_peers:
-            if db.get_links_from_peer_to_subnets(peer).count(subnet) == 0:
-                # Check if the peer's address is in the subnet range
-                try:
-                    subnet_network = ipaddress.ip_network(subnet.subnet, strict=False)
-                    peer_ip = ipaddress.ip_address(peer.address)
-                    if peer_ip in subnet_network:
-                        logging.info(f"Removing peer {peer.username} from subnet {subnet.subnet} due to address containment")
-                        revoke_public(subnet.subnet, peer.address)
-                        del_member(subnet.subnet, peer.address)
-                except ValueError as ve:
-                    logging.warning(f"Invalid IP address or subnet format: {ve}")
+        linked_addresses = {peer.address for peer in peers_in_subnet.get(subnet.subnet, [])}
+        for peer in db.get_peers_in_subnet(subnet):
+            if peer.address not in linked_addresses:
+                logging.info(f"Removing peer {peer.username} from subnet {subnet.subnet} due to address containment")
+                revoke_public(subnet.subnet, peer.address)
+                del_member(subnet.subnet, peer.address)
 
         # 2) Revoke subnet -> service grants for this subnet
         service_links = db.get_links_from_subnet_to_service()
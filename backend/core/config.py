@@ -12,6 +12,24 @@ class Settings(BaseSettings):
     public_key: str = ""
     wg_default_subnet: str = "10.128.0.0/9"
     mtu: str = "1420"
+    nft_mirror_check_interval: float = 0.0
+    nft_reconcile_interval: float = 0.0
+    nft_policy_mode: str = "rules"
+    nft_ct_mark_fastpath: bool = False
+    wg_client: str = "auto"
+    wg_key_pool_size: int = 0
+    wg_telemetry_interval: float = 2.0
+    wg_history_samples: int = 150
+    wg_shards: int = 1
+    wg_shard_by: str = "subnet"
+    wg_shard_prefix: int = 24
+    wg_shard_reassign: bool = False
+    write_group_size: int = 1
+    write_group_window: float = 0.0
+    topology_check_interval: float = 0.0
+    db_read_connections: bool = True
+    db_cache_size_kib: int = 16384
+    db_mmap_size: int = 268435456
 
 try:
     with open("/etc/wireguard/publickey", "r") as f:
@@ -26,6 +44,24 @@ endpoint = os.getenv("ENDPOINT", f"127.0.0.0")
 endpoint = f"{endpoint}:{wg_udp_port}"
 wg_default_subnet = os.getenv("WG_DEFAULT_SUBNET", "10.128.0.0/9")
 mtu = os.getenv("MTU", "1420")
+nft_mirror_check_interval = float(os.getenv("NFT_MIRROR_CHECK_INTERVAL", 0))
+nft_reconcile_interval = float(os.getenv("NFT_RECONCILE_INTERVAL", 0))
+nft_policy_mode = os.getenv("NFT_POLICY_MODE", "rules")
+wg_client = os.getenv("WG_CLIENT", "auto")
+wg_key_pool_size = int(os.getenv("WG_KEY_POOL_SIZE", 0))
+wg_telemetry_interval = float(os.getenv("WG_TELEMETRY_INTERVAL", 2))
+wg_history_samples = int(os.getenv("WG_HISTORY_SAMPLES", 150))
+wg_shards = int(os.getenv("WG_SHARDS", 1))
+wg_shard_by = os.getenv("WG_SHARD_BY", "subnet")
+wg_shard_prefix = int(os.getenv("WG_SHARD_PREFIX", 24))
+wg_shard_reassign = os.getenv("WG_SHARD_REASSIGN", "false").lower() in ("1", "true", "yes")
+write_group_size = int(os.getenv("WRITE_GROUP_SIZE", 1))
+write_group_window = float(os.getenv("WRITE_GROUP_WINDOW", 0))
+topology_check_interval = float(os.getenv("TOPOLOGY_CHECK_INTERVAL", 0))
+db_read_connections = os.getenv("DB_READ_CONNECTIONS", "true").lower() in ("1", "true", "yes")
+db_cache_size_kib = int(os.getenv("DB_CACHE_SIZE_KIB", 16384))
+db_mmap_size = int(os.getenv("DB_MMAP_SIZE", 268435456))
+nft_ct_mark_fastpath = os.getenv("NFT_CT_MARK_FASTPATH", "false").lower() in ("1", "true", "yes")
 
 settings = Settings(public_key=public_key_value,
                     wg_udp_port=wg_udp_port,
@@ -33,7 +69,25 @@ settings = Settings(public_key=public_key_value,
                     api_token=api_token,
                     endpoint=endpoint,
                     wg_default_subnet=wg_default_subnet,
-                    mtu=mtu)
+                    mtu=mtu,
+                    nft_mirror_check_interval=nft_mirror_check_interval,
+                    nft_reconcile_interval=nft_reconcile_interval,
+                    nft_policy_mode=nft_policy_mode,
+                    nft_ct_mark_fastpath=nft_ct_mark_fastpath,
+                    wg_client=wg_client,
+                    wg_key_pool_size=wg_key_pool_size,
+                    wg_telemetry_interval=wg_telemetry_interval,
+                    wg_history_samples=wg_history_samples,
+                    wg_shards=wg_shards,
+                    wg_shard_by=wg_shard_by,
+                    wg_shard_prefix=wg_shard_prefix,
+                    wg_shard_reassign=wg_shard_reassign,
+                    write_group_size=write_group_size,
+                    write_group_window=write_group_window,
+                    topology_check_interval=topology_check_interval,
+                    db_read_connections=db_read_connections,
+                    db_cache_size_kib=db_cache_size_kib,
+                    db_mmap_size=db_mmap_size)
 
 tags_metadata = [
     {
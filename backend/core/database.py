@@ -1,4 +1,4 @@
 from backend.db import Database
 from backend.core.config import settings
 
-db = Database(settings.db_path)
\ No newline at end of file
+db = Database(settings.db_path, settings.db_cache_size_kib, settings.db_mmap_size, settings.db_read_connections)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+
+from backend.core.logger import logger as logging
+
+# What an intent names: nft sets whose elements change, peer keys and addresses, and the two
+# bulk subjects (the whole dcv table, every WireGuard peer) for operations that replace them.
+INTENT_SUBJECTS = ("set", "table", "peer", "address", "wireguard")
+
+
+class IntentLog:
+    """Write-ahead record, in SQLite, of the kernel objects a write is about to change.
+
+    Before an nft batch or a wg call of a write reaches the kernel, the names of what the write
+    touches are committed to an intent row; the row is deleted once the write has committed or
+    been rolled back. A row still there at startup belongs to a write the process did not finish
+    (it died between the kernel and the database commit, or while undoing), and recovery compares
+    only the sets and peers it names with the database instead of every one of them.
+
+    Only subjects not yet on disk cause a write, so a request costs one small commit, plus one
+    per WireGuard call that names a new peer. Without a store (tests, tools) nothing is logged.
+    """
+
+    def __init__(self):
+        self.store = None
+        self._local = threading.local()
+        self.stats: dict[str, int] = {"intents": 0, "persists": 0, "recovered": 0}
+
+    def configure(self, store) -> None:
+        self.store = store
+
+    @property
+    def active(self) -> bool:
+        return self.store is not None and getattr(self._local, "subjects", None) is not None
+
+    def begin(self) -> None:
+        self._local.subjects = {kind: set() for kind in INTENT_SUBJECTS}
+        self._local.intent_id = None
+        self._local.dirty = False
+
+    def touch(self, kind: str, name: str = "") -> None:
+        """Name something the current write is going to change (persisted by ``persist``)."""
+        if not self.active:
+            return
+        names = self._local.subjects[kind]
+        if name not in names:
+            names.add(name)
+            self._local.dirty = True
+
+    def persist(self) -> None:
+        """Commit the subjects named so far; call right before the kernel is touched."""
+        if not self.active or not self._local.dirty:
+            return
+        subjects = {kind: sorted(names) for kind, names in self._local.subjects.items() if names}
+        if self._local.intent_id is None:
+            self.stats["intents"] += 1
+        self._local.intent_id = self.store.save_intent(self._local.intent_id, time.time(), json.dumps(subjects))
+        self._local.dirty = False
+        self.stats["persists"] += 1
+
+    def finish(self) -> None:
+        """The write is settled (committed or rolled back): its intent is no longer needed."""
+        intent_id = getattr(self._local, "intent_id", None)
+        self.release()
+        if intent_id is not None:
+            try:
+                self.store.delete_intents([intent_id])
+            except Exception as e:
+                # Harmless: startup recovery would only find the kernel already in line.
+                logging.warning(f"Failed to drop kernel intent #{intent_id}: {e}")
+
+    def release(self) -> None:
+        """Stop logging for this thread but keep the intent on disk for startup recovery."""
+        self._local.subjects = None
+        self._local.intent_id = None
+
+    # ----- recovery -----------------------------------------------------------------------
+
+    def unfinished(self) -> tuple[list[int], dict[str, set[str]]]:
+        """Ids of the intents left by a previous run and the union of their subjects."""
+        merged: dict[str, set[str]] = {kind: set() for kind in INTENT_SUBJECTS}
+        if self.store is None:
+            return [], merged
+        ids = []
+        for intent_id, created_at, subjects in self.store.get_intents():
+            ids.append(intent_id)
+            for kind, names in json.loads(subjects).items():
+                merged.setdefault(kind, set()).update(names)
+            logging.warning(f"Unfinished kernel intent #{intent_id} from {time.ctime(created_at)}: {subjects}")
+        return ids, merged
+
+    def settle(self, intent_ids: list[int]) -> None:
+        """Forget intents once recovery has brought their subjects back in line with the database."""
+        if intent_ids:
+            self.store.delete_intents(intent_ids)
+            self.stats["recovered"] += len(intent_ids)
+
+
+intent_log = IntentLog()
@@ -0,0 +1,108 @@
+import threading
+from typing import Callable, TypeVar
+
+from backend.core.logger import logger as logging
+
+T = TypeVar("T")
+
+
+class UndoJournal:
+    """Inverse operations of the changes made by the write in progress, replayed newest first on failure.
+
+    The nftables and WireGuard helpers record the inverse of what they did (an element added is
+    deleted, a peer removed is set again), so undoing a write costs as much as the write itself.
+    Changes without a cheap inverse (a whole table load, a bulk peer sync) record a snapshot of
+    the subsystem instead, taken on first touch and at most once per write.
+
+    Recording only happens between ``begin`` and ``commit``/``rollback`` in the same thread;
+    the same helpers called at startup or by the background tasks record nothing. Inverses run
+    with recording off, so undoing never journals itself. ``mark``/``rollback_to`` undo only the
+    tail of a write, for grouped writes where one member fails and the others go on.
+
+    ``applied`` marks where the write's nft batch was last accepted by the kernel: inverses
+    recorded after it undo commands that were still queued when the write failed.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.stats: dict[str, int] = {"writes": 0, "rollbacks": 0, "entries": 0, "snapshots": 0, "undo_errors": 0}
+
+    @property
+    def active(self) -> bool:
+        return getattr(self._local, "entries", None) is not None
+
+    def begin(self) -> None:
+        self._local.entries = []
+        # Snapshot key -> index of its entry, so undoing past it lets the key be snapshotted again.
+        self._local.snapshots = {}
+        self._local.applied = 0
+        self.stats["writes"] += 1
+
+    def commit(self) -> None:
+        self._local.entries = None
+
+    def record(self, undo: Callable[[], None]) -> None:
+        entries = getattr(self._local, "entries", None)
+        if entries is not None:
+            entries.append(undo)
+            self.stats["entries"] += 1
+
+    def snapshot(self, key: str, take: Callable[[], T], restore: Callable[[T], None]) -> None:
+        """Record ``restore(take())`` the first time ``key`` is touched during this write."""
+        if not self.active or key in self._local.snapshots:
+            return
+        state = take()
+        self.stats["snapshots"] += 1
+        self._local.snapshots[key] = len(self._local.entries)
+        self.record(lambda: restore(state))
+
+    def mark(self) -> int:
+        """Position to come back to with ``rollback_to``."""
+        return len(self._local.entries) if self.active else 0
+
+    def applied(self) -> None:
+        """The nft commands queued so far were accepted by the kernel (see ``commands.batch_applied_hooks``)."""
+        if self.active:
+            self._local.applied = len(self._local.entries)
+
+    @property
+    def applied_mark(self) -> int:
+        """Position of the last accepted batch: the inverses before it have kernel changes to undo."""
+        return self._local.applied if self.active else 0
+
+    def rollback_to(self, mark: int) -> list[Exception]:
+        """Run the inverses recorded since ``mark``, newest first, and keep journaling the write."""
+        if not self.active:
+            return []
+        entries = self._local.entries
+        tail = entries[mark:]
+        del entries[mark:]
+        self._local.applied = min(self._local.applied, mark)
+        for key in [key for key, index in self._local.snapshots.items() if index >= mark]:
+            del self._local.snapshots[key]
+        self._local.entries = None
+        try:
+            return self._undo(tail)
+        finally:
+            self._local.entries = entries
+
+    def rollback(self) -> list[Exception]:
+        """Run every recorded inverse, newest first; returns the errors instead of stopping at one."""
+        entries = getattr(self._local, "entries", None) or []
+        self._local.entries = None
+        return self._undo(entries)
+
+    def _undo(self, entries: list[Callable[[], None]]) -> list[Exception]:
+        self.stats["rollbacks"] += 1
+        errors = []
+        for undo in reversed(entries):
+            try:
+                undo()
+            except Exception as e:
+                logging.error(f"Undo step failed: {e}")
+                errors.append(e)
+        self.stats["undo_errors"] += len(errors)
+        return errors
+
+
+undo_journal = UndoJournal()
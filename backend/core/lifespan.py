@@ -1,9 +1,20 @@
+import os
+import threading
+from typing import Callable
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from backend.core.config import settings
 from backend.core.database import db
+from backend.core.intents import intent_log
+from backend.core.lock import lock
 from backend.core.logger import logger as logging
+from backend.core.scheduler import write_scheduler
 from backend.core.nftables import (
+    compile_and_load,
+    reconcile_dcv_table,
+    ct_fastpath,
+    dcv_mirror,
+    subnet_policy,
     flush_dcv, 
     ensure_subnet, 
     add_member, make_public, 
@@ -14,7 +25,10 @@ from backend.core.nftables import (
     grant_admin_peer_to_peer,
     grant_admin_peer_to_subnet,
 )
-from backend.core.wireguard import apply_to_wg_config, flush_wireguard, apply_ip_route
+from backend.core.wireguard import (
+    apply_ip_route, key_pool, peer_history, resync_wireguard_peers, sync_wireguard, wg_client, wg_shards, wg_telemetry
+)
+from backend.db import IntentStore, RollupStore
 from backend.db.init_db import init_db
 from backend.core.nftables import ensure_table_and_chain
 
@@ -22,45 +36,166 @@ from backend.core.nftables import ensure_table_and_chain
 async def lifespan(app: FastAPI):
     # STARTUP CODE
     logging.info("Starting Driftcove WireGuard API...")
-    try:
-        apply_ip_route()
-    except Exception as e:
-        logging.error(f"Failed to apply IP route: {e}")
-        raise
     try:
         init_db(settings.db_path)
+        # Intents commit while a request transaction holds the main database, so they get a file of their own.
+        intent_log.configure(IntentStore(os.path.splitext(settings.db_path)[0] + "-intents.db"))
         logging.info("Database initialized successfully.")
     except Exception as e:
         logging.error(f"Failed to initialize database: {e}")
         raise
+    try:
+        wg_shards.configure(settings.wg_interface, settings.wg_udp_port, settings.wg_shards,
+                            settings.wg_shard_by, settings.wg_shard_prefix)
+        check_shard_layout()
+        if wg_shards.count > 1:
+            wg_shards.ensure_interfaces("/etc/wireguard/privatekey", settings.mtu)
+    except Exception as e:
+        logging.error(f"Failed to set up WireGuard shard interfaces: {e}")
+        raise
+    try:
+        apply_ip_route()
+    except Exception as e:
+        logging.error(f"Failed to apply IP route: {e}")
+        raise
     logging.info("Applying WireGuard configuration and nftables rules from database...")
     try:
-        apply_config_from_database()
+        subnet_policy.configure(settings.nft_policy_mode)
+        ct_fastpath.configure(settings.nft_ct_mark_fastpath)
+        wg_client.configure(settings.wg_client)
+        # A table and peers left by a previous run are patched rather than replaced, and only
+        # where a write was left unfinished, so a restart costs as much as the in-flight work.
+        recover_from_intents()
     except Exception as e:
         logging.error(f"Failed to configure WireGuard on startup: {e}")
         raise
+    stop_mirror_check = start_periodic("nft-mirror-check", settings.nft_mirror_check_interval, verify_mirror)
+    stop_graph_check = start_periodic("topology-check", settings.topology_check_interval, verify_topology_graph)
+    key_pool.start(settings.wg_key_pool_size)
+    wg_telemetry.configure(settings.wg_telemetry_interval, wg_shards.interfaces)
+    # The history writes its rollups every minute from the telemetry thread, so they get a file of their own too.
+    peer_history.configure(settings.wg_history_samples, RollupStore(os.path.splitext(settings.db_path)[0] + "-rollups.db"))
+    wg_telemetry.listeners.append(peer_history.record)
+    stop_telemetry = start_periodic("wg-telemetry", settings.wg_telemetry_interval, wg_telemetry.collect)
+    stop_reconcile = start_periodic("nft-reconcile", settings.nft_reconcile_interval, reconcile_from_database)
+    write_scheduler.start(settings.write_group_size, settings.write_group_window)
 
     yield  # control passes to the app here
 
-def apply_config_from_database():
-    try:
-        logging.info("Resetting iptables rules for WireGuard and WireGuard config...")
-        flush_dcv(wg_if=settings.wg_interface)
-        flush_wireguard()
+    stop_mirror_check.set()
+    stop_graph_check.set()
+    stop_reconcile.set()
+    key_pool.stop()
+    stop_telemetry.set()
+    write_scheduler.stop()
 
-        # ensure base table/chain exist
-        ensure_table_and_chain(wg_if=settings.wg_interface)
 
-        peers = db.get_all_peers()
-        services = db.get_all_services()
-        peer2services = db.get_links_from_peers_to_service()
-        peer2peers = db.get_links_from_peer_to_peer()
-        admin_peer2peers = db.get_admin_links_from_peer_to_peer()
-        admin_peer2subnets = db.get_admin_links_from_peer_to_subnet()
-        admin_subnet2subnets = db.get_admin_links_from_subnet_to_subnet()
+def start_periodic(name: str, interval: float, task: Callable[[], object]) -> threading.Event:
+    """Run ``task`` every ``interval`` seconds in a daemon thread; disabled when interval <= 0."""
+    stop = threading.Event()
+    if interval <= 0:
+        return stop
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                task()
+            except Exception as e:
+                logging.error(f"{name} failed: {e}")
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return stop
+
+
+def verify_mirror():
+    # verify() swaps the mirror's dicts for the kernel's: no reader or write may see it halfway.
+    with lock.write_lock():
+        dcv_mirror.verify()
+
+
+def verify_topology_graph() -> list[str]:
+    """Compare the in-memory topology graph with the database and drop it if they differ;
+    returns the views that did not match."""
+    with lock.read_lock():
+        mismatched = db.graph.check(db)
+        if mismatched:
+            logging.warning(f"Topology graph out of step with the database ({', '.join(mismatched)}), reloading it")
+            db.graph.invalidate()
+    return mismatched
+
+
+def check_shard_layout():
+    """Startup: refuse a shard layout that would move peers to another interface or port than
+    their issued config names, unless WG_SHARD_REASSIGN says the configs will be reissued."""
+    stored = db.get_shard_layout()
+    if stored == wg_shards.layout:
+        return
+    if stored is not None:
+        moved = wg_shards.moved(stored, [peer.address for peer in db.get_all_peers()])
+        if moved:
+            count, mode, prefix, base_port = stored
+            if not settings.wg_shard_reassign:
+                raise RuntimeError(
+                    f"The WireGuard shard settings would move {len(moved)} peers (e.g. {moved[0]}) off the "
+                    f"interface or port their config names; keep WG_SHARDS={count} WG_SHARD_BY={mode} "
+                    f"WG_SHARD_PREFIX={prefix} WG_UDP_PORT={base_port}, or set WG_SHARD_REASSIGN=true "
+                    f"and reissue their configs")
+            logging.warning(f"WireGuard shard layout changed, {len(moved)} peers moved: reissue their configs")
+    db.save_shard_layout(wg_shards.layout)
+    db.commit_transaction()
+
+
+def recover_from_intents():
+    """Startup: bring the kernel back in line with the database, comparing set elements and
+    WireGuard peers only where an intent says a write did not finish (see core/intents.py)."""
+    intent_ids, subjects = intent_log.unfinished()
+    peers = db.get_all_peers()
+    live_peers = sum(len(wg_client.peers(interface)) for interface in wg_shards.interfaces)
+    if subjects["wireguard"] or (peers and not live_peers):
+        # Fresh interfaces (reboot) or a bulk change in flight: every peer has to be set.
+        sync_wireguard(peers)
+    elif subjects["peer"] or subjects["address"]:
+        resync_wireguard_peers(subjects["peer"], subjects["address"], peers)
+    sets = None if subjects["table"] else subjects["set"]
+    drift = reconcile_dcv_table(dcv_table_builder(), sets=sets)
+    intent_log.settle(intent_ids)
+    logging.info(f"Recovered from {len(intent_ids)} unfinished writes; {drift} nftables changes applied")
+
+
+def reconcile_from_database() -> int:
+    """Diff the live nftables table against the database and apply only the difference."""
+    with lock.write_lock():
+        return reconcile_dcv_table(dcv_table_builder())
+
+
+def dcv_table_builder() -> Callable[[], None]:
+    """Read everything the nftables table is derived from, once, and return the helper sequence
+    that builds the table from it (run by the compiler or the reconciler, not against the DB)."""
+    peers = db.get_all_peers()
+    services = db.get_all_services()
+    service_hosts = db.get_service_hosts()
+    peer2services = db.get_links_from_peers_to_service()
+    peer2peers = db.get_links_from_peer_to_peer()
+    admin_peer2peers = db.get_admin_links_from_peer_to_peer()
+    admin_peer2subnets = db.get_admin_links_from_peer_to_subnet()
+    admin_subnet2subnets = db.get_admin_links_from_subnet_to_subnet()
+    subnets = db.get_all_subnets()
+    peer2subnets = db.get_links_from_peer_to_subnet()  # legacy “link”
+    subnet_to_subnet_links = db.get_links_from_subnet_to_subnet()
+    subnet_to_service_links = db.get_links_from_subnet_to_service()
+    subnet_addresses = db.get_addresses_in_subnets()
+
+    for service in services:
+        if service.name not in service_hosts:
+            raise Exception(f"Service host for service {service.name} not found")
+
+    def build_dcv_table():
+        flush_dcv(wg_if=wg_shards.interfaces)
+
+        # ensure base table/chain exist
+        ensure_table_and_chain(wg_if=wg_shards.interfaces)
 
         for peer in peers:
-            apply_to_wg_config(peer)
             for link in peer2peers.get(peer.address, []):
                 add_p2p_link(peer.address, link.address)
             for link in admin_peer2peers.get(peer.address, []):
@@ -68,33 +203,25 @@ def apply_config_from_database():
 
         for service in services:
             for peer in peer2services.get(service.name, []):
-                host = db.get_service_host(service)
-                if host is None:
-                    raise Exception(f"Service host for service {service.name} not found")
-                grant_service(peer.address, host.address, service.port)
+                grant_service(peer.address, service_hosts[service.name].address, service.port)
 
         # 3) Subnets: create sets & rule, then members/public
         logging.info("Applying subnet membership/public flags…")
-        subnets = db.get_all_subnets()
-        subnet_to_subnet_links = db.get_links_from_subnet_to_subnet()
-        subnet_to_service_links = db.get_links_from_subnet_to_service()
-
         for subnet in subnets:
             logging.info(f"Ensuring nftables structures for subnet {subnet.name} ({subnet.subnet})")
             ensure_subnet(subnet.subnet)
 
         # now add all the other rules
         for subnet in subnets:
-
-            linked_peers = db.get_peers_linked_to_subnet(subnet)  # legacy “link”
+            linked_peers = peer2subnets.get(subnet.subnet, [])
+            linked_addresses = {peer.address for peer in linked_peers}
             for peer in linked_peers:
                 add_member(subnet.subnet, peer.address)
                 make_public(subnet.subnet, peer.address)
-            
-            peers_inside = db.get_peers_in_subnet(subnet) # peers whose address is inside the subnet
-            for peer in peers_inside:
-                if peer not in linked_peers:
-                    add_member(subnet.subnet, peer.address)
+
+            for address in subnet_addresses.get(subnet.subnet, []):  # peers whose address is inside the subnet
+                if address not in linked_addresses:
+                    add_member(subnet.subnet, address)
 
             subnet_links = subnet_to_subnet_links.get(subnet.subnet, [])
             for linked_subnet in subnet_links:
@@ -103,9 +230,7 @@ def apply_config_from_database():
 
             link_services = subnet_to_service_links.get(subnet.subnet, [])
             for service in link_services:
-                host = db.get_service_host(service)
-                if host is None:
-                    raise Exception(f"Service host for service {service.name} not found")
+                host = service_hosts[service.name]
                 logging.info(f"Subnet {subnet.name} ({subnet.subnet}) has service {service.name} on {host.address}:{service.port}")
                 grant_subnet_service(subnet.subnet, host.address, service.port)
 
@@ -119,7 +244,23 @@ def apply_config_from_database():
             for subnet in admin_subnets:
                 logging.info(f"Admin peer {peer.username} ({peer.address}) granted admin access to subnet {subnet.name} ({subnet.subnet})")
                 grant_admin_peer_to_subnet(peer.address, subnet.subnet)
-        
+
+    return build_dcv_table
+
+
+def apply_config_from_database(reconcile: bool = False):
+    try:
+        logging.info("Synchronising WireGuard peers and nftables rules with the database...")
+        # One syncconf (or netlink diff) for every peer; unchanged peers keep their sessions.
+        sync_wireguard(db.get_all_peers())
+
+        build_dcv_table = dcv_table_builder()
+        if reconcile:
+            reconcile_dcv_table(build_dcv_table)
+        else:
+            # Render the whole table and load it in one transaction; when called from inside
+            # state_manager.saved_state() the load joins the request batch instead.
+            compile_and_load(build_dcv_table)
 
         logging.info("Loaded and applied WireGuard configuration from database")
     except Exception as e:
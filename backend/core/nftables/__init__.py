@@ -6,6 +6,12 @@ from backend.core.nftables.base import (
     flush_dcv,
     restore_dcv_table,
 )
+from backend.core.nftables.commands import nft_batch, nft_pool, nft_stats
+from backend.core.nftables.compiler import compile_and_load, compile_stats
+from backend.core.nftables.conntrack import conntrack_revoker
+from backend.core.nftables.mirror import dcv_mirror
+from backend.core.nftables.policy import ct_fastpath, subnet_policy
+from backend.core.nftables.reconciler import reconcile_dcv_table, reconcile_stats
 from backend.core.nftables.peers import (
     _purge_pair_set_for_ip,
     add_p2p_link,
@@ -20,6 +26,7 @@ from backend.core.nftables.services import (
     grant_subnet_service,
     revoke_service,
     revoke_subnet_service,
+    service_ports,
 )
 from backend.core.nftables.subnets import (
     add_member,
@@ -43,8 +50,13 @@ __all__ = [
     "add_member",
     "add_p2p_link",
     "backup_dcv_table",
+    "compile_and_load",
+    "compile_stats",
     "connect_subnet_to_subnet_public",
     "connect_subnets_bidirectional_public",
+    "conntrack_revoker",
+    "ct_fastpath",
+    "dcv_mirror",
     "del_member",
     "destroy_subnet",
     "disconnect_subnet_from_subnet_public",
@@ -61,6 +73,11 @@ __all__ = [
     "grant_service",
     "grant_subnet_service",
     "make_public",
+    "nft_batch",
+    "nft_pool",
+    "nft_stats",
+    "reconcile_dcv_table",
+    "reconcile_stats",
     "remove_p2p_link",
     "restore_dcv_table",
     "revoke_admin_peer_to_peer",
@@ -70,4 +87,6 @@ __all__ = [
     "revoke_public",
     "revoke_service",
     "revoke_subnet_service",
+    "service_ports",
+    "subnet_policy",
 ]
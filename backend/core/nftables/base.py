@@ -1,19 +1,41 @@
 import ipaddress
+from typing import Sequence
 
 from backend.core.logger import logger as logging
-from backend.core.nftables.commands import backup_table, nft_try, restore_table
+from backend.core.nftables.commands import backup_table, nft_try, restore_table, submit_early
+from backend.core.nftables.conntrack import conntrack_revoker
+from backend.core.nftables.mirror import add_set, dcv_mirror, ensure_rule, flush_chain, snapshot_table
+from backend.core.nftables.policy import PAIRS_SET, SERVICES_SET, ct_fastpath, subnet_policy
+from backend.core.nftables.services import service_ports
 
 
-def flush_dcv(wg_if: str = "wg0") -> None:
+def flush_dcv(wg_if: str | Sequence[str] = "wg0") -> None:
+    snapshot_table()
+    # ``add`` first so the ``delete`` applies on a host without the table, in the same batch.
+    nft_try("add table inet dcv")
     nft_try("delete table inet dcv")
+    # Whatever the old table allowed is gone until the rebuild grants it again.
+    conntrack_revoker.revoke_all()
+    dcv_mirror.reset()
+    subnet_policy.reset()
+    service_ports.reset()
     ensure_table_and_chain(wg_if=wg_if)
 
 
 def flush_conntrack_for_ip(ip: str) -> None:
-    logging.debug("Skipping conntrack flush for %s; nftables package does not shell out to conntrack", ip)
+    """Drop the fast-pathed connections from or to ``ip`` once the current batch is applied."""
+    try:
+        net = ipaddress.ip_network(ip, strict=False)
+    except ValueError:
+        logging.debug("invalid address %s; skipping conntrack flush", ip)
+        return
+    bounds = [(int(net.network_address), int(net.broadcast_address))]
+    conntrack_revoker.revoke(bounds, None)
+    conntrack_revoker.revoke(None, bounds)
 
 
 def flush_conntrack_for_prefix(cidr: str, allow_large_prefix: bool = False) -> None:
+    """Like ``flush_conntrack_for_ip`` for every address in ``cidr``."""
     try:
         net = ipaddress.ip_network(cidr, strict=False)
     except ValueError:
@@ -23,7 +45,7 @@ def flush_conntrack_for_prefix(cidr: str, allow_large_prefix: bool = False) -> N
         if (net.version == 4 and net.prefixlen < 24) or (net.version == 6 and net.prefixlen < 64):
             logging.debug("CIDR %s too broad; skipping conntrack flush", cidr)
             return
-    logging.debug("Skipping conntrack flush for %s; nftables package does not shell out to conntrack", cidr)
+    flush_conntrack_for_ip(cidr)
 
 
 def backup_dcv_table() -> str:
@@ -32,20 +54,31 @@ def backup_dcv_table() -> str:
 
 def restore_dcv_table(dcv_text: str) -> None:
     restore_table(dcv_text, "inet", "dcv")
+    submit_early("table restore")
+    dcv_mirror.load()
 
 
-def ensure_table_and_chain(wg_if: str = "wg0", wg_server_ip: str = "10.128.0.1") -> None:
+def ensure_table_and_chain(wg_if: str | Sequence[str] = "wg0", wg_server_ip: str = "10.128.0.1") -> None:
+    # Several interfaces when WireGuard peers are sharded; each one gets its own hook rules.
+    interfaces = [wg_if] if isinstance(wg_if, str) else list(wg_if)
     nft_try("add table inet dcv")
 
+    for set_name, spec in (
+        ("p2p_links", "type ipv4_addr . ipv4_addr; flags interval;"),
+        ("admin_links", "type ipv4_addr . ipv4_addr; flags interval;"),
+        ("admin_peer2cidr", "type ipv4_addr . ipv4_addr; flags interval;"),
+        ("blocked_pairs", "type ipv4_addr . ipv4_addr; flags interval;"),
+        ("svc_guest_tcp", "type ipv4_addr . ipv4_addr . inet_service; flags interval;"),
+        ("svc_guest_udp", "type ipv4_addr . ipv4_addr . inet_service; flags interval;"),
+        ("svc_pairs_tcp", "type ipv4_addr . ipv4_addr; flags interval;"),
+        ("svc_pairs_udp", "type ipv4_addr . ipv4_addr; flags interval;"),
+        (SERVICES_SET, "type inet_proto . ipv4_addr . ipv4_addr . inet_service; flags interval;"),
+    ):
+        add_set(set_name, spec)
+    if subnet_policy.compiled:
+        add_set(PAIRS_SET, "type ipv4_addr . ipv4_addr; flags interval;")
+
     for command in (
-        "add set inet dcv p2p_links { type ipv4_addr . ipv4_addr; flags interval; }",
-        "add set inet dcv admin_links { type ipv4_addr . ipv4_addr; flags interval; }",
-        "add set inet dcv admin_peer2cidr { type ipv4_addr . ipv4_addr; flags interval; }",
-        "add set inet dcv blocked_pairs { type ipv4_addr . ipv4_addr; flags interval; }",
-        "add set inet dcv svc_guest_tcp { type ipv4_addr . ipv4_addr . inet_service; flags interval; }",
-        "add set inet dcv svc_guest_udp { type ipv4_addr . ipv4_addr . inet_service; flags interval; }",
-        "add set inet dcv svc_pairs_tcp { type ipv4_addr . ipv4_addr; flags interval; }",
-        "add set inet dcv svc_pairs_udp { type ipv4_addr . ipv4_addr; flags interval; }",
         'add chain inet dcv input   { type filter hook input   priority 0; policy accept; }',
         'add chain inet dcv forward { type filter hook forward priority 0; policy accept; }',
         "add chain inet dcv fwd_est",
@@ -55,31 +88,48 @@ def ensure_table_and_chain(wg_if: str = "wg0", wg_server_ip: str = "10.128.0.1")
     ):
         nft_try(command)
 
-    for command in (
-        "flush chain inet dcv input",
-        "add rule inet dcv input ct state established,related accept",
-        f'add rule inet dcv input iifname "{wg_if}" ip daddr {wg_server_ip} icmp type echo-request accept',
-        "flush chain inet dcv forward",
-        "add rule inet dcv forward ip saddr . ip daddr @blocked_pairs drop",
-        "add rule inet dcv forward jump fwd_est",
-        f'add rule inet dcv forward iifname "{wg_if}" goto wg',
-        f'add rule inet dcv forward oifname "{wg_if}" goto wg',
-        "flush chain inet dcv fwd_est",
-        "add rule inet dcv fwd_est ct state established,related ct original ip saddr . ct original ip daddr @admin_peer2cidr accept",
-        "add rule inet dcv fwd_est ct state established,related ct original ip saddr . ct original ip daddr @admin_links accept",
-        "add rule inet dcv fwd_est ct state established,related ct original ip saddr . ct original ip daddr @p2p_links accept",
-        "add rule inet dcv fwd_est ct state established,related ct original protocol tcp ct original ip saddr . ct original ip daddr @svc_pairs_tcp accept",
-        "add rule inet dcv fwd_est ct state established,related ct original protocol udp ct original ip saddr . ct original ip daddr @svc_pairs_udp accept",
-        "flush chain inet dcv wg",
-        "add rule inet dcv wg jump wg_base",
-        "add rule inet dcv wg jump wg_allow",
-        "add rule inet dcv wg counter drop",
-        "flush chain inet dcv wg_base",
-        "add rule inet dcv wg_base ip saddr . ip daddr @admin_peer2cidr ct state new accept",
-        "add rule inet dcv wg_base ip saddr . ip daddr @admin_links   ct state new accept",
-        "add rule inet dcv wg_base ip saddr . ip daddr @p2p_links     ct state new accept",
-        "add rule inet dcv wg_base meta l4proto tcp ip saddr . ip daddr . th dport @svc_guest_tcp ct state new accept",
-        "add rule inet dcv wg_base meta l4proto udp ip saddr . ip daddr . th dport @svc_guest_udp ct state new accept",
-        "flush chain inet dcv wg_allow",
-    ):
-        nft_try(command)
+    # Every rule goes through the mirror and carries its signature comment, so flushes, drift
+    # checks and the reconciler can tell the rules apart without parsing them.
+    for chain in ("input", "forward", "fwd_est", "wg", "wg_base", "wg_allow"):
+        flush_chain(chain)
+
+    rules = [("input", "ct state established,related accept")]
+    rules += [("input", f'iifname "{name}" ip daddr {wg_server_ip} icmp type echo-request accept') for name in interfaces]
+    rules.append(("forward", "ip saddr . ip daddr @blocked_pairs drop"))
+    if ct_fastpath.enabled:
+        # Connections accepted by wg_base/wg_allow carry the mark; fwd_est stays empty.
+        rules.append(("forward", ct_fastpath.forward_rule))
+    else:
+        rules += [
+            ("forward", "jump fwd_est"),
+            ("fwd_est", "ct state established,related ct original ip saddr . ct original ip daddr @admin_peer2cidr accept"),
+            ("fwd_est", "ct state established,related ct original ip saddr . ct original ip daddr @admin_links accept"),
+            ("fwd_est", "ct state established,related ct original ip saddr . ct original ip daddr @p2p_links accept"),
+            ("fwd_est", "ct state established,related ct original protocol tcp ct original ip saddr . ct original ip daddr @svc_pairs_tcp accept"),
+            ("fwd_est", "ct state established,related ct original protocol udp ct original ip saddr . ct original ip daddr @svc_pairs_udp accept"),
+            ("fwd_est", "ct state established,related "
+                        f"ct original protocol . ct original ip saddr . ct original ip daddr . ct original proto-dst @{SERVICES_SET} accept"),
+        ]
+        if subnet_policy.compiled:
+            rules.append(("fwd_est", f"ct state established,related ct original ip saddr . ct original ip daddr @{PAIRS_SET} accept"))
+
+    accept = ct_fastpath.verdict
+    for name in interfaces:
+        rules += [("forward", f'iifname "{name}" goto wg'), ("forward", f'oifname "{name}" goto wg')]
+    rules += [
+        ("wg", "jump wg_base"),
+        ("wg", "jump wg_allow"),
+        ("wg", "counter drop"),
+        ("wg_base", f"ip saddr . ip daddr @admin_peer2cidr ct state new {accept}"),
+        ("wg_base", f"ip saddr . ip daddr @admin_links   ct state new {accept}"),
+        ("wg_base", f"ip saddr . ip daddr @p2p_links     ct state new {accept}"),
+        ("wg_base", f"meta l4proto tcp ip saddr . ip daddr . th dport @svc_guest_tcp ct state new {accept}"),
+        ("wg_base", f"meta l4proto udp ip saddr . ip daddr . th dport @svc_guest_udp ct state new {accept}"),
+        ("wg_base", f"meta l4proto . ip saddr . ip daddr . th dport @{SERVICES_SET} ct state new {accept}"),
+    ]
+    if subnet_policy.compiled:
+        # Subnet links are expanded into PAIRS_SET instead of one wg_allow/fwd_est rule pair each.
+        rules.append(("wg_base", f"ip saddr . ip daddr @{PAIRS_SET} ct state new {accept}"))
+
+    for chain, rule in rules:
+        ensure_rule(chain, rule)
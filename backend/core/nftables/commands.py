@@ -1,7 +1,8 @@
 import importlib
 import json
-import re
-from typing import Any
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
 
 from backend.core.logger import logger as logging
 
@@ -13,7 +14,7 @@ class NftablesCommandError(RuntimeError):
         self.error = error
 
 
-def _new_nft(*, json_output: bool = False, handle_output: bool = False):
+def _new_nft(*, json_output: bool = False, handle_output: bool = False, echo_output: bool = False):
     """Create a libnftables client only when a real nft operation is requested."""
     # The external binding is installed in the backend container, but not necessarily on
     # developer hosts. Lazy import keeps local test collection and skipped Docker tests usable.
@@ -22,7 +23,7 @@ def _new_nft(*, json_output: bool = False, handle_output: bool = False):
     for method_name, value in (
         ("set_json_output", json_output),
         ("set_handle_output", handle_output),
-        ("set_echo_output", False),
+        ("set_echo_output", echo_output),
         ("set_stateless_output", False),
     ):
         method = getattr(nft, method_name, None)
@@ -31,6 +32,50 @@ def _new_nft(*, json_output: bool = False, handle_output: bool = False):
     return nft
 
 
+class NftClientPool:
+    """Long-lived libnftables contexts, one per output mode (text, JSON, handles, echo) and thread.
+
+    Creating an ``Nftables`` context and setting its output flags costs more than most single
+    commands, so each thread keeps its configured contexts and reuses them. libnftables contexts
+    are not safe to share between threads, hence the thread-local storage. A context whose
+    ``cmd()`` raises (as opposed to returning a non-zero rc for a rejected command) is dropped
+    and rebuilt on the next call.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.stats: dict[str, int] = {"created": 0, "reused": 0, "rebuilt": 0}
+
+    def _clients(self) -> dict[tuple[bool, bool, bool], Any]:
+        clients = getattr(self._local, "clients", None)
+        if clients is None:
+            clients = self._local.clients = {}
+        return clients
+
+    def get(self, *, json_output: bool = False, handle_output: bool = False, echo_output: bool = False):
+        clients = self._clients()
+        key = (json_output, handle_output, echo_output)
+        nft = clients.get(key)
+        if nft is not None:
+            self.stats["reused"] += 1
+            return nft
+        nft = clients[key] = _new_nft(json_output=json_output, handle_output=handle_output, echo_output=echo_output)
+        self.stats["created"] += 1
+        return nft
+
+    def cmd(self, command: str, *, json_output: bool = False, handle_output: bool = False, echo_output: bool = False):
+        nft = self.get(json_output=json_output, handle_output=handle_output, echo_output=echo_output)
+        try:
+            return nft.cmd(command)
+        except Exception:
+            self._clients().pop((json_output, handle_output, echo_output), None)
+            self.stats["rebuilt"] += 1
+            raise
+
+
+nft_pool = NftClientPool()
+
+
 def _decode(value: Any) -> str:
     if value is None:
         return ""
@@ -39,9 +84,35 @@ def _decode(value: Any) -> str:
     return str(value)
 
 
-def nft_cmd(command: str, *, json_output: bool = False, handle_output: bool = False) -> str:
-    nft = _new_nft(json_output=json_output, handle_output=handle_output)
-    rc, out, err = nft.cmd(command)
+# Counters for the kernel round-trips issued by this process; read by the benchmarks.
+nft_stats: dict[str, int] = {
+    "commands": 0,
+    "round_trips": 0,
+    "batches": 0,
+    "batch_rejections": 0,
+    "early_submits": 0,
+}
+
+# Called right before a batch is handed to the kernel, e.g. to make the write's intent durable
+# first (see backend/core/intents.py). An exception keeps the batch from being submitted.
+submit_hooks: list[Callable[[], None]] = []
+
+# Called when the kernel rejected a batch, so in-memory views of the table (see mirror.py), which
+# already reflect the queued commands, know they no longer match the kernel.
+batch_rejected_hooks: list[Callable[[], None]] = []
+
+# Called when the kernel accepted a batch, e.g. so a failed write knows which of its inverses undo
+# kernel changes and which only undo queued commands (see backend/core/state_manager.py).
+batch_applied_hooks: list[Callable[[], None]] = []
+
+HandleCallback = Callable[[int], None]
+
+_local = threading.local()
+
+
+def _run(command: str, *, json_output: bool = False, handle_output: bool = False, echo_output: bool = False) -> str:
+    nft_stats["round_trips"] += 1
+    rc, out, err = nft_pool.cmd(command, json_output=json_output, handle_output=handle_output, echo_output=echo_output)
     out_text = _decode(out)
     err_text = _decode(err)
     if rc != 0:
@@ -49,14 +120,212 @@ def nft_cmd(command: str, *, json_output: bool = False, handle_output: bool = Fa
     return out_text
 
 
-def nft_try(command: str) -> None:
+def _echoed_rule_handles(out: str) -> list[int]:
+    """Handles of the rules added by a command buffer run with JSON echo output, in order."""
     try:
-        nft_cmd(command)
-    except Exception as exc:
-        logging.debug("nftables command failed (ignored): %s -> %s", command, exc)
+        data = json.loads(out or "{}")
+    except ValueError:
+        return []
+    handles: list[int] = []
+    for item in data.get("nftables", []):
+        added = item.get("add") if isinstance(item, dict) else None
+        rule = added.get("rule") if isinstance(added, dict) else None
+        if isinstance(rule, dict) and rule.get("handle") is not None:
+            handles.append(int(rule["handle"]))
+    return handles
+
+
+def _run_with_handle(command: str, on_handle: HandleCallback) -> None:
+    handles = _echoed_rule_handles(_run(command, json_output=True, echo_output=True))
+    if handles:
+        on_handle(handles[0])
+
+
+class NftBatch:
+    """Mutating nft commands queued for a single libnftables transaction.
+
+    The whole buffer is handed to libnftables in one ``cmd()`` call, which the kernel applies
+    atomically: if any command is rejected nothing from the batch is applied and ``flush``
+    raises, whether the command was issued through ``nft_cmd`` or ``nft_try``. Commands queued
+    through ``nft_try`` therefore have to be idempotent (``add``) or only be issued when they
+    apply: the mirror helpers skip deleting elements, sets and rules they know are absent.
+    ``add rule`` entries may carry a callback that receives the kernel handle of the new rule;
+    batches with callbacks are submitted with JSON echo output to learn those handles. A capture
+    batch (see ``nft_capture``) only records its commands and never submits them.
+
+    Reads issued inside a batch go to the kernel without submitting the queued commands, so a
+    write reaches the kernel as one transaction; the mirror (see mirror.py) is what reflects the
+    queued commands. The only exceptions go through ``submit_early``: each is counted in
+    ``nft_stats["early_submits"]`` and compensated by the undo journal if the write fails.
+    """
+
+    def __init__(self, capture: bool = False):
+        self.capture = capture
+        self.commands: list[str | None] = []
+        self.on_handle: dict[int, HandleCallback] = {}
+        self.deferred: dict[Callable[[], None], None] = {}
+        # Bumped whenever the queue is emptied, so queue indexes from before are never reused.
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return sum(1 for entry in self.commands if entry is not None)
+
+    def queue(self, command: str, *, on_handle: HandleCallback | None = None) -> int:
+        self.commands.append(command)
+        if not self.capture:
+            nft_stats["commands"] += 1
+        index = len(self.commands) - 1
+        if on_handle is not None:
+            self.on_handle[index] = on_handle
+        return index
+
+    def cancel(self, index: int) -> None:
+        """Drop a queued command that has not been submitted yet."""
+        self.commands[index] = None
+        self.on_handle.pop(index, None)
+
+    def defer(self, callback: Callable[[], None]) -> None:
+        """Run ``callback`` once the commands queued so far have been accepted by the kernel."""
+        self.deferred[callback] = None
+
+    def discard(self) -> None:
+        self.commands = []
+        self.on_handle = {}
+        self.deferred = {}
+        self.generation += 1
+
+    def flush(self) -> None:
+        if self.capture:
+            return
+        entries = [(index, entry) for index, entry in enumerate(self.commands) if entry is not None]
+        callbacks = self.on_handle
+        deferred = list(self.deferred)
+        self.discard()
+        if not entries:
+            for callback in deferred:
+                callback()
+            return
+        for hook in submit_hooks:
+            hook()
+        nft_stats["batches"] += 1
+        try:
+            out = _run("\n".join(command for _, command in entries), json_output=bool(callbacks), echo_output=bool(callbacks))
+        except NftablesCommandError:
+            # The kernel rolled the whole transaction back. The helpers only queue commands that
+            # apply on top of the state they expect (see mirror.py), so a rejection means that
+            # state was wrong: fail the batch rather than applying part of it.
+            nft_stats["batch_rejections"] += 1
+            for hook in batch_rejected_hooks:
+                hook()
+            raise
+        if callbacks:
+            added = [index for index, command in entries if command.lstrip().startswith("add rule")]
+            handles = _echoed_rule_handles(out)
+            if len(handles) == len(added):
+                for index, handle in zip(added, handles):
+                    if index in callbacks:
+                        callbacks[index](handle)
+            else:
+                # Without a one-to-one match the handles cannot be attributed; callers fall
+                # back to looking the rules up when they need them.
+                logging.debug("nftables echoed %d rule handles for %d added rules", len(handles), len(added))
+        for hook in batch_applied_hooks:
+            hook()
+        for callback in deferred:
+            callback()
+
+
+def current_batch() -> NftBatch | None:
+    return getattr(_local, "batch", None)
+
+
+@contextmanager
+def nft_batch() -> Iterator[NftBatch]:
+    """Queue every mutating nft command issued in this thread and submit them as one transaction.
+
+    Nested uses join the outermost batch. The batch is submitted when the outermost block exits
+    normally and discarded if it raises. Read commands (``list ...``) are run right away and do
+    not see the pending commands.
+    """
+    batch = current_batch()
+    if batch is not None:
+        yield batch
+        return
+
+    batch = NftBatch()
+    _local.batch = batch
+    try:
+        yield batch
+    except BaseException:
+        batch.discard()
+        raise
+    finally:
+        _local.batch = None
+    batch.flush()
+
+
+@contextmanager
+def nft_capture() -> Iterator[NftBatch]:
+    """Record the mutating nft commands issued in this thread instead of submitting them.
+
+    Used by the ruleset compiler to turn the helpers' command stream into a declarative table.
+    Reads still go to the kernel and therefore do not see the recorded commands.
+    """
+    previous = current_batch()
+    batch = NftBatch(capture=True)
+    _local.batch = batch
+    try:
+        yield batch
+    finally:
+        _local.batch = previous
+
 
+def _is_read(command: str, json_output: bool, handle_output: bool) -> bool:
+    return json_output or handle_output or command.lstrip().startswith("list")
 
 
+def submit_early(reason: str) -> None:
+    """Submit the commands queued in this thread's batch before the write ends.
+
+    Only for the steps that have to see the kernel in between: loading a compiled ruleset (its
+    rejection must be caught to fall back to the helpers), putting a whole table back while
+    undoing, and handing the inverses of a failed savepoint to the kernel. The commands submitted
+    here are journaled like the others, so a write that fails later undoes them.
+    """
+    batch = current_batch()
+    if batch is None or batch.capture:
+        return
+    if len(batch):
+        nft_stats["early_submits"] += 1
+        logging.debug("nftables batch submitted before the end of the write: %s", reason)
+    batch.flush()
+
+
+def nft_cmd(command: str, *, json_output: bool = False, handle_output: bool = False) -> str:
+    batch = current_batch()
+    if batch is not None and not _is_read(command, json_output, handle_output):
+        batch.queue(command)
+        return ""
+    nft_stats["commands"] += 1
+    return _run(command, json_output=json_output, handle_output=handle_output)
+
+
+def nft_try(command: str, *, on_handle: HandleCallback | None = None) -> None:
+    """Run ``command``, ignoring a rejection. Inside a batch it joins the transaction like any
+    other command, so it must apply there (see ``NftBatch``)."""
+    batch = current_batch()
+    if batch is not None and not _is_read(command, False, False):
+        batch.queue(command, on_handle=on_handle)
+        return
+    try:
+        if on_handle is not None:
+            nft_stats["commands"] += 1
+            _run_with_handle(command, on_handle)
+        else:
+            nft_cmd(command)
+    except Exception as exc:
+        logging.debug("nftables command failed (ignored): %s -> %s", command, exc)
+
 
 def nft_json(command: str) -> dict:
     out = nft_cmd(command, json_output=True)
@@ -74,72 +343,11 @@ def slug(value: str) -> str:
     return "".join(ch if ch.isalnum() else "_" for ch in value)
 
 
-def delete_rule_by_match(chain: str, pattern: str) -> None:
-    out = nft_list_text(f"list chain inet dcv {chain}", handle_output=True)
-    for line in out.splitlines():
-        if re.search(pattern, line):
-            match = re.search(r"handle\s+(\d+)", line)
-            if match:
-                nft_try(f"delete rule inet dcv {chain} handle {match.group(1)}")
-
-
 def backup_table(family: str, table: str, fallback: str) -> str:
     out = nft_list_text(f"list table {family} {table}")
     return out if out.strip() else fallback
 
 
 def restore_table(table_text: str, family: str, table: str) -> None:
-    nft_try(f"delete table {family} {table}")
-    nft_cmd(table_text)
-
-
-def list_set_elements(set_name: str) -> list[Any]:
-    try:
-        data = nft_json(f"list set inet dcv {set_name}")
-    except Exception as exc:
-        logging.debug("nftables set query failed for %s: %s", set_name, exc)
-        return []
-
-    direct_set = data.get("set")
-    if isinstance(direct_set, dict):
-        return direct_set.get("elem", []) or []
-
-    for item in data.get("nftables", []):
-        set_data = item.get("set") if isinstance(item, dict) else None
-        if isinstance(set_data, dict):
-            return set_data.get("elem", []) or []
-    return []
-
-
-def element_tuple(element: Any) -> list[Any]:
-    if isinstance(element, dict):
-        value = element.get("elem", element.get("val", element))
-    else:
-        value = element
-    return value if isinstance(value, list) else [value]
-
-
-def table_rules() -> list[dict]:
-    try:
-        data = nft_json("list table inet dcv")
-    except Exception:
-        return []
-    rules: list[dict] = []
-    for item in data.get("nftables", []):
-        rule = item.get("rule") if isinstance(item, dict) else None
-        if isinstance(rule, dict):
-            rules.append(rule)
-    return rules
-
-
-def expression_has_set(node: Any, name: str) -> bool:
-    if isinstance(node, dict):
-        if node.get("set") == name:
-            return True
-        lookup = node.get("lookup")
-        if isinstance(lookup, dict) and (lookup.get("set") == name or lookup.get("name") == name):
-            return True
-        return any(expression_has_set(value, name) for value in node.values())
-    if isinstance(node, list):
-        return any(expression_has_set(value, name) for value in node)
-    return False
+    # ``add`` makes the ``delete`` valid when the table is gone; all three apply as one transaction.
+    nft_cmd(f"add table {family} {table}\ndelete table {family} {table}\n{table_text}")
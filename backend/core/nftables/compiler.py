@@ -0,0 +1,216 @@
+import re
+import time
+from typing import Callable
+
+from backend.core.logger import logger as logging
+from backend.core.nftables.commands import NftablesCommandError, nft_batch, nft_capture, nft_cmd, submit_early
+from backend.core.nftables.conntrack import conntrack_revoker
+from backend.core.nftables.mirror import dcv_mirror, snapshot_table
+
+_ADD_SET = re.compile(r"^add set inet dcv (\S+) \{ (.*) \}$")
+_SET_OP = re.compile(r"^(flush|delete) set inet dcv (\S+)$")
+_ELEMENT_OP = re.compile(r"^(add|delete) element inet dcv (\S+) \{ (.*) \}$")
+_ADD_CHAIN = re.compile(r"^add chain inet dcv (\S+)(?:\s+\{ (.*) \})?$")
+_FLUSH_CHAIN = re.compile(r"^flush chain inet dcv (\S+)$")
+_ADD_RULE = re.compile(r"^add rule inet dcv (\S+) (.*)$")
+_CHAIN_REF = re.compile(r"\b(?:jump|goto) (\w+)")
+
+# Filled by compile_and_load; exposed under /network/metrics.
+compile_stats: dict[str, float] = {
+    "compile_seconds": 0.0,
+    "load_seconds": 0.0,
+    "rules": 0,
+    "elements": 0,
+    "bytes": 0,
+    "loads": 0,
+    "fallbacks": 0,
+}
+
+
+class DcvRuleset:
+    """Declarative ``inet dcv`` table folded from the nft commands the helpers issue.
+
+    The helpers are the single source of truth for what the table looks like, so instead of
+    duplicating them the compiler records their command stream (``nft_capture``) and folds it
+    into final sets, elements and chains here. ``render`` turns the result into one ``table``
+    block that libnftables parses and applies as a single transaction.
+    """
+
+    def __init__(self):
+        self.sets: dict[str, str] = {}
+        self.elements: dict[str, dict[str, None]] = {}
+        self.chains: dict[str, str] = {}
+        self.rules: dict[str, list[str]] = {}
+
+    def clear(self) -> None:
+        self.sets.clear()
+        self.elements.clear()
+        self.chains.clear()
+        self.rules.clear()
+
+    def apply(self, command: str) -> None:
+        command = command.strip()
+        if command == "add table inet dcv":
+            return
+        if command == "delete table inet dcv":
+            self.clear()
+            return
+        if match := _ADD_SET.match(command):
+            name, spec = match.groups()
+            self.sets.setdefault(name, spec)
+            self.elements.setdefault(name, {})
+            return
+        if match := _SET_OP.match(command):
+            op, name = match.groups()
+            if op == "flush":
+                self.elements[name] = {}
+            else:
+                self.sets.pop(name, None)
+                self.elements.pop(name, None)
+            return
+        if match := _ELEMENT_OP.match(command):
+            op, name, elements = match.groups()
+            current = self.elements.setdefault(name, {})
+            for element in elements.split(", "):
+                if op == "add":
+                    current[element] = None
+                else:
+                    current.pop(element, None)
+            return
+        if match := _ADD_CHAIN.match(command):
+            name, header = match.groups()
+            self.chains.setdefault(name, " ".join((header or "").split()))
+            self.rules.setdefault(name, [])
+            return
+        if match := _FLUSH_CHAIN.match(command):
+            self.rules[match.group(1)] = []
+            return
+        if match := _ADD_RULE.match(command):
+            chain, rule = match.groups()
+            self.rules.setdefault(chain, []).append(" ".join(rule.split()))
+            return
+        # Handle-based deletes cannot be folded: the captured table has no handles yet.
+        raise ValueError(f"Cannot compile nft command: {command}")
+
+    def _chain_order(self) -> list[str]:
+        """Chains ordered so that every jump/goto target is defined before the chain using it."""
+        ordered: list[str] = []
+        visiting: set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in ordered or name in visiting or name not in self.chains:
+                return
+            visiting.add(name)
+            for rule in self.rules.get(name, []):
+                for target in _CHAIN_REF.findall(rule):
+                    visit(target)
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in self.chains:
+            visit(name)
+        return ordered
+
+    @property
+    def rule_count(self) -> int:
+        return sum(len(rules) for rules in self.rules.values())
+
+    @property
+    def element_count(self) -> int:
+        return sum(len(elements) for elements in self.elements.values())
+
+    def render(self) -> str:
+        lines = ["table inet dcv {"]
+        for name, spec in self.sets.items():
+            lines.append(f"\tset {name} {{")
+            lines.extend(f"\t\t{part.strip()};" for part in spec.split(";") if part.strip())
+            elements = self.elements.get(name)
+            if elements:
+                lines.append(f"\t\telements = {{ {', '.join(elements)} }}")
+            lines.append("\t}")
+        for name in self._chain_order():
+            lines.append(f"\tchain {name} {{")
+            lines.extend(f"\t\t{part.strip()};" for part in self.chains[name].split(";") if part.strip())
+            lines.extend(f"\t\t{rule}" for rule in self.rules.get(name, []))
+            lines.append("\t}")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+def compile_ruleset(build: Callable[[], None]) -> DcvRuleset:
+    """Run ``build`` (a sequence of nftables helper calls) without touching the kernel and return
+    the table it would produce. The mirror and the policy index are updated as usual."""
+    ruleset = DcvRuleset()
+    with nft_capture() as capture:
+        build()
+    for command in capture.commands:
+        if command is not None:
+            ruleset.apply(command)
+    # Captured rule adds never reach the kernel on their own; their handles are learned below.
+    dcv_mirror.pending.clear()
+    return ruleset
+
+
+def load_ruleset(table_text: str) -> None:
+    """Replace the ``inet dcv`` table with a rendered ``table inet dcv { ... }`` in one transaction.
+
+    ``add table`` makes the ``delete`` valid on an empty host; both run in the same transaction
+    as the definition, so there is no moment without a table.
+    """
+    nft_cmd("add table inet dcv\ndelete table inet dcv\n" + table_text)
+
+
+def replay(build: Callable[[], None]) -> int:
+    """Apply ``build`` through the helpers, as one batch (or as part of the open one), instead of
+    as a compiled table. Returns the number of commands it queued."""
+    compile_stats["fallbacks"] += 1
+    with nft_batch() as batch:
+        queued = len(batch)
+        build()
+        return len(batch) - queued
+
+
+def compile_and_load(build: Callable[[], None]) -> None:
+    """Compile ``build`` into a declarative table and load it, applying ``build`` through the
+    helpers instead if it cannot be compiled or the kernel rejects the compiled table.
+
+    Inside a request batch, what the request queued so far is submitted first and the table is
+    loaded in a transaction of its own (see ``submit_early``), so a rejection is known here and
+    not at the end of the request, when there is nothing left to fall back to.
+    """
+    # The table is replaced wholesale, so an undo needs the table as it was.
+    snapshot_table()
+    started = time.perf_counter()
+    try:
+        ruleset = compile_ruleset(build)
+    except ValueError as exc:
+        logging.warning(f"Could not compile the nftables ruleset, applying it through the helpers: {exc}")
+        replay(build)
+        return
+    text = ruleset.render()
+    compiled = time.perf_counter()
+    compile_stats["compile_seconds"] = compiled - started
+    compile_stats["rules"] = ruleset.rule_count
+    compile_stats["elements"] = ruleset.element_count
+    compile_stats["bytes"] = len(text)
+
+    submit_early("ruleset load")
+    try:
+        load_ruleset(text)
+        submit_early("ruleset load")
+    except NftablesCommandError as exc:
+        # A single rejected element fails the whole definition.
+        logging.warning(f"Compiled nftables ruleset was rejected, applying it through the helpers: {exc.error}")
+        replay(build)
+        return
+    compile_stats["load_seconds"] = time.perf_counter() - compiled
+    compile_stats["loads"] += 1
+    # The revocations of the build were captured, not applied: what the old table allowed is gone.
+    conntrack_revoker.revoke_all()
+    # Learn the handles of the managed rules that were just created.
+    dcv_mirror.load()
+    logging.info(
+        f"Compiled nftables ruleset: {ruleset.rule_count} rules, {ruleset.element_count} elements, "
+        f"{len(text)} bytes in {compile_stats['compile_seconds'] * 1000:.1f} ms, "
+        f"loaded in {compile_stats['load_seconds'] * 1000:.1f} ms"
+    )
@@ -0,0 +1,171 @@
+import errno
+import ipaddress
+import threading
+from bisect import bisect_right
+from typing import Callable, Iterable
+
+from backend.core.logger import logger as logging
+from backend.core.nftables.commands import current_batch
+
+Range = tuple[int, int]
+# Sources and destinations of the connections a change no longer allows; None means any address.
+Revocation = tuple[list[Range] | None, list[Range] | None]
+
+
+class ConntrackError(RuntimeError):
+    pass
+
+
+def _merge(ranges: Iterable[Range]) -> tuple[list[int], list[int]]:
+    starts: list[int] = []
+    ends: list[int] = []
+    for start, end in sorted(ranges):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def _contains(bounds: tuple[list[int], list[int]], value: int) -> bool:
+    starts, ends = bounds
+    index = bisect_right(starts, value) - 1
+    return index >= 0 and ends[index] >= value
+
+
+class ConntrackRevoker:
+    """Drops the conntrack entries of fast-pathed connections that a change no longer allows.
+
+    With the conntrack mark fast path (see ``CtMarkFastPath``) established packets are accepted
+    on the mark alone, so removing a grant from the table does not stop a connection that was
+    already accepted. The set and rule helpers therefore report what they take away here, and
+    once the nft batch carrying the change has been accepted by the kernel, every marked entry
+    whose original direction matches is deleted. A connection that is still allowed is picked up
+    again as new on its next packet and passes the NEW rules; one that is not is dropped.
+
+    Revocations are gathered per batch and applied with one dump of the marked entries. Nothing
+    is done while the fast path is off: ``fwd_est`` then checks every established packet.
+
+    If conntrack cannot be changed, every marked entry is dropped on a fresh socket instead; if
+    that fails too, ``ConntrackError`` is raised, out of ``nft_batch`` for a deferred revocation,
+    so that the write fails and its changes are undone rather than leaving connections running.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.mark = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._socket = None
+        self.stats: dict[str, int] = {"flushes": 0, "revocations": 0, "deleted": 0, "errors": 0}
+
+    def configure(self, enabled: bool, mark: int) -> None:
+        self.enabled = enabled
+        self.mark = mark
+
+    def revoke(self, sources: list[Range] | None, destinations: list[Range] | None) -> None:
+        """Connections from ``sources`` to ``destinations`` lose their entry once the current batch is applied."""
+        if not self.enabled:
+            return
+        batch = current_batch()
+        if batch is None:
+            self._delete([(sources, destinations)])
+            return
+        if batch.capture:
+            # Captured commands never reach the kernel; whoever loads them revokes (see compiler.py).
+            return
+        pending = getattr(self._local, "pending", None)
+        if pending is None or pending[0] is not batch or pending[1] != batch.generation:
+            pending = self._local.pending = (batch, batch.generation, [])
+        pending[2].append((sources, destinations))
+        batch.defer(self._flush_pending)
+
+    def revoke_all(self) -> None:
+        """Every fast-pathed connection, for changes that replace the whole table."""
+        self.revoke(None, None)
+
+    def _flush_pending(self) -> None:
+        pending = getattr(self._local, "pending", None)
+        self._local.pending = None
+        if pending is not None:
+            self._delete(pending[2])
+
+    def _conntrack(self):
+        if self._socket is None:
+            from pyroute2 import Conntrack  # optional dependency, imported on first use
+
+            self._socket = Conntrack()
+        return self._socket
+
+    def _delete(self, revocations: list[Revocation]) -> None:
+        self.stats["flushes"] += 1
+        self.stats["revocations"] += len(revocations)
+        any_source: list[Range] = []
+        any_destination: list[Range] = []
+        pairs: list[Revocation] = []
+        everything = False
+        for sources, destinations in revocations:
+            if sources is None and destinations is None:
+                everything = True
+            elif destinations is None:
+                any_destination.extend(sources)
+            elif sources is None:
+                any_source.extend(destinations)
+            else:
+                pairs.append((sources, destinations))
+        from_sources = _merge(any_destination)
+        to_destinations = _merge(any_source)
+        pair_bounds = [(_merge(sources), _merge(destinations)) for sources, destinations in pairs]
+
+        def revoked(source: int, destination: int) -> bool:
+            if everything or _contains(from_sources, source) or _contains(to_destinations, destination):
+                return True
+            return any(_contains(s, source) and _contains(d, destination) for s, d in pair_bounds)
+
+        try:
+            deleted = self._drop(revoked)
+        except Exception as exc:
+            self.stats["errors"] += 1
+            if everything:
+                raise ConntrackError(f"Failed to drop revoked connections from conntrack: {exc}") from exc
+            # Retry on a fresh socket without sorting: every fast-pathed connection goes through the
+            # NEW rules again, the ones that are still allowed pass.
+            logging.error(f"Failed to drop revoked connections from conntrack, dropping every marked one: {exc}")
+            try:
+                deleted = self._drop(lambda source, destination: True)
+            except Exception as retry_exc:
+                self.stats["errors"] += 1
+                raise ConntrackError(f"Failed to drop revoked connections from conntrack: {retry_exc}") from retry_exc
+        self.stats["deleted"] += deleted
+        if deleted:
+            logging.info(f"Dropped {deleted} revoked connections from conntrack")
+
+    def _drop(self, revoked: Callable[[int, int], bool]) -> int:
+        """Deletes the marked entries whose original direction is ``revoked``; the socket is reopened next time on failure."""
+        with self._lock:
+            try:
+                conntrack = self._conntrack()
+                deleted = 0
+                for entry in list(conntrack.dump_entries(mark=self.mark, mark_mask=self.mark)):
+                    orig = entry.tuple_orig
+                    try:
+                        source = int(ipaddress.IPv4Address(orig.saddr))
+                        destination = int(ipaddress.IPv4Address(orig.daddr))
+                    except ValueError:
+                        continue
+                    if not revoked(source, destination):
+                        continue
+                    try:
+                        conntrack.entry("del", tuple_orig=orig)
+                    except Exception as exc:
+                        if getattr(exc, "code", None) != errno.ENOENT:
+                            raise
+                        continue  # timed out or closed since the dump
+                    deleted += 1
+                return deleted
+            except Exception:
+                self._socket = None
+                raise
+
+conntrack_revoker = ConntrackRevoker()
@@ -0,0 +1,518 @@
+import bisect
+import hashlib
+import ipaddress
+import re
+import time
+from typing import Any, Iterable
+
+from backend.core.intents import intent_log
+from backend.core.journal import undo_journal
+from backend.core.logger import logger as logging
+from backend.core.nftables import commands
+from backend.core.nftables.commands import backup_table, current_batch, nft_json, nft_try, restore_table, submit_early
+from backend.core.nftables.conntrack import conntrack_revoker
+
+
+def canonical_rule(rule: str) -> str:
+    return " ".join(rule.split())
+
+
+def rule_signature(chain: str, rule: str) -> str:
+    """Stable id of a rule, stored in the rule comment so it survives kernel re-printing."""
+    digest = hashlib.sha1(f"{chain}|{canonical_rule(rule)}".encode()).hexdigest()
+    return f"dcv:{digest[:20]}"
+
+
+def canonical_element(element: str) -> str:
+    return " . ".join(part.strip() for part in re.split(r"\s+\.\s+", element.strip()))
+
+
+def _json_value_text(value: Any) -> str:
+    if isinstance(value, dict):
+        if "prefix" in value:
+            prefix = value["prefix"]
+            if prefix.get("len") == 32:
+                return str(prefix["addr"])
+            return f"{prefix['addr']}/{prefix['len']}"
+        if "range" in value:
+            low, high = value["range"]
+            return f"{_json_value_text(low)}-{_json_value_text(high)}"
+    return str(value)
+
+
+def json_element_text(element: Any) -> str:
+    """Render a set element from ``nft -j`` output the way the helpers write it."""
+    if isinstance(element, dict) and "elem" in element:
+        element = element["elem"]
+        if isinstance(element, dict) and "val" in element:
+            element = element["val"]
+    if isinstance(element, dict) and "concat" in element:
+        return " . ".join(_json_value_text(part) for part in element["concat"])
+    return _json_value_text(element)
+
+
+def _address_range(value: str) -> tuple[int, int] | None:
+    """Integer bounds of an element field (address, prefix or range); None for ports and protocols."""
+    if "." not in value and ":" not in value:
+        return None
+    try:
+        if "-" in value:
+            low, high = value.split("-", 1)
+            return int(ipaddress.ip_address(low)), int(ipaddress.ip_address(high))
+        net = ipaddress.ip_network(value, strict=False)
+        return int(net.network_address), int(net.broadcast_address)
+    except ValueError:
+        return None
+
+
+class AddressIndex:
+    """Elements of one set sorted by the integer bounds of each of their address fields.
+
+    ``within`` returns the elements with an address field inside a network by bisecting to the
+    network start and walking only the entries that begin inside it, so purges cost the number
+    of matches rather than a parse of every element.
+    """
+
+    def __init__(self, elements: Iterable[str] = ()):
+        self.entries: list[tuple[int, int, str]] = []
+        for element in elements:
+            self.entries.extend(self._entries(element))
+        self.entries.sort()
+
+    @staticmethod
+    def _entries(element: str) -> set[tuple[int, int, str]]:
+        entries = set()
+        for field in element.split(" . "):
+            bounds = _address_range(field)
+            if bounds is not None:
+                entries.add((bounds[0], bounds[1], element))
+        return entries
+
+    def add(self, element: str) -> None:
+        for entry in self._entries(element):
+            bisect.insort(self.entries, entry)
+
+    def discard(self, element: str) -> None:
+        for entry in self._entries(element):
+            i = bisect.bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+
+    def within(self, cidr: str) -> list[str]:
+        """Elements having an address, prefix or range field that lies entirely inside ``cidr``."""
+        bounds = _address_range(cidr)
+        if bounds is None:
+            return []
+        low, high = bounds
+        matches: dict[str, None] = {}
+        i = bisect.bisect_left(self.entries, (low,))
+        while i < len(self.entries) and self.entries[i][0] <= high:
+            if self.entries[i][1] <= high:
+                matches[self.entries[i][2]] = None
+            i += 1
+        return list(matches)
+
+
+def _referenced_sets(rule: str) -> frozenset[str]:
+    return frozenset(re.findall(r"@(\w+)", rule))
+
+
+def _json_referenced_sets(node: Any) -> set[str]:
+    if isinstance(node, str):
+        return {node[1:]} if node.startswith("@") else set()
+    if isinstance(node, dict):
+        return set().union(*(_json_referenced_sets(value) for value in node.values())) if node else set()
+    if isinstance(node, list):
+        return set().union(*(_json_referenced_sets(value) for value in node)) if node else set()
+    return set()
+
+
+class DcvMirror:
+    """In-memory copy of the ``inet dcv`` table: set elements and the handles of managed rules.
+
+    Managed rules are the ones added through ``ensure_rule``; they carry their signature in the
+    rule comment, which turns deletes into a dictionary lookup instead of a chain listing. Set
+    elements are kept as canonical strings (``a . b . port``) so membership checks and purges do
+    not need a kernel dump. Every helper updates the mirror when it queues the corresponding nft
+    command; ``load`` rebuilds it from a single JSON listing of the table.
+
+    The text of managed rules and the spec of sets are remembered as the helpers create them
+    (and kept across ``load`` for what is still in the kernel), so a deleted rule or set can be
+    created again when a write is undone.
+    """
+
+    def __init__(self):
+        self.sets: dict[str, set[str]] = {}
+        self.indexes: dict[str, AddressIndex] = {}
+        self.rules: dict[str, dict[str, int | None]] = {}
+        self.rule_sets: dict[str, frozenset[str]] = {}
+        self.rules_by_set: dict[str, set[tuple[str, str]]] = {}
+        self.pending: dict[str, tuple[Any, int, int]] = {}
+        self.rule_texts: dict[str, str] = {}
+        self.set_specs: dict[str, str] = {}
+        self.loaded = False
+        self.stale = False
+        self.stats: dict[str, float] = {"loads": 0, "checks": 0, "drift_elements": 0, "drift_rules": 0, "last_check": 0.0}
+
+    def reset(self) -> None:
+        self.sets.clear()
+        self.indexes.clear()
+        self.rules.clear()
+        self.rule_sets.clear()
+        self.rules_by_set.clear()
+        self.pending.clear()
+        self.rule_texts.clear()
+        self.set_specs.clear()
+        self.loaded = True
+        self.stale = False
+
+    def invalidate(self) -> None:
+        self.stale = True
+
+    def _ensure_fresh(self) -> None:
+        if self.stale or not self.loaded:
+            self.load()
+
+    # ----- loading / checking -------------------------------------------------------------
+
+    def _read_kernel(self) -> "DcvMirror":
+        snapshot = DcvMirror()
+        snapshot.reset()
+        try:
+            data = nft_json("list table inet dcv")
+        except Exception as exc:
+            logging.debug("nftables table query failed: %s", exc)
+            return snapshot
+        for item in data.get("nftables", []):
+            if not isinstance(item, dict):
+                continue
+            set_data = item.get("set")
+            if isinstance(set_data, dict):
+                snapshot.sets[set_data["name"]] = {json_element_text(e) for e in set_data.get("elem", []) or []}
+            chain_data = item.get("chain")
+            if isinstance(chain_data, dict):
+                snapshot.rules.setdefault(chain_data["name"], {})
+            rule = item.get("rule")
+            if isinstance(rule, dict) and str(rule.get("comment", "")).startswith("dcv:"):
+                snapshot._track_rule(rule["chain"], rule["comment"], frozenset(_json_referenced_sets(rule.get("expr", []))))
+                snapshot.rules[rule["chain"]][rule["comment"]] = rule.get("handle")
+        return snapshot
+
+    def _adopt(self, other: "DcvMirror") -> None:
+        self.sets = other.sets
+        self.indexes = {}
+        self.rules = other.rules
+        self.rule_sets = other.rule_sets
+        self.rules_by_set = other.rules_by_set
+        self.pending = {}
+        self.rule_texts = {signature: text for signature, text in self.rule_texts.items() if signature in other.rule_sets}
+        self.set_specs = {name: spec for name, spec in self.set_specs.items() if name in other.sets}
+        self.loaded = True
+        self.stale = False
+
+    def load(self) -> None:
+        """Replace the mirror with the live kernel table (one JSON dump)."""
+        self._adopt(self._read_kernel())
+        self.stats["loads"] += 1
+        logging.debug("nftables mirror loaded: %d sets, %d managed rules", len(self.sets), len(self.rule_sets))
+
+    def verify(self) -> tuple[int, int]:
+        """Compare the mirror with the kernel, log any drift and resynchronise from the kernel."""
+        kernel = self._read_kernel()
+        drift_elements = sum(
+            len(self.sets.get(name, set()) ^ kernel.sets.get(name, set()))
+            for name in set(self.sets) | set(kernel.sets)
+        )
+        drift_rules = len(set(self.rule_sets) ^ set(kernel.rule_sets))
+        self.stats["checks"] += 1
+        self.stats["drift_elements"] += drift_elements
+        self.stats["drift_rules"] += drift_rules
+        self.stats["last_check"] = time.time()
+        if drift_elements or drift_rules:
+            logging.warning(f"nftables mirror drifted from the kernel ({drift_elements} elements, {drift_rules} rules); resyncing")
+        self._adopt(kernel)
+        return drift_elements, drift_rules
+
+    # ----- bookkeeping --------------------------------------------------------------------
+
+    def _track_rule(self, chain: str, signature: str, sets: frozenset[str]) -> None:
+        self.rules.setdefault(chain, {})
+        self.rule_sets[signature] = sets
+        for name in sets:
+            self.rules_by_set.setdefault(name, set()).add((chain, signature))
+
+    def _untrack_rule(self, chain: str, signature: str) -> None:
+        self.rules.get(chain, {}).pop(signature, None)
+        self.pending.pop(signature, None)
+        self.rule_texts.pop(signature, None)
+        for name in self.rule_sets.pop(signature, frozenset()):
+            users = self.rules_by_set.get(name)
+            if users is not None:
+                users.discard((chain, signature))
+                if not users:
+                    del self.rules_by_set[name]
+
+    def elements(self, set_name: str) -> set[str]:
+        self._ensure_fresh()
+        return self.sets.get(set_name, set())
+
+    def index(self, set_name: str) -> AddressIndex:
+        """Address index of a set, built on first use and kept in step by the element helpers."""
+        self._ensure_fresh()
+        index = self.indexes.get(set_name)
+        if index is None:
+            index = self.indexes[set_name] = AddressIndex(self.sets.get(set_name, ()))
+        return index
+
+    def _index_add(self, set_name: str, elements: Iterable[str]) -> None:
+        index = self.indexes.get(set_name)
+        if index is not None:
+            for element in elements:
+                index.add(element)
+
+    def _index_discard(self, set_name: str, elements: Iterable[str]) -> None:
+        index = self.indexes.get(set_name)
+        if index is not None:
+            for element in elements:
+                index.discard(element)
+
+    def has_rule(self, chain: str, rule: str) -> bool:
+        self._ensure_fresh()
+        return rule_signature(chain, rule) in self.rules.get(chain, {})
+
+
+dcv_mirror = DcvMirror()
+commands.batch_rejected_hooks.append(dcv_mirror.invalidate)
+commands.submit_hooks.append(intent_log.persist)
+commands.batch_applied_hooks.append(undo_journal.applied)
+
+
+def _journaling() -> bool:
+    """Whether inverses should be recorded: a write is in progress and commands are not just captured."""
+    batch = current_batch()
+    return undo_journal.active and (batch is None or not batch.capture)
+
+
+def _journal_set(set_name: str, undo) -> None:
+    undo_journal.record(undo)
+    intent_log.touch("set", set_name)
+
+
+# Removing elements from these sets allows more traffic, never less.
+_UNBLOCKING_SETS = frozenset({"blocked_pairs"})
+_RULE_ADDRESS = re.compile(r"\bip (saddr|daddr) (\S+)")
+
+
+def revoke_element_connections(set_name: str, elements: Iterable[str]) -> None:
+    """Report the connections allowed by removed elements to the conntrack revoker."""
+    if not conntrack_revoker.enabled or set_name in _UNBLOCKING_SETS:
+        return
+    for element in elements:
+        bounds = [bound for bound in map(_address_range, element.split(" . ")) if bound is not None]
+        if len(bounds) >= 2:
+            conntrack_revoker.revoke([bounds[0]], [bounds[1]])
+        elif bounds:
+            # A member set: any connection from or to the address may have relied on it.
+            conntrack_revoker.revoke([bounds[0]], None)
+            conntrack_revoker.revoke(None, [bounds[0]])
+
+
+def _revoke_rule(rule: str | None) -> None:
+    """Report the connections allowed by a removed accept rule to the conntrack revoker."""
+    if not conntrack_revoker.enabled:
+        return
+    sides: dict[str, list[tuple[int, int]] | None] = {"saddr": None, "daddr": None}
+    for side, value in _RULE_ADDRESS.findall(rule or ""):
+        if value.startswith("@"):
+            sides[side] = [bound for element in dcv_mirror.elements(value[1:]) if (bound := _address_range(element))]
+        elif (bound := _address_range(value)) is not None:
+            sides[side] = [bound]
+        else:
+            # A concatenation or something else this does not decode: revoke broadly.
+            sides = {"saddr": None, "daddr": None}
+            break
+    conntrack_revoker.revoke(sides["saddr"], sides["daddr"])
+
+
+def _restore_table(table_text: str) -> None:
+    restore_table(table_text, "inet", "dcv")
+    submit_early("table restore")
+    dcv_mirror.load()
+
+
+def snapshot_table() -> None:
+    """Keep the whole table text for the current write, for changes that have no cheap inverse."""
+    if _journaling():
+        intent_log.touch("table")
+        undo_journal.snapshot("nftables", lambda: backup_table("inet", "dcv", "add table inet dcv\n"), _restore_table)
+
+
+def add_set(set_name: str, spec: str) -> None:
+    if set_name not in dcv_mirror.sets and _journaling():
+        _journal_set(set_name, lambda: delete_set(set_name))
+    nft_try(f"add set inet dcv {set_name} {{ {spec} }}")
+    dcv_mirror.sets.setdefault(set_name, set())
+    dcv_mirror.set_specs[set_name] = spec
+
+
+def flush_set(set_name: str) -> None:
+    dcv_mirror._ensure_fresh()
+    if set_name not in dcv_mirror.sets:
+        return
+    if _journaling():
+        elements = list(dcv_mirror.elements(set_name))
+        if elements:
+            _journal_set(set_name, lambda: add_elements(set_name, elements))
+    revoke_element_connections(set_name, dcv_mirror.elements(set_name))
+    nft_try(f"flush set inet dcv {set_name}")
+    dcv_mirror.sets[set_name] = set()
+    dcv_mirror.indexes.pop(set_name, None)
+
+
+def delete_set(set_name: str) -> None:
+    dcv_mirror._ensure_fresh()
+    if set_name not in dcv_mirror.sets:
+        return
+    if _journaling():
+        spec = dcv_mirror.set_specs.get(set_name)
+        if spec is None:
+            snapshot_table()
+        else:
+            elements = list(dcv_mirror.elements(set_name))
+            _journal_set(set_name, lambda: (add_set(set_name, spec), add_elements(set_name, elements)))
+    revoke_element_connections(set_name, dcv_mirror.elements(set_name))
+    nft_try(f"delete set inet dcv {set_name}")
+    dcv_mirror.sets.pop(set_name, None)
+    dcv_mirror.indexes.pop(set_name, None)
+    dcv_mirror.set_specs.pop(set_name, None)
+
+
+def add_elements(set_name: str, elements: Iterable[str]) -> None:
+    current = dcv_mirror.elements(set_name)
+    new = [e for e in dict.fromkeys(canonical_element(e) for e in elements) if e not in current]
+    if not new:
+        return
+    if _journaling():
+        _journal_set(set_name, lambda: delete_elements(set_name, new))
+    nft_try(f"add element inet dcv {set_name} {{ {', '.join(new)} }}")
+    dcv_mirror.sets.setdefault(set_name, set()).update(new)
+    dcv_mirror._index_add(set_name, new)
+
+
+def delete_elements(set_name: str, elements: Iterable[str]) -> None:
+    current = dcv_mirror.elements(set_name)
+    present = [e for e in dict.fromkeys(canonical_element(e) for e in elements) if e in current]
+    if not present:
+        return
+    if _journaling():
+        _journal_set(set_name, lambda: add_elements(set_name, present))
+    revoke_element_connections(set_name, present)
+    nft_try(f"delete element inet dcv {set_name} {{ {', '.join(present)} }}")
+    current.difference_update(present)
+    dcv_mirror._index_discard(set_name, present)
+
+
+def ensure_rule(chain: str, rule: str) -> None:
+    """Add ``rule`` to ``chain`` unless the same managed rule is already there."""
+    dcv_mirror._ensure_fresh()
+    signature = rule_signature(chain, rule)
+    if signature in dcv_mirror.rules.get(chain, {}):
+        return
+    if _journaling():
+        undo_journal.record(lambda: _undo_add_rule(chain, signature))
+    dcv_mirror._track_rule(chain, signature, _referenced_sets(rule))
+    dcv_mirror.rules[chain][signature] = None
+    dcv_mirror.rule_texts[signature] = rule
+
+    def remember_handle(handle: int) -> None:
+        if signature in dcv_mirror.rules.get(chain, {}):
+            dcv_mirror.rules[chain][signature] = handle
+        dcv_mirror.pending.pop(signature, None)
+
+    nft_try(f'add rule inet dcv {chain} {canonical_rule(rule)} comment "{signature}"', on_handle=remember_handle)
+    batch = current_batch()
+    if batch is not None and dcv_mirror.rules[chain][signature] is None:
+        dcv_mirror.pending[signature] = (batch, batch.generation, len(batch.commands) - 1)
+
+
+def _undo_add_rule(chain: str, signature: str) -> None:
+    if signature not in dcv_mirror.rules.get(chain, {}):
+        return
+    batch = current_batch()
+    if batch is not None and batch.capture:
+        # Undoing a write that never reached the kernel: only the mirror has the rule.
+        dcv_mirror._untrack_rule(chain, signature)
+    else:
+        _delete_managed_rule(chain, signature)
+
+
+def _undo_delete_rule(chain: str, rule: str, handle: int | None) -> None:
+    batch = current_batch()
+    if batch is not None and batch.capture:
+        # The delete never reached the kernel: the rule is still there, under its old handle.
+        signature = rule_signature(chain, rule)
+        dcv_mirror._track_rule(chain, signature, _referenced_sets(rule))
+        dcv_mirror.rules[chain][signature] = handle
+        dcv_mirror.rule_texts[signature] = rule
+    else:
+        # Managed rules deleted at runtime are accepts, so appending them again keeps the verdict.
+        ensure_rule(chain, rule)
+
+
+def _kernel_rule_handle(chain: str, signature: str) -> int | None:
+    try:
+        data = nft_json(f"list chain inet dcv {chain}")
+    except Exception as exc:
+        logging.debug("nftables chain query failed: %s", exc)
+        return None
+    for item in data.get("nftables", []):
+        rule = item.get("rule") if isinstance(item, dict) else None
+        if isinstance(rule, dict) and rule.get("comment") == signature:
+            return rule.get("handle")
+    return None
+
+
+def _delete_managed_rule(chain: str, signature: str) -> None:
+    handle = dcv_mirror.rules.get(chain, {}).get(signature)
+    _revoke_rule(dcv_mirror.rule_texts.get(signature))
+    if _journaling():
+        rule = dcv_mirror.rule_texts.get(signature)
+        if rule is None:
+            snapshot_table()
+        else:
+            undo_journal.record(lambda: _undo_delete_rule(chain, rule, handle))
+    pending = dcv_mirror.pending.get(signature)
+    batch = current_batch()
+    if handle is None and pending is not None and pending[0] is batch and pending[1] == batch.generation:
+        # Added earlier in the same, not yet submitted transaction: just drop the add.
+        batch.cancel(pending[2])
+    elif handle is None:
+        # The handle of this rule was never echoed back; look it up in the kernel's chain.
+        handle = _kernel_rule_handle(chain, signature)
+        if handle is not None:
+            nft_try(f"delete rule inet dcv {chain} handle {handle}")
+    else:
+        nft_try(f"delete rule inet dcv {chain} handle {handle}")
+    dcv_mirror._untrack_rule(chain, signature)
+
+
+def delete_rule(chain: str, rule: str) -> None:
+    dcv_mirror._ensure_fresh()
+    signature = rule_signature(chain, rule)
+    if signature in dcv_mirror.rules.get(chain, {}):
+        _delete_managed_rule(chain, signature)
+
+
+def delete_rules_using_set(set_name: str) -> None:
+    """Delete every managed rule that references ``@set_name``."""
+    dcv_mirror._ensure_fresh()
+    for chain, signature in sorted(dcv_mirror.rules_by_set.get(set_name, set())):
+        _delete_managed_rule(chain, signature)
+
+
+def flush_chain(chain: str) -> None:
+    # Rule order matters in the static chains, which appending rules back would not keep.
+    snapshot_table()
+    nft_try(f"flush chain inet dcv {chain}")
+    for signature in list(dcv_mirror.rules.get(chain, {})):
+        dcv_mirror._untrack_rule(chain, signature)
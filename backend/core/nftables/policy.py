@@ -0,0 +1,420 @@
+import ipaddress
+from bisect import bisect_right
+from typing import Iterable, Iterator
+
+from backend.core.journal import undo_journal
+from backend.core.nftables.conntrack import conntrack_revoker
+from backend.core.nftables.mirror import add_elements, delete_elements, delete_rule, ensure_rule
+
+POLICY_MODES = ("rules", "compiled")
+
+PAIRS_SET = "s2s_pairs"
+SERVICES_SET = "svc_subnet"
+
+# Conntrack mark bit stamped on connections accepted by a dcv policy rule (fast path mode).
+CT_MARK_ACCEPTED = 0x00100000
+
+
+class CtMarkFastPath:
+    """Accept established traffic by conntrack mark instead of re-matching every policy.
+
+    When enabled, every rule that accepts a NEW connection also ORs ``CT_MARK_ACCEPTED`` into the
+    connection's mark, and one rule at the top of ``forward`` accepts established/related packets
+    carrying that bit. The ``fwd_est`` twins of the NEW rules are then not installed at all.
+
+    Since established packets are no longer checked against the grants, revoking a link, service
+    or membership has to end the connections it allowed: the set and rule helpers report what
+    they remove to ``conntrack_revoker``, which deletes the matching marked conntrack entries once
+    the change is in the kernel. ``blocked_pairs`` is still matched before the mark.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def configure(self, enabled: bool) -> None:
+        self.enabled = enabled
+        conntrack_revoker.configure(enabled, CT_MARK_ACCEPTED)
+
+    @property
+    def verdict(self) -> str:
+        if self.enabled:
+            return f"ct mark set ct mark or {CT_MARK_ACCEPTED:#010x} accept"
+        return "accept"
+
+    @property
+    def forward_rule(self) -> str:
+        return f"ct state established,related ct mark and {CT_MARK_ACCEPTED:#010x} == {CT_MARK_ACCEPTED:#010x} accept"
+
+
+ct_fastpath = CtMarkFastPath()
+
+
+def ensure_allow_rules(new_match: str, established_match: str) -> None:
+    """Install a NEW-accept rule in ``wg_allow`` and, unless the mark fast path is on, its ``fwd_est`` twin."""
+    ensure_rule("wg_allow", f"{new_match} {ct_fastpath.verdict}")
+    if not ct_fastpath.enabled:
+        ensure_rule("fwd_est", f"{established_match} accept")
+
+
+def delete_allow_rules(new_match: str, established_match: str) -> None:
+    delete_rule("wg_allow", f"{new_match} {ct_fastpath.verdict}")
+    if not ct_fastpath.enabled:
+        delete_rule("fwd_est", f"{established_match} accept")
+
+
+Range = tuple[int, int]
+# ("pair", daddr) or ("svc", proto, daddr, dport): what a set of source roles is allowed to reach.
+Target = tuple
+
+
+def range_text(low: int, high: int) -> str:
+    """An address interval written the way nft lists it: an address, an aligned prefix or ``a-b``."""
+    first = ipaddress.IPv4Address(low)
+    if low == high:
+        return str(first)
+    size = high - low + 1
+    if size & (size - 1) == 0 and low % size == 0:
+        return f"{first}/{33 - size.bit_length()}"
+    return f"{first}-{ipaddress.IPv4Address(high)}"
+
+
+class AddressRanges:
+    """Addresses as sorted, disjoint, non-adjacent inclusive [start, end] integer intervals.
+
+    ``add`` and ``discard`` return the intervals they replaced and the ones they created, so the
+    set elements built from the intervals can be updated without listing them all again.
+    """
+
+    def __init__(self, ranges: Iterable[Range] = ()):
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        for start, end in ranges:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __contains__(self, address: int) -> bool:
+        index = bisect_right(self.starts, address) - 1
+        return index >= 0 and self.ends[index] >= address
+
+    def __iter__(self) -> Iterator[Range]:
+        return zip(self.starts, self.ends)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def addresses(self) -> Iterator[int]:
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    def add(self, address: int) -> tuple[list[Range], list[Range]]:
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and self.ends[index] >= address:
+            return [], []
+        joins_left = index >= 0 and self.ends[index] == address - 1
+        joins_right = index + 1 < len(self.starts) and self.starts[index + 1] == address + 1
+        if joins_left and joins_right:
+            removed = [(self.starts[index], self.ends[index]), (self.starts[index + 1], self.ends[index + 1])]
+            self.ends[index] = self.ends[index + 1]
+            del self.starts[index + 1], self.ends[index + 1]
+            return removed, [(self.starts[index], self.ends[index])]
+        if joins_left:
+            removed = [(self.starts[index], self.ends[index])]
+            self.ends[index] = address
+            return removed, [(self.starts[index], address)]
+        if joins_right:
+            removed = [(self.starts[index + 1], self.ends[index + 1])]
+            self.starts[index + 1] = address
+            return removed, [(address, self.ends[index + 1])]
+        self.starts.insert(index + 1, address)
+        self.ends.insert(index + 1, address)
+        return [], [(address, address)]
+
+    def discard(self, address: int) -> tuple[list[Range], list[Range]]:
+        index = bisect_right(self.starts, address) - 1
+        if index < 0 or self.ends[index] < address:
+            return [], []
+        start, end = self.starts[index], self.ends[index]
+        if start == end:
+            del self.starts[index], self.ends[index]
+            return [(start, end)], []
+        if address == start:
+            self.starts[index] = address + 1
+            return [(start, end)], [(address + 1, end)]
+        if address == end:
+            self.ends[index] = address - 1
+            return [(start, end)], [(start, address - 1)]
+        self.ends[index] = address - 1
+        self.starts.insert(index + 1, address + 1)
+        self.ends.insert(index + 1, end)
+        return [(start, end)], [(start, address - 1), (address + 1, end)]
+
+
+def _union(range_sets: Iterable[Iterable[Range]]) -> list[Range]:
+    merged: list[Range] = []
+    for start, end in sorted(interval for ranges in range_sets for interval in ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class SubnetPolicy:
+    """Subnet-level grants kept as set elements, one kernel lookup per packet.
+
+    The index knows the addresses in every per-subnet set (members, public), called roles here,
+    and the grants made from those roles, and keeps two concatenated sets in step with both:
+
+    * ``SERVICES_SET`` (``l4proto . saddr . daddr . dport``) always holds the subnet service
+      grants, so ``grant_subnet_service`` adds elements instead of a rule per subnet, service
+      and protocol. A grant is written with its source intervals, ``tcp . 10.1.0.0/24 . host
+      . port``, so it costs one element per run of consecutive member addresses.
+    * ``PAIRS_SET`` (``saddr . daddr``) holds role-to-role links (a subnet's members to its own
+      public peers, public subnet links, admin subnet links) in ``compiled`` mode. In ``rules``
+      mode those links stay one ``wg_allow`` rule (plus its ``fwd_est`` twin) each.
+
+    A peer can be in several roles at once, so addresses cannot be mapped to a single role id.
+    Instead every target (a destination address of a link, a service) records the roles allowed
+    to reach it, and the sources are written as the union of those roles' addresses, collapsed
+    into intervals: a members → public link costs one element per public peer and per run of
+    consecutive member addresses, not one per pair. The intervals of a target never overlap,
+    which concatenated interval sets require.
+
+    Each change records its own inverse in the undo journal; the elements it adds and removes
+    are journaled by the set helpers. Only ``reset`` snapshots the whole index.
+    """
+
+    def __init__(self):
+        self.compiled = False
+        self.roles: dict[str, AddressRanges] = {}
+        self.links: set[tuple[str, str]] = set()
+        self.links_from: dict[str, set[str]] = {}
+        self.links_to: dict[str, set[str]] = {}
+        self.services: set[tuple[str, str, str, int]] = set()
+        # target -> source role -> number of grants through which the role reaches the target
+        self.sources: dict[Target, dict[str, int]] = {}
+        # role -> targets it is a source of
+        self.targets: dict[str, set[Target]] = {}
+        # target -> union of its source roles
+        self.coverage: dict[Target, AddressRanges] = {}
+
+    def configure(self, mode: str) -> None:
+        if mode not in POLICY_MODES:
+            raise ValueError(f"Unknown nftables policy mode {mode!r}, expected one of {', '.join(POLICY_MODES)}")
+        self.compiled = mode == "compiled"
+
+    @property
+    def element_count(self) -> int:
+        return sum(len(ranges) for ranges in self.coverage.values())
+
+    def reset(self) -> None:
+        undo_journal.snapshot("subnet_policy", self.snapshot, self.restore)
+        self.roles.clear()
+        self.links.clear()
+        self.services.clear()
+        self._rebuild()
+
+    def snapshot(self) -> tuple:
+        return (
+            frozenset(self.links),
+            frozenset(self.services),
+            {role: tuple(ranges) for role, ranges in self.roles.items()},
+        )
+
+    def restore(self, snapshot: tuple) -> None:
+        """Go back to a snapshot; targets and their coverage are derived data and are rebuilt from it."""
+        links, services, roles = snapshot
+        self.links = set(links)
+        self.services = set(services)
+        self.roles = {role: AddressRanges(ranges) for role, ranges in roles.items()}
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        self.links_from, self.links_to = {}, {}
+        self.sources, self.targets, self.coverage = {}, {}, {}
+        for src, dst in self.links:
+            self.links_from.setdefault(src, set()).add(dst)
+            self.links_to.setdefault(dst, set()).add(src)
+            for address in self._addresses(dst):
+                self._count_source(("pair", address), src)
+        for src, proto, host, port in self.services:
+            self._count_source(("svc", proto, host, port), src)
+        for target, sources in self.sources.items():
+            self.coverage[target] = AddressRanges(_union(self.roles.get(role, ()) for role in sources))
+
+    def _addresses(self, role: str) -> Iterator[int]:
+        ranges = self.roles.get(role)
+        return ranges.addresses() if ranges is not None else iter(())
+
+    # ----- targets ------------------------------------------------------------------------
+
+    @staticmethod
+    def _element(target: Target, start: int, end: int) -> tuple[str, str]:
+        if target[0] == "pair":
+            return PAIRS_SET, f"{range_text(start, end)} . {ipaddress.IPv4Address(target[1])}"
+        _, proto, host, port = target
+        return SERVICES_SET, f"{proto} . {range_text(start, end)} . {host} . {port}"
+
+    def _update(self, changes: Iterable[tuple[Target, list[Range], list[Range]]]) -> None:
+        """Apply coverage changes to the sets: every delete first, so no add overlaps what it replaces."""
+        gone: dict[str, dict[str, None]] = {}
+        new: dict[str, dict[str, None]] = {}
+
+        def move(set_name: str, element: str, into: dict, cancel: dict) -> None:
+            if element in cancel.get(set_name, {}):
+                del cancel[set_name][element]
+            else:
+                into.setdefault(set_name, {})[element] = None
+
+        for target, removed, added in changes:
+            for start, end in removed:
+                move(*self._element(target, start, end), gone, new)
+            for start, end in added:
+                move(*self._element(target, start, end), new, gone)
+        for set_name, elements in gone.items():
+            delete_elements(set_name, elements)
+        for set_name, elements in new.items():
+            add_elements(set_name, elements)
+
+    def _count_source(self, target: Target, role: str) -> bool:
+        """Count one more grant from ``role`` to ``target``; True if ``role`` was not a source yet."""
+        sources = self.sources.setdefault(target, {})
+        count = sources.get(role, 0)
+        sources[role] = count + 1
+        if count:
+            return False
+        self.targets.setdefault(role, set()).add(target)
+        return True
+
+    def _recover(self, target: Target) -> tuple[Target, list[Range], list[Range]]:
+        """Recompute the coverage of ``target`` from its sources."""
+        before = set(self.coverage.get(target, ()))
+        after = _union(self.roles.get(role, ()) for role in self.sources.get(target, {}))
+        if self.sources.get(target):
+            self.coverage[target] = AddressRanges(after)
+        else:
+            self.coverage.pop(target, None)
+            self.sources.pop(target, None)
+        return target, list(before.difference(after)), [interval for interval in after if interval not in before]
+
+    def _add_source(self, target: Target, role: str) -> list[tuple[Target, list[Range], list[Range]]]:
+        return [self._recover(target)] if self._count_source(target, role) else []
+
+    def _remove_source(self, target: Target, role: str) -> list[tuple[Target, list[Range], list[Range]]]:
+        sources = self.sources.get(target, {})
+        count = sources.get(role, 0)
+        if count > 1:
+            sources[role] = count - 1
+            return []
+        if not count:
+            return []
+        del sources[role]
+        targets = self.targets[role]
+        targets.discard(target)
+        if not targets:
+            del self.targets[role]
+        return [self._recover(target)]
+
+    # ----- grants -------------------------------------------------------------------------
+
+    def link(self, src: str, dst: str) -> None:
+        """Allow NEW traffic from every address in role ``src`` to every address in role ``dst``."""
+        if (src, dst) in self.links:
+            return
+        undo_journal.record(lambda: self.unlink(src, dst))
+        self.links.add((src, dst))
+        self.links_from.setdefault(src, set()).add(dst)
+        self.links_to.setdefault(dst, set()).add(src)
+        changes = []
+        for address in self._addresses(dst):
+            changes += self._add_source(("pair", address), src)
+        self._update(changes)
+
+    def unlink(self, src: str, dst: str) -> None:
+        if (src, dst) not in self.links:
+            return
+        undo_journal.record(lambda: self.link(src, dst))
+        self.links.discard((src, dst))
+        for index, role, other in ((self.links_from, src, dst), (self.links_to, dst, src)):
+            index[role].discard(other)
+            if not index[role]:
+                del index[role]
+        changes = []
+        for address in self._addresses(dst):
+            changes += self._remove_source(("pair", address), src)
+        self._update(changes)
+
+    def grant_service(self, src: str, protos: Iterable[str], host: str, port: int) -> None:
+        """Allow NEW traffic from every address in role ``src`` to ``host:port`` over ``protos``."""
+        changes = []
+        for proto in protos:
+            if (src, proto, host, port) in self.services:
+                continue
+            undo_journal.record(lambda proto=proto: self.revoke_service(src, [proto], host, port))
+            self.services.add((src, proto, host, port))
+            changes += self._add_source(("svc", proto, host, port), src)
+        self._update(changes)
+
+    def revoke_service(self, src: str, protos: Iterable[str], host: str, port: int) -> None:
+        changes = []
+        for proto in protos:
+            if (src, proto, host, port) not in self.services:
+                continue
+            undo_journal.record(lambda proto=proto: self.grant_service(src, [proto], host, port))
+            self.services.discard((src, proto, host, port))
+            changes += self._remove_source(("svc", proto, host, port), src)
+        self._update(changes)
+
+    # ----- addresses ----------------------------------------------------------------------
+
+    def add_address(self, role: str, address: str) -> None:
+        value = int(ipaddress.IPv4Address(address))
+        ranges = self.roles.setdefault(role, AddressRanges())
+        if value in ranges:
+            return
+        undo_journal.record(lambda: self.remove_address(role, address))
+        ranges.add(value)
+        changes = []
+        # As a source: the address joins the coverage of every target the role reaches.
+        for target in self.targets.get(role, ()):
+            removed, added = self.coverage[target].add(value)
+            if removed or added:
+                changes.append((target, removed, added))
+        # As a destination: the address becomes a target of every role linked to this one.
+        for src in self.links_to.get(role, ()):
+            changes += self._add_source(("pair", value), src)
+        self._update(changes)
+
+    def remove_address(self, role: str, address: str) -> None:
+        value = int(ipaddress.IPv4Address(address))
+        ranges = self.roles.get(role)
+        if ranges is None or value not in ranges:
+            return
+        undo_journal.record(lambda: self.add_address(role, address))
+        changes = []
+        for src in self.links_to.get(role, ()):
+            changes += self._remove_source(("pair", value), src)
+        ranges.discard(value)
+        for target in self.targets.get(role, ()):
+            # Another source role of the target may still hold the address.
+            if not any(value in self.roles.get(source, ()) for source in self.sources[target]):
+                removed, added = self.coverage[target].discard(value)
+                changes.append((target, removed, added))
+        self._update(changes)
+
+    def drop_role(self, role: str) -> None:
+        """Forget a role entirely (the subnet was destroyed), removing every grant that uses it."""
+        for dst in sorted(self.links_from.get(role, ())):
+            self.unlink(role, dst)
+        for src in sorted(self.links_to.get(role, ())):
+            self.unlink(src, role)
+        for src, proto, host, port in sorted(self.services):
+            if src == role:
+                self.revoke_service(src, [proto], host, port)
+        for value in list(self._addresses(role)):
+            self.remove_address(role, str(ipaddress.IPv4Address(value)))
+        self.roles.pop(role, None)
+
+
+subnet_policy = SubnetPolicy()
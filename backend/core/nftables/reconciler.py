@@ -0,0 +1,212 @@
+import re
+import time
+from typing import Callable, Iterable
+
+from backend.core.logger import logger as logging
+from backend.core.nftables.commands import current_batch, nft_batch, nft_json, nft_try
+from backend.core.nftables.conntrack import conntrack_revoker
+from backend.core.nftables.compiler import DcvRuleset, compile_and_load, compile_ruleset, compile_stats, replay
+from backend.core.nftables.mirror import dcv_mirror, json_element_text, revoke_element_connections, snapshot_table
+
+_COMMENT = re.compile(r'\s+comment "(dcv:[0-9a-f]+)"$')
+
+# Filled by reconcile_dcv_table; exposed under /network/metrics.
+reconcile_stats: dict[str, float] = {
+    "runs": 0,
+    "last_run": 0.0,
+    "last_seconds": 0.0,
+    "last_drift": 0,
+    "full_loads": 0,
+    "elements_added": 0,
+    "elements_removed": 0,
+    "rules_added": 0,
+    "rules_removed": 0,
+    "chains_rewritten": 0,
+    "sets_added": 0,
+    "sets_removed": 0,
+}
+
+
+class LiveTable:
+    """The parts of the kernel's ``inet dcv`` table the reconciler compares, from one JSON listing."""
+
+    def __init__(self, data: dict):
+        self.exists = False
+        self.elements: dict[str, set[str]] = {}
+        self.chains: set[str] = set()
+        # chain -> [(signature or None, handle)] in rule order
+        self.rules: dict[str, list[tuple[str | None, int]]] = {}
+        for item in data.get("nftables", []):
+            if not isinstance(item, dict):
+                continue
+            if isinstance(item.get("table"), dict):
+                self.exists = True
+            set_data = item.get("set")
+            if isinstance(set_data, dict):
+                self.elements[set_data["name"]] = {json_element_text(e) for e in set_data.get("elem", []) or []}
+            chain_data = item.get("chain")
+            if isinstance(chain_data, dict):
+                self.chains.add(chain_data["name"])
+                self.rules.setdefault(chain_data["name"], [])
+            rule = item.get("rule")
+            if isinstance(rule, dict):
+                comment = str(rule.get("comment", ""))
+                signature = comment if comment.startswith("dcv:") else None
+                self.rules.setdefault(rule["chain"], []).append((signature, rule.get("handle")))
+
+
+def _signature(rule: str) -> str | None:
+    match = _COMMENT.search(rule)
+    return match.group(1) if match else None
+
+
+def _accept_only(rules: list[str]) -> bool:
+    """Whether rule order is irrelevant in a chain: every rule ends in an accept verdict."""
+    return all(_COMMENT.sub("", rule).rstrip().endswith("accept") for rule in rules)
+
+
+def _read_live() -> LiveTable:
+    try:
+        return LiveTable(nft_json("list table inet dcv"))
+    except Exception as exc:
+        logging.debug("nftables table query failed: %s", exc)
+        return LiveTable({})
+
+
+def reconcile_dcv_table(build: Callable[[], None], sets: Iterable[str] | None = None) -> int:
+    """Bring the live ``inet dcv`` table to what ``build`` would produce, touching only the delta.
+
+    The desired table is compiled from ``build`` (see compiler.py) and compared with one JSON
+    listing of the kernel table: set elements by value, rules by their signature comment. Missing
+    and extra elements and rules are applied in one batch. Chains whose rules are all accepts are
+    patched in place; chains where order matters (drops, jumps) are rewritten as a whole inside
+    the same transaction if their rule sequence differs. Rules without a signature (manual edits)
+    count as extra. When there is no table at all, the compiled table is loaded instead.
+
+    With ``sets`` (startup recovery, see backend/core/intents.py) only the elements of those sets
+    are compared; sets, chains and rules are always compared, and any drift there means the table
+    was not left by this configuration, so every set is compared after all.
+
+    Returns the number of changes (elements, rules, chains and sets) that were applied.
+    """
+    started = time.perf_counter()
+    live = _read_live()
+    if not live.exists:
+        compile_and_load(build)
+        reconcile_stats["full_loads"] += 1
+        drift = reconcile_stats["last_drift"] = compile_stats["rules"] + compile_stats["elements"]
+        _finish(started)
+        return drift
+
+    try:
+        desired = compile_ruleset(build)
+    except ValueError as exc:
+        # Without the desired table there is nothing to compare with: apply all of it.
+        logging.warning(f"Could not compile the nftables ruleset, applying it through the helpers: {exc}")
+        drift = reconcile_stats["last_drift"] = replay(build)
+        reconcile_stats["full_loads"] += 1
+        _finish(started)
+        return drift
+    # The delta is applied as raw commands, which have no recorded inverses.
+    snapshot_table()
+    drift = 0
+    with nft_batch():
+        drift += _add_sets(desired, live)
+        for name in desired.chains.keys() - live.chains:
+            header = desired.chains[name]
+            nft_try(f"add chain inet dcv {name} {{ {header} }}" if header else f"add chain inet dcv {name}")
+            drift += 1
+        drift += _sync_rules(desired, live)
+        for name in live.chains - desired.chains.keys():
+            conntrack_revoker.revoke_all()
+            nft_try(f"flush chain inet dcv {name}")
+            nft_try(f"delete chain inet dcv {name}")
+            drift += 1
+        removed_sets = live.elements.keys() - desired.sets.keys()
+        only = set(sets) if sets is not None and not drift and not removed_sets else None
+        drift += _sync_elements(desired, live, only)
+        for name in removed_sets:
+            revoke_element_connections(name, live.elements[name])
+            nft_try(f"delete set inet dcv {name}")
+            reconcile_stats["sets_removed"] += 1
+            drift += 1
+    if current_batch() is None:
+        # The capture rebuilt the mirror without handles; read them back from the kernel.
+        dcv_mirror.load()
+    reconcile_stats["last_drift"] = drift
+    _finish(started)
+    if drift:
+        logging.warning(f"nftables table differed from the desired policy; applied {drift} changes")
+    return drift
+
+
+def _finish(started: float) -> None:
+    reconcile_stats["runs"] += 1
+    reconcile_stats["last_run"] = time.time()
+    reconcile_stats["last_seconds"] = time.perf_counter() - started
+
+
+def _add_sets(desired: DcvRuleset, live: LiveTable) -> int:
+    changes = 0
+    for name in desired.sets.keys() - live.elements.keys():
+        nft_try(f"add set inet dcv {name} {{ {desired.sets[name]} }}")
+        live.elements[name] = set()
+        reconcile_stats["sets_added"] += 1
+        changes += 1
+    return changes
+
+
+def _sync_elements(desired: DcvRuleset, live: LiveTable, only: set[str] | None = None) -> int:
+    changes = 0
+    for name, elements in desired.elements.items():
+        if only is not None and name not in only:
+            continue
+        wanted = set(elements)
+        current = live.elements.get(name, set())
+        extra = sorted(current - wanted)
+        missing = [element for element in elements if element not in current]
+        if extra:
+            revoke_element_connections(name, extra)
+            nft_try(f"delete element inet dcv {name} {{ {', '.join(extra)} }}")
+            reconcile_stats["elements_removed"] += len(extra)
+        if missing:
+            nft_try(f"add element inet dcv {name} {{ {', '.join(missing)} }}")
+            reconcile_stats["elements_added"] += len(missing)
+        changes += len(extra) + len(missing)
+    return changes
+
+
+def _sync_rules(desired: DcvRuleset, live: LiveTable) -> int:
+    changes = 0
+    for chain, rules in desired.rules.items():
+        current = live.rules.get(chain, [])
+        wanted = [_signature(rule) for rule in rules]
+        if [signature for signature, _ in current] == wanted:
+            continue
+        if not _accept_only(rules):
+            conntrack_revoker.revoke_all()
+            nft_try(f"flush chain inet dcv {chain}")
+            for rule in rules:
+                nft_try(f"add rule inet dcv {chain} {rule}")
+            reconcile_stats["chains_rewritten"] += 1
+            reconcile_stats["rules_removed"] += len(current)
+            reconcile_stats["rules_added"] += len(rules)
+            changes += 1
+            continue
+        present = {signature for signature, _ in current}
+        wanted_set = set(wanted)
+        seen: set[str | None] = set()
+        for signature, handle in current:
+            if signature not in wanted_set or signature in seen:
+                # Live rules are only known by handle here, so their matches are not decoded.
+                conntrack_revoker.revoke_all()
+                nft_try(f"delete rule inet dcv {chain} handle {handle}")
+                reconcile_stats["rules_removed"] += 1
+                changes += 1
+            seen.add(signature)
+        for rule, signature in zip(rules, wanted):
+            if signature not in present:
+                nft_try(f"add rule inet dcv {chain} {rule}")
+                reconcile_stats["rules_added"] += 1
+                changes += 1
+    return changes
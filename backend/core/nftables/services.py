@@ -1,74 +1,80 @@
-from backend.core.logger import logger as logging
-from backend.core.nftables.commands import delete_rule_by_match, element_tuple, list_set_elements, nft_try, slug
+from backend.core.journal import undo_journal
+from backend.core.nftables.commands import slug
+from backend.core.nftables.mirror import add_elements, delete_elements
+from backend.core.nftables.policy import subnet_policy
 
 
 def _protos(proto: str) -> list[str]:
     return ["tcp", "udp"] if proto == "both" else [proto.lower()]
 
 
-def _svc_pair_has_other_ports(src_ip: str, dst_ip: str, proto: str) -> bool:
-    setname = "svc_guest_tcp" if proto.lower() == "tcp" else "svc_guest_udp"
-    try:
-        for element in list_set_elements(setname):
-            triple = element_tuple(element)
-            if len(triple) == 3 and triple[0] == src_ip and triple[1] == dst_ip:
-                return True
-    except Exception as exc:
-        logging.debug("%s query failed: %s", setname, exc)
-    return False
+class ServicePorts:
+    """Ports granted per (src, dst, proto) through ``svc_guest_{proto}``.
+
+    ``svc_pairs_{proto}`` holds one ``src . dst`` element for the established-traffic match, shared
+    by every port granted between the two peers; it may only go once the last port is revoked.
+    Counting the ports here answers that in O(1) instead of scanning the guest set. The index is
+    filled by the grants replayed from the database at startup and follows every grant, revoke
+    and purge afterwards. Every change records its inverse in the undo journal.
+    """
+
+    def __init__(self):
+        self.ports: dict[tuple[str, str, str], set[str]] = {}
+
+    def reset(self) -> None:
+        if undo_journal.active:
+            undo_journal.record(lambda snapshot=self.snapshot(): self.restore(snapshot))
+        self.ports.clear()
+
+    def snapshot(self) -> dict[tuple[str, str, str], frozenset[str]]:
+        return {key: frozenset(ports) for key, ports in self.ports.items()}
+
+    def restore(self, snapshot: dict[tuple[str, str, str], frozenset[str]]) -> None:
+        self.ports = {key: set(ports) for key, ports in snapshot.items()}
+
+    def add(self, src_ip: str, dst_ip: str, proto: str, port: int | str) -> None:
+        ports = self.ports.setdefault((src_ip, dst_ip, proto), set())
+        if str(port) not in ports:
+            ports.add(str(port))
+            undo_journal.record(lambda: self.remove(src_ip, dst_ip, proto, port))
+
+    def remove(self, src_ip: str, dst_ip: str, proto: str, port: int | str) -> bool:
+        """Forget one port; returns True when no port is left between the two peers."""
+        key = (src_ip, dst_ip, proto)
+        ports = self.ports.get(key)
+        if ports is None:
+            return True
+        if str(port) in ports:
+            ports.discard(str(port))
+            undo_journal.record(lambda: self.add(src_ip, dst_ip, proto, port))
+        if ports:
+            return False
+        del self.ports[key]
+        return True
+
+
+service_ports = ServicePorts()
 
 
 def grant_service(src_ip: str, dst_ip: str, port: int, proto: str = "both") -> None:
     for p in _protos(proto):
-        if p == "tcp":
-            nft_try(f"add element inet dcv svc_guest_tcp {{ {src_ip} . {dst_ip} . {port} }}")
-            nft_try(f"add element inet dcv svc_pairs_tcp {{ {src_ip} . {dst_ip} }}")
-        elif p == "udp":
-            nft_try(f"add element inet dcv svc_guest_udp {{ {src_ip} . {dst_ip} . {port} }}")
-            nft_try(f"add element inet dcv svc_pairs_udp {{ {src_ip} . {dst_ip} }}")
+        if p in ("tcp", "udp"):
+            add_elements(f"svc_guest_{p}", [f"{src_ip} . {dst_ip} . {port}"])
+            add_elements(f"svc_pairs_{p}", [f"{src_ip} . {dst_ip}"])
+            service_ports.add(src_ip, dst_ip, p, port)
 
 
 def revoke_service(src_ip: str, dst_ip: str, port: int, proto: str = "both") -> None:
     for p in _protos(proto):
-        if p == "tcp":
-            nft_try(f"delete element inet dcv svc_guest_tcp {{ {src_ip} . {dst_ip} . {port} }}")
-            if not _svc_pair_has_other_ports(src_ip, dst_ip, "tcp"):
-                nft_try(f"delete element inet dcv svc_pairs_tcp {{ {src_ip} . {dst_ip} }}")
-        elif p == "udp":
-            nft_try(f"delete element inet dcv svc_guest_udp {{ {src_ip} . {dst_ip} . {port} }}")
-            if not _svc_pair_has_other_ports(src_ip, dst_ip, "udp"):
-                nft_try(f"delete element inet dcv svc_pairs_udp {{ {src_ip} . {dst_ip} }}")
+        if p in ("tcp", "udp"):
+            delete_elements(f"svc_guest_{p}", [f"{src_ip} . {dst_ip} . {port}"])
+            if service_ports.remove(src_ip, dst_ip, p, port):
+                delete_elements(f"svc_pairs_{p}", [f"{src_ip} . {dst_ip}"])
 
 
 def grant_subnet_service(subnet_id: str, dst_ip: str, port: int, proto: str = "both") -> None:
-    members = f"subnet_{slug(subnet_id)}_members"
-    for p in _protos(proto):
-        delete_rule_by_match(
-            "wg_allow",
-            rf"meta l4proto {p} ip saddr @{members} ip daddr {dst_ip} th dport {port} ct state new accept",
-        )
-        nft_try(
-            f"add rule inet dcv wg_allow meta l4proto {p} "
-            f"ip saddr @{members} ip daddr {dst_ip} th dport {port} ct state new accept"
-        )
-        delete_rule_by_match(
-            "fwd_est",
-            rf"ct original l4proto {p} ct original ip saddr @{members} ct original ip daddr {dst_ip} accept",
-        )
-        nft_try(
-            f"add rule inet dcv fwd_est ct state established,related "
-            f"ct original l4proto {p} ct original ip saddr @{members} ct original ip daddr {dst_ip} accept"
-        )
+    subnet_policy.grant_service(f"subnet_{slug(subnet_id)}_members", _protos(proto), dst_ip, port)
 
 
 def revoke_subnet_service(subnet_id: str, dst_ip: str, port: int, proto: str = "both") -> None:
-    members = f"subnet_{slug(subnet_id)}_members"
-    for p in _protos(proto):
-        delete_rule_by_match(
-            "wg_allow",
-            rf"meta l4proto {p} ip saddr @{members} ip daddr {dst_ip} th dport {port} ct state new accept",
-        )
-        delete_rule_by_match(
-            "fwd_est",
-            rf"ct original l4proto {p} ct original ip saddr @{members} ct original ip daddr {dst_ip} accept",
-        )
+    subnet_policy.revoke_service(f"subnet_{slug(subnet_id)}_members", _protos(proto), dst_ip, port)
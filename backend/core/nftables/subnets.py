@@ -1,15 +1,47 @@
-import ipaddress
-
 from backend.core.nftables.base import flush_conntrack_for_ip, flush_conntrack_for_prefix
-from backend.core.nftables.commands import (
-    delete_rule_by_match,
-    element_tuple,
-    expression_has_set,
-    list_set_elements,
-    nft_try,
-    slug,
-    table_rules,
+from backend.core.nftables.commands import slug
+from backend.core.nftables.mirror import (
+    add_elements,
+    add_set,
+    dcv_mirror,
+    delete_elements,
+    delete_rules_using_set,
+    delete_set,
+    flush_set,
 )
+from backend.core.nftables.policy import delete_allow_rules, ensure_allow_rules, subnet_policy
+from backend.core.nftables.services import service_ports
+
+
+def _set_to_set_matches(src_set: str, dst_set: str) -> tuple[str, str]:
+    return (
+        f"ip saddr @{src_set} ip daddr @{dst_set} ct state new",
+        f"ct state established,related ct original ip saddr @{src_set} ct original ip daddr @{dst_set}",
+    )
+
+
+def _allow_set_to_set(src_set: str, dst_set: str) -> None:
+    if subnet_policy.compiled:
+        subnet_policy.link(src_set, dst_set)
+        return
+    ensure_allow_rules(*_set_to_set_matches(src_set, dst_set))
+
+
+def _disallow_set_to_set(src_set: str, dst_set: str) -> None:
+    if subnet_policy.compiled:
+        subnet_policy.unlink(src_set, dst_set)
+        return
+    delete_allow_rules(*_set_to_set_matches(src_set, dst_set))
+
+
+def _add_address(set_name: str, ip: str) -> None:
+    add_elements(set_name, [ip])
+    subnet_policy.add_address(set_name, ip)
+
+
+def _remove_address(set_name: str, ip: str) -> None:
+    delete_elements(set_name, [ip])
+    subnet_policy.remove_address(set_name, ip)
 
 
 def ensure_subnet(subnet_id: str) -> None:
@@ -17,17 +49,10 @@ def ensure_subnet(subnet_id: str) -> None:
     members = f"subnet_{subnet_slug}_members"
     public = f"subnet_{subnet_slug}_public"
 
-    nft_try(f"add set inet dcv {members} {{ type ipv4_addr; flags interval; }}")
-    nft_try(f"add set inet dcv {public}  {{ type ipv4_addr; flags interval; }}")
+    add_set(members, "type ipv4_addr; flags interval;")
+    add_set(public, "type ipv4_addr; flags interval;")
 
-    delete_rule_by_match("wg_allow", rf"ip saddr @{members} ip daddr @{public} ct state new accept")
-    nft_try(f"add rule inet dcv wg_allow ip saddr @{members} ip daddr @{public} ct state new accept")
-
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{members} ct original ip daddr @{public} accept")
-    nft_try(
-        f"add rule inet dcv fwd_est ct state established,related "
-        f"ct original ip saddr @{members} ct original ip daddr @{public} accept"
-    )
+    _allow_set_to_set(members, public)
 
 
 def destroy_subnet(subnet_id: str, destroy_all_traffic_to_peers_inside: bool = False) -> None:
@@ -35,94 +60,59 @@ def destroy_subnet(subnet_id: str, destroy_all_traffic_to_peers_inside: bool = F
     members = f"subnet_{subnet_slug}_members"
     public = f"subnet_{subnet_slug}_public"
 
-    for set_name in ("p2p_links", "admin_links", "admin_peer2cidr", "svc_pairs_tcp", "svc_pairs_udp"):
-        _purge_pair_set_for_subnet(set_name, subnet_id)
-    for set_name in ("svc_guest_tcp", "svc_guest_udp"):
-        _purge_service_triples_for_subnet(subnet_id, set_name)
-
-    for rule in table_rules():
-        chain = rule.get("chain")
-        handle = rule.get("handle")
-        expr = rule.get("expr", [])
-        if chain and handle is not None and (expression_has_set(expr, members) or expression_has_set(expr, public)):
-            nft_try(f"delete rule inet dcv {chain} handle {handle}")
-
-    delete_rule_by_match("wg_allow", rf"@{members}")
-    delete_rule_by_match("wg_allow", rf"@{public}")
-    delete_rule_by_match("fwd_est", rf"@{members}")
-    delete_rule_by_match("fwd_est", rf"@{public}")
-
-    nft_try(f"flush set inet dcv {members}")
-    nft_try(f"flush set inet dcv {public}")
-    nft_try(f"delete set inet dcv {members}")
-    nft_try(f"delete set inet dcv {public}")
+    for set_name in ("p2p_links", "admin_links", "admin_peer2cidr", "svc_pairs_tcp", "svc_pairs_udp",
+                     "svc_guest_tcp", "svc_guest_udp"):
+        _purge_set_for_subnet(set_name, subnet_id)
+
+    delete_rules_using_set(members)
+    delete_rules_using_set(public)
+    subnet_policy.drop_role(members)
+    subnet_policy.drop_role(public)
+
+    flush_set(members)
+    flush_set(public)
+    delete_set(members)
+    delete_set(public)
     flush_conntrack_for_prefix(subnet_id, allow_large_prefix=destroy_all_traffic_to_peers_inside)
 
 
-def _purge_pair_set_for_subnet(setname: str, cidr: str) -> None:
-    try:
-        net = ipaddress.ip_network(cidr, strict=False)
-    except ValueError:
-        return
-    for element in list_set_elements(setname):
-        pair = element_tuple(element)
-        if len(pair) != 2:
-            continue
-        a, b = pair
-        if ipaddress.ip_address(a) in net or ipaddress.ip_address(b) in net:
-            nft_try(f"delete element inet dcv {setname} {{ {a} . {b} }}")
-
-
-def _purge_service_triples_for_subnet(cidr: str, setname: str) -> None:
-    try:
-        net = ipaddress.ip_network(cidr, strict=False)
-    except ValueError:
-        return
-    for element in list_set_elements(setname):
-        triple = element_tuple(element)
-        if len(triple) != 3:
-            continue
-        src_ip, dst_ip, port = triple
-        if ipaddress.ip_address(src_ip) in net or ipaddress.ip_address(dst_ip) in net:
-            nft_try(f"delete element inet dcv {setname} {{ {src_ip} . {dst_ip} . {port} }}")
+def _purge_set_for_subnet(setname: str, cidr: str) -> None:
+    """Delete every element of ``setname`` with an address inside ``cidr``, in one command."""
+    matches = dcv_mirror.index(setname).within(cidr)
+    if setname.startswith("svc_guest_"):
+        for element in matches:
+            src_ip, dst_ip, port = element.split(" . ")
+            service_ports.remove(src_ip, dst_ip, setname.rsplit("_", 1)[1], port)
+    delete_elements(setname, matches)
 
 
 def add_member(subnet_id: str, ip: str) -> None:
-    nft_try(f"add element inet dcv subnet_{slug(subnet_id)}_members {{ {ip} }}")
+    _add_address(f"subnet_{slug(subnet_id)}_members", ip)
 
 
 def del_member(subnet_id: str, ip: str) -> None:
-    nft_try(f"delete element inet dcv subnet_{slug(subnet_id)}_members {{ {ip} }}")
+    _remove_address(f"subnet_{slug(subnet_id)}_members", ip)
     flush_conntrack_for_ip(ip)
 
 
 def make_public(subnet_id: str, ip: str) -> None:
-    nft_try(f"add element inet dcv subnet_{slug(subnet_id)}_public {{ {ip} }}")
+    _add_address(f"subnet_{slug(subnet_id)}_public", ip)
 
 
 def revoke_public(subnet_id: str, ip: str) -> None:
-    nft_try(f"delete element inet dcv subnet_{slug(subnet_id)}_public {{ {ip} }}")
+    _remove_address(f"subnet_{slug(subnet_id)}_public", ip)
 
 
 def connect_subnet_to_subnet_public(src_subnet_id: str, dst_subnet_id: str) -> None:
     src_members = f"subnet_{slug(src_subnet_id)}_members"
     dst_public = f"subnet_{slug(dst_subnet_id)}_public"
-
-    delete_rule_by_match("wg_allow", rf"ip saddr @{src_members} ip daddr @{dst_public} ct state new accept")
-    nft_try(f"add rule inet dcv wg_allow ip saddr @{src_members} ip daddr @{dst_public} ct state new accept")
-
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{src_members} ct original ip daddr @{dst_public} accept")
-    nft_try(
-        f"add rule inet dcv fwd_est ct state established,related "
-        f"ct original ip saddr @{src_members} ct original ip daddr @{dst_public} accept"
-    )
+    _allow_set_to_set(src_members, dst_public)
 
 
 def disconnect_subnet_from_subnet_public(src_subnet_id: str, dst_subnet_id: str) -> None:
     src_members = f"subnet_{slug(src_subnet_id)}_members"
     dst_public = f"subnet_{slug(dst_subnet_id)}_public"
-    delete_rule_by_match("wg_allow", rf"ip saddr @{src_members} ip daddr @{dst_public} ct state new accept")
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{src_members} ct original ip daddr @{dst_public} accept")
+    _disallow_set_to_set(src_members, dst_public)
 
 
 def connect_subnets_bidirectional_public(subnet_a: str, subnet_b: str) -> None:
@@ -137,37 +127,30 @@ def disconnect_subnets_bidirectional_public(subnet_a: str, subnet_b: str) -> Non
     disconnect_subnet_from_subnet_public(subnet_b, subnet_a)
 
 
+def _admin_subnet_to_peer_matches(members: str, dst_ip: str) -> tuple[str, str]:
+    return (
+        f"ip saddr @{members} ip daddr {dst_ip} ct state new",
+        f"ct state established,related ct original ip saddr @{members} ct original ip daddr {dst_ip}",
+    )
+
+
 def grant_admin_subnet_to_peer(src_subnet_id: str, dst_ip: str) -> None:
     members = f"subnet_{slug(src_subnet_id)}_members"
-    delete_rule_by_match("wg_allow", rf"ip saddr @{members} ip daddr {dst_ip} ct state new accept")
-    nft_try(f"add rule inet dcv wg_allow ip saddr @{members} ip daddr {dst_ip} ct state new accept")
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{members} ct original ip daddr {dst_ip} accept")
-    nft_try(
-        f"add rule inet dcv fwd_est ct state established,related "
-        f"ct original ip saddr @{members} ct original ip daddr {dst_ip} accept"
-    )
+    ensure_allow_rules(*_admin_subnet_to_peer_matches(members, dst_ip))
 
 
 def revoke_admin_subnet_to_peer(src_subnet_id: str, dst_ip: str) -> None:
     members = f"subnet_{slug(src_subnet_id)}_members"
-    delete_rule_by_match("wg_allow", rf"ip saddr @{members} ip daddr {dst_ip} ct state new accept")
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{members} ct original ip daddr {dst_ip} accept")
+    delete_allow_rules(*_admin_subnet_to_peer_matches(members, dst_ip))
 
 
 def grant_admin_subnet_to_subnet(src_subnet_id: str, dst_subnet_id: str) -> None:
     src_members = f"subnet_{slug(src_subnet_id)}_members"
     dst_members = f"subnet_{slug(dst_subnet_id)}_members"
-    delete_rule_by_match("wg_allow", rf"ip saddr @{src_members} ip daddr @{dst_members} ct state new accept")
-    nft_try(f"add rule inet dcv wg_allow ip saddr @{src_members} ip daddr @{dst_members} ct state new accept")
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{src_members} ct original ip daddr @{dst_members} accept")
-    nft_try(
-        f"add rule inet dcv fwd_est ct state established,related "
-        f"ct original ip saddr @{src_members} ct original ip daddr @{dst_members} accept"
-    )
+    _allow_set_to_set(src_members, dst_members)
 
 
 def revoke_admin_subnet_to_subnet(src_subnet_id: str, dst_subnet_id: str) -> None:
     src_members = f"subnet_{slug(src_subnet_id)}_members"
     dst_members = f"subnet_{slug(dst_subnet_id)}_members"
-    delete_rule_by_match("wg_allow", rf"ip saddr @{src_members} ip daddr @{dst_members} ct state new accept")
-    delete_rule_by_match("fwd_est", rf"ct original ip saddr @{src_members} ct original ip daddr @{dst_members} accept")
+    _disallow_set_to_set(src_members, dst_members)
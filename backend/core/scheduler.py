@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, TypeVar
+
+from backend.core.lock import lock
+from backend.core.logger import logger as logging
+from backend.core.state_manager import RestoreError, state_manager
+
+T = TypeVar("T")
+
+# Upper bounds of the group size buckets reported in the metrics; larger groups go in "more".
+GROUP_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class _Write:
+    def __init__(self, fn: Callable[[], Any]):
+        self.fn = fn
+        self.result: Any = None
+        self.error: BaseException | None = None
+        # The outcome is final: the write was committed, or failed and was undone on its own.
+        self.settled = False
+        self.done = threading.Event()
+
+
+class WriteScheduler:
+    """Runs the API writes that arrive together as one group: one transaction, one nft batch.
+
+    A write is a function doing what used to be the body of ``with lock.write_lock(),
+    state_manager.saved_state():``. Callers hand it to ``run`` and block until it is settled. A
+    worker thread takes every write queued at that point (waiting up to ``window`` seconds for
+    more, at most ``max_size`` per group) and runs them in order under a single write lock,
+    database transaction and kernel batch. Each write runs in a savepoint of its own, so one that
+    raises is undone alone and its caller gets the exception while the others go on.
+
+    If the group itself fails to commit (the kernel rejects the batch, the database cannot
+    commit), everything is rolled back and the writes that had succeeded are run again one at a
+    time, so each caller still gets the outcome of its own write. Until ``start`` is called (tests,
+    tools) or with ``max_size`` <= 1, writes run inline in the caller's thread as before.
+    """
+
+    def __init__(self):
+        self.max_size = 1
+        self.window = 0.0
+        self._writes: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.stats: dict[str, int] = {"writes": 0, "groups": 0, "failed": 0, "regrouped": 0, "largest_group": 0}
+        self.group_sizes: dict[str, int] = {**{f"<={size}": 0 for size in GROUP_SIZE_BUCKETS}, "more": 0}
+
+    def start(self, max_size: int, window: float) -> None:
+        self.max_size = max(max_size, 1)
+        self.window = max(window, 0.0)
+        if self.max_size == 1 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._work, name="write-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Settle the writes queued so far and wait up to ``timeout`` seconds for the worker to exit."""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        # Later writes run inline; the worker stops at this marker, after the writes queued before it.
+        self._writes.put(None)
+        if thread is threading.current_thread():
+            return
+        thread.join(timeout)
+        if thread.is_alive():
+            logging.warning(f"Write scheduler did not stop within {timeout}s")
+            return
+        self._drain()
+
+    def run(self, fn: Callable[[], T]) -> T:
+        """Run ``fn`` as a write and return its result, or raise what it raised."""
+        if self._thread is None or threading.current_thread() is self._thread:
+            with lock.write_lock(), state_manager.saved_state():
+                return fn()
+        write = _Write(fn)
+        self._writes.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            group = self._collect()
+            if not group:
+                continue
+            try:
+                self._run_group(group)
+            except BaseException as e:
+                for write in group:
+                    if not write.settled:
+                        write.result = None
+                        write.error = e
+            finally:
+                for write in group:
+                    write.done.set()
+        self._drain()
+
+    def _drain(self) -> None:
+        """Run alone the writes queued after the stop marker, by callers that had not seen the stop yet."""
+        while True:
+            try:
+                write = self._writes.get_nowait()
+            except queue.Empty:
+                return
+            if write is not None:
+                self._run_alone(write)
+                write.done.set()
+
+    def _collect(self) -> list[_Write]:
+        first = self._writes.get()
+        if first is None:
+            self._stop.set()
+            return []
+        group = [first]
+        deadline = time.monotonic() + self.window
+        while len(group) < self.max_size:
+            try:
+                timeout = deadline - time.monotonic()
+                write = self._writes.get(timeout=timeout) if timeout > 0 else self._writes.get_nowait()
+            except queue.Empty:
+                break
+            if write is None:
+                self._stop.set()
+                break
+            group.append(write)
+        return group
+
+    def _run_group(self, group: list[_Write]) -> None:
+        self._count(len(group))
+        try:
+            with lock.write_lock(), state_manager.saved_state():
+                for write in group:
+                    try:
+                        with state_manager.savepoint():
+                            write.result = write.fn()
+                    except RestoreError:
+                        raise
+                    except Exception as e:
+                        write.error = e
+                        write.settled = True
+        except Exception as e:
+            if len(group) == 1 and group[0].error is None:
+                group[0].error = e
+                group[0].settled = True
+                return
+            # Nothing of the group was kept: run again, alone, the writes that did not fail on their own.
+            logging.warning(f"Group of {len(group)} writes failed to commit ({e}), running them one at a time")
+            self.stats["regrouped"] += 1
+            for write in group:
+                if write.error is None:
+                    self._run_alone(write)
+        else:
+            for write in group:
+                write.settled = True
+        self.stats["failed"] += sum(1 for write in group if write.error is not None)
+
+    def _run_alone(self, write: _Write) -> None:
+        write.result = None
+        try:
+            with lock.write_lock(), state_manager.saved_state():
+                write.result = write.fn()
+        except Exception as e:
+            write.error = e
+        write.settled = True
+
+    def _count(self, size: int) -> None:
+        self.stats["writes"] += size
+        self.stats["groups"] += 1
+        self.stats["largest_group"] = max(self.stats["largest_group"], size)
+        bucket = next((f"<={limit}" for limit in GROUP_SIZE_BUCKETS if size <= limit), "more")
+        self.group_sizes[bucket] += 1
+
+
+write_scheduler = WriteScheduler()
@@ -1,60 +1,113 @@
 from contextlib import contextmanager
 from backend.core.logger import logger as logging
-from backend.core.config import settings
 from backend.core.database import db
-from backend.core.nftables import restore_dcv_table, backup_dcv_table
-import subprocess
+from backend.core.intents import intent_log
+from backend.core.journal import undo_journal
+from backend.core.nftables import nft_batch
+from backend.core.nftables.commands import current_batch, nft_capture, submit_early
+
+
+class RestoreError(RuntimeError):
+    """The changes of a failed write could not all be undone."""
+
 
 class StateManager:
-    def __init__(self, wg_interface: str):
-        self.wg_interface = wg_interface
-        self.dcv_backup_text: str | None = None
-        self.wg_config_backup_text: str | None = None
+    """
+    Runs API writes as transactions over the database, nftables and WireGuard.
 
-    def backup(self):
+    Nothing is copied up front: the nft and wg helpers record the inverse of each change in the
+    undo journal as they make it, and a failed write replays only those inverses. Subsystems
+    without a cheap inverse (a whole table load, a bulk peer sync) snapshot themselves the first
+    time a write touches them.
 
-        # backup nftables dcv table
-        self.dcv_backup_text = backup_dcv_table()
+    What a write is about to change in the kernel is also committed to the intent log before it
+    gets there, and dropped once the write is settled; a write interrupted by a crash is finished
+    by the startup recovery from its intent.
+    """
 
-        # backup WireGuard config
-        result = subprocess.run(["wg", "showconf", self.wg_interface], check=True, stdout=subprocess.PIPE, text=True)
-        self.wg_config_backup_text = result.stdout
+    def __init__(self):
+        # Whether saved_state joined a batch opened by its caller, which outlives a failed write.
+        self.joined = False
 
+    def backup(self):
+        undo_journal.begin()
+        intent_log.begin()
         db.begin_transaction()
-        logging.info("🔋  Backed up state in memory.")
+        logging.info("🔋  Started undo journal.")
 
     def restore(self):
         """
-        Restores nftables dcv table and WireGuard config from in-memory backup.
+        Undoes the changes recorded by the failed write and rolls the database back.
         """
 
         try:
-            if self.dcv_backup_text:
-                restore_dcv_table(self.dcv_backup_text)
-
-            if self.wg_config_backup_text:
-                subprocess.run(["wg", "setconf", self.wg_interface, "/dev/stdin"],
-                               input=self.wg_config_backup_text, text=True, check=True)
-
+            errors = []
+            if not self.joined:
+                # The commands queued after the last batch the kernel accepted were discarded
+                # with the write: their inverses only put the in-memory mirror and indexes back.
+                with nft_capture():
+                    errors += undo_journal.rollback_to(undo_journal.applied_mark)
+            with nft_batch():
+                errors += undo_journal.rollback()
             db.rollback_transaction()
+            if errors:
+                raise errors[0]
+            intent_log.finish()
             logging.info("🔄 System state restored.")
         except Exception as e:
+            # The intent stays on disk: the next startup compares what it names with the database.
+            intent_log.release()
             logging.error(f"❌  Failed to restore state: {e}")
             raise
 
     @contextmanager
     def saved_state(self):
+        """
+        Runs the enclosed block as one transaction: DB writes are committed and every nft command
+        issued inside is submitted to the kernel as a single atomic batch on success.
+        """
         self.backup()
+        self.joined = current_batch() is not None
         try:
-            yield
+            with nft_batch():
+                yield
             db.commit_transaction()
+            undo_journal.commit()
+            intent_log.finish()
             logging.info("✅  Transaction committed successfully.")
         except Exception as e:
             logging.warning(f"⛑️  Exception occurred: {e}. Restoring state...")
             self.restore()
             raise
 
-    
+    @contextmanager
+    def savepoint(self):
+        """
+        Inside ``saved_state``, makes the enclosed block undoable on its own: if it raises, only its
+        own changes are reverted (its inverses join the open nft batch, the database goes back to the
+        savepoint) and the enclosing transaction carries on. Used to run several writes as one group.
+        """
+        mark = undo_journal.mark()
+        db.savepoint("write")
+        try:
+            yield
+        except Exception:
+            applied = undo_journal.applied_mark
+            errors = undo_journal.rollback_to(mark)
+            if applied > mark and not errors:
+                # Some of the block's commands already reached the kernel: submit their inverses
+                # now, so a later failure discarding the open batch cannot leave them applied.
+                try:
+                    submit_early("savepoint undo")
+                except Exception as e:
+                    errors = [e]
+            db.rollback_to_savepoint("write")
+            if errors:
+                # What the failed write left behind is unknown: the whole transaction has to go.
+                raise RestoreError(f"Failed to undo write: {errors[0]}") from errors[0]
+            raise
+        db.release_savepoint("write")
+
 
-state_manager = StateManager(wg_interface=settings.wg_interface)
 
+state_manager = StateManager()
@@ -0,0 +1,34 @@
+from backend.core.wireguard.client import WgPeerConfig, WgPeerDump, wg_client
+from backend.core.wireguard.history import peer_history
+from backend.core.wireguard.keys import generate_keys, key_pool
+from backend.core.wireguard.shards import wg_shards
+from backend.core.wireguard.telemetry import wg_telemetry
+from backend.core.wireguard.interface import (
+    apply_ip_route,
+    apply_to_wg_config,
+    flush_wireguard,
+    generate_wg_config,
+    getPeerInfo,
+    remove_from_wg_config,
+    resync_wireguard_peers,
+    sync_wireguard,
+)
+
+__all__ = [
+    "WgPeerConfig",
+    "WgPeerDump",
+    "apply_ip_route",
+    "apply_to_wg_config",
+    "flush_wireguard",
+    "generate_keys",
+    "generate_wg_config",
+    "getPeerInfo",
+    "key_pool",
+    "peer_history",
+    "remove_from_wg_config",
+    "resync_wireguard_peers",
+    "sync_wireguard",
+    "wg_client",
+    "wg_shards",
+    "wg_telemetry",
+]
@@ -0,0 +1,259 @@
+import base64
+import subprocess
+import threading
+from typing import Iterable, NamedTuple
+
+from backend.core.logger import logger as logging
+
+WG_CLIENT_MODES = ("auto", "netlink", "subprocess")
+
+
+class WgPeerDump(NamedTuple):
+    public_key: str
+    preshared_key: str
+    endpoint: str
+    allowed_ips: tuple[str, ...]
+    last_handshake: int
+    rx: int
+    tx: int
+
+
+class WgPeerConfig(NamedTuple):
+    public_key: str
+    preshared_key: str
+    allowed_ips: tuple[str, ...]
+
+
+def _allowed_ip(address: str) -> str:
+    return address if "/" in address else f"{address}/32"
+
+
+def render_peers(peers: Iterable[WgPeerConfig]) -> str:
+    """``[Peer]`` sections for ``wg setconf``/``wg syncconf``."""
+    sections = []
+    for peer in peers:
+        sections.append(
+            "[Peer]\n"
+            f"PublicKey = {peer.public_key}\n"
+            f"PresharedKey = {peer.preshared_key}\n"
+            f"AllowedIPs = {', '.join(_allowed_ip(ip) for ip in peer.allowed_ips)}\n"
+        )
+    return "\n".join(sections)
+
+
+def _interface_section(showconf: str) -> str:
+    """The ``[Interface]`` part of ``wg showconf``, i.e. everything before the first peer."""
+    head, _, _ = showconf.partition("[Peer]")
+    return head.rstrip() + "\n"
+
+
+class SubprocessBackend:
+    """Drives the interface through the ``wg`` binary; keys are passed on stdin, never on disk."""
+
+    name = "subprocess"
+
+    def peers(self, interface: str) -> list[str]:
+        output = subprocess.check_output(["wg", "show", interface, "peers"], text=True).strip()
+        return output.split()
+
+    def dump(self, interface: str) -> list[WgPeerDump]:
+        output = subprocess.check_output(["wg", "show", interface, "dump"], text=True)
+        peers = []
+        # The first line describes the interface itself.
+        for line in output.splitlines()[1:]:
+            parts = line.split("\t")
+            if len(parts) < 8:
+                continue
+            public_key, preshared_key, endpoint, allowed_ips, handshake, rx, tx = parts[:7]
+            peers.append(WgPeerDump(
+                public_key=public_key,
+                preshared_key="" if preshared_key == "(none)" else preshared_key,
+                endpoint="" if endpoint == "(none)" else endpoint,
+                allowed_ips=tuple(ip for ip in allowed_ips.split(",") if ip and ip != "(none)"),
+                last_handshake=int(handshake),
+                rx=int(rx),
+                tx=int(tx),
+            ))
+        return peers
+
+    def set_peer(self, interface: str, public_key: str, preshared_key: str, allowed_ips: list[str]) -> None:
+        subprocess.run([
+            "wg", "set", interface,
+            "peer", public_key,
+            "preshared-key", "/dev/stdin",
+            "allowed-ips", ",".join(_allowed_ip(ip) for ip in allowed_ips),
+        ], input=preshared_key, text=True, check=True)
+
+    def remove_peers(self, interface: str, public_keys: list[str]) -> None:
+        if not public_keys:
+            return
+        command = ["wg", "set", interface]
+        for public_key in public_keys:
+            command += ["peer", public_key, "remove"]
+        subprocess.run(command, check=True)
+
+    def sync_peers(self, interface: str, peers: list[WgPeerConfig]) -> None:
+        """Two processes for any number of peers: read the interface section, then ``syncconf``,
+        which only touches peers that differ and so keeps the sessions of the others."""
+        showconf = subprocess.check_output(["wg", "showconf", interface], text=True)
+        config = _interface_section(showconf) + "\n" + render_peers(peers)
+        subprocess.run(["wg", "syncconf", interface, "/dev/stdin"], input=config, text=True, check=True)
+
+
+def _key_text(value) -> str:
+    """pyroute2 hands keys back base64 encoded, as bytes or str depending on the version."""
+    if isinstance(value, bytes):
+        return value.decode() if len(value) == 44 else base64.b64encode(value).decode()
+    return str(value)
+
+
+class NetlinkBackend:
+    """Talks to the WireGuard generic-netlink family in-process through pyroute2.
+
+    One socket is opened lazily and reused; requests on it are serialised.
+    """
+
+    name = "netlink"
+
+    def __init__(self):
+        from pyroute2 import WireGuard  # optional dependency, imported on first use
+
+        self._socket = WireGuard()
+        self._lock = threading.Lock()
+
+    def _device(self, interface: str) -> list:
+        with self._lock:
+            return list(self._socket.info(interface))
+
+    def _peer_attrs(self, interface: str) -> list:
+        peers = []
+        for message in self._device(interface):
+            peers.extend(message.get_attr("WGDEVICE_A_PEERS") or [])
+        return peers
+
+    def peers(self, interface: str) -> list[str]:
+        return [_key_text(peer.get_attr("WGPEER_A_PUBLIC_KEY")) for peer in self._peer_attrs(interface)]
+
+    def dump(self, interface: str) -> list[WgPeerDump]:
+        peers = []
+        for peer in self._peer_attrs(interface):
+            endpoint = peer.get_attr("WGPEER_A_ENDPOINT") or {}
+            handshake = peer.get_attr("WGPEER_A_LAST_HANDSHAKE_TIME") or {}
+            allowed = []
+            for item in peer.get_attr("WGPEER_A_ALLOWEDIPS") or []:
+                addr = item.get_attr("WGALLOWEDIP_A_IPADDR") if hasattr(item, "get_attr") else item.get("addr")
+                cidr = item.get_attr("WGALLOWEDIP_A_CIDR_MASK") if hasattr(item, "get_attr") else None
+                if addr:
+                    allowed.append(f"{addr}/{cidr}" if cidr is not None and "/" not in str(addr) else str(addr))
+            preshared_key = peer.get_attr("WGPEER_A_PRESHARED_KEY")
+            peers.append(WgPeerDump(
+                public_key=_key_text(peer.get_attr("WGPEER_A_PUBLIC_KEY")),
+                preshared_key=_key_text(preshared_key) if preshared_key else "",
+                endpoint=f"{endpoint['addr']}:{endpoint['port']}" if endpoint.get("addr") else "",
+                allowed_ips=tuple(allowed),
+                last_handshake=int(handshake.get("tv_sec", 0)),
+                rx=int(peer.get_attr("WGPEER_A_RX_BYTES") or 0),
+                tx=int(peer.get_attr("WGPEER_A_TX_BYTES") or 0),
+            ))
+        return peers
+
+    def set_peer(self, interface: str, public_key: str, preshared_key: str, allowed_ips: list[str]) -> None:
+        peer = {
+            "public_key": public_key,
+            "preshared_key": preshared_key,
+            "allowed_ips": [_allowed_ip(ip) for ip in allowed_ips],
+        }
+        with self._lock:
+            self._socket.set(interface, peer=peer)
+
+    def remove_peers(self, interface: str, public_keys: list[str]) -> None:
+        with self._lock:
+            for public_key in public_keys:
+                self._socket.set(interface, peer={"public_key": public_key, "remove": True})
+
+    def sync_peers(self, interface: str, peers: list[WgPeerConfig]) -> None:
+        """Diff against one device dump and send messages only for peers that differ."""
+        current = {dump.public_key: dump for dump in self.dump(interface)}
+        wanted = {peer.public_key for peer in peers}
+        self.remove_peers(interface, [public_key for public_key in current if public_key not in wanted])
+        for peer in peers:
+            dump = current.get(peer.public_key)
+            allowed_ips = sorted(_allowed_ip(ip) for ip in peer.allowed_ips)
+            if dump is not None and dump.preshared_key == peer.preshared_key and sorted(dump.allowed_ips) == allowed_ips:
+                continue
+            self.set_peer(interface, peer.public_key, peer.preshared_key, list(peer.allowed_ips))
+
+
+class WgClient:
+    """Front for the WireGuard backends: netlink when available, the ``wg`` binary otherwise.
+
+    In ``auto`` mode a netlink failure (missing module, kernel without the family, a rejected
+    message) is logged and the same operation is retried through the subprocess backend, so the
+    fallback costs one failed call, not a broken request.
+    """
+
+    def __init__(self):
+        self.mode = "auto"
+        self.subprocess = SubprocessBackend()
+        self.netlink: NetlinkBackend | None = None
+        self._netlink_failed = False
+        self.stats: dict[str, int] = {"netlink_calls": 0, "subprocess_calls": 0, "fallbacks": 0}
+
+    def configure(self, mode: str) -> None:
+        if mode not in WG_CLIENT_MODES:
+            raise ValueError(f"Unknown WireGuard client mode {mode!r}, expected one of {', '.join(WG_CLIENT_MODES)}")
+        self.mode = mode
+        self.netlink = None
+        self._netlink_failed = False
+
+    def _netlink(self) -> NetlinkBackend | None:
+        if self.mode == "subprocess" or self._netlink_failed:
+            return None
+        if self.netlink is None:
+            try:
+                self.netlink = NetlinkBackend()
+            except Exception as exc:
+                if self.mode == "netlink":
+                    raise
+                self._netlink_failed = True
+                logging.info(f"WireGuard netlink backend unavailable ({exc}); using the wg binary")
+                return None
+        return self.netlink
+
+    @property
+    def backend(self) -> str:
+        return "netlink" if self._netlink() is not None else "subprocess"
+
+    def _call(self, operation: str, *args):
+        netlink = self._netlink()
+        if netlink is not None:
+            try:
+                result = getattr(netlink, operation)(*args)
+                self.stats["netlink_calls"] += 1
+                return result
+            except Exception as exc:
+                if self.mode == "netlink":
+                    raise
+                self.stats["fallbacks"] += 1
+                logging.warning(f"WireGuard netlink {operation} failed ({exc}); retrying with the wg binary")
+        self.stats["subprocess_calls"] += 1
+        return getattr(self.subprocess, operation)(*args)
+
+    def peers(self, interface: str) -> list[str]:
+        return self._call("peers", interface)
+
+    def dump(self, interface: str) -> list[WgPeerDump]:
+        return self._call("dump", interface)
+
+    def set_peer(self, interface: str, public_key: str, preshared_key: str, allowed_ips: Iterable[str]) -> None:
+        self._call("set_peer", interface, public_key, preshared_key, list(allowed_ips))
+
+    def remove_peers(self, interface: str, public_keys: Iterable[str]) -> None:
+        self._call("remove_peers", interface, list(public_keys))
+
+    def sync_peers(self, interface: str, peers: Iterable[WgPeerConfig]) -> None:
+        """Make ``peers`` the exact peer list of the interface, leaving unchanged peers alone."""
+        self._call("sync_peers", interface, list(peers))
+
+
+wg_client = WgClient()
@@ -0,0 +1,235 @@
+import heapq
+import threading
+import time
+from array import array
+
+from backend.core.logger import logger as logging
+from backend.core.wireguard.client import WgPeerDump
+
+# Rollup resolutions: seconds per slot -> (seconds per stored window, retention in seconds).
+ROLLUPS = {
+    60: (3600, 7 * 86400),
+    3600: (86400, 90 * 86400),
+}
+_QUERY_CHUNK = 500
+# Longest top-talkers list kept ready; requests slice it.
+TOP_MAX = 100
+
+
+class _Window:
+    """One rollup row being filled: rx/tx byte counts per slot, interleaved."""
+
+    __slots__ = ("counts", "dirty")
+
+    def __init__(self, slots: int, data: bytes | None = None):
+        self.counts = array("Q", bytes(16 * slots) if data is None else data)
+        self.dirty = False
+
+
+class PeerHistory:
+    """Per-peer rx/tx rates fed by the WireGuard telemetry collector.
+
+    Recent samples live in memory: one shared ring of sample times and, per peer, two float32
+    rings of rates (bytes/s) of ``samples`` entries, so memory is bounded at about
+    ``8 * samples`` bytes per peer (1.2 MB per 1000 peers at the default 150 samples) whatever
+    the uptime. Peers that disappear from the interface are dropped at the next sample.
+
+    The bytes each peer moved over the whole ring are kept as a running total (the sample that
+    is overwritten is subtracted, the new one added), and the ``TOP_MAX`` largest totals are
+    selected once per sample, so a top-talkers request only slices a ready list.
+
+    Byte counts are also summed into 1-minute and 1-hour slots. The windows being filled (the
+    current hour of minutes, the current day of hours) stay in memory and are written to SQLite
+    as packed blobs at every minute boundary, to a ``RollupStore`` in a file of its own so the
+    writes never wait for a request transaction, nor hold one up.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.store = None
+        self.times = array("d")
+        self.spans = array("d")
+        self.head = -1
+        self.rates: dict[str, tuple[array, array]] = {}
+        self.last: dict[str, tuple[int, int]] = {}
+        self.last_time = 0.0
+        self.window_bytes: dict[str, float] = {}
+        self.top: list[tuple[str, float]] = []
+        self.pending: dict[str, list[int]] = {}
+        self.minute = 0
+        self.windows: dict[tuple[str, int, int], _Window] = {}
+        self._lock = threading.Lock()
+        self.stats: dict[str, float] = {"samples": 0, "flushes": 0, "last_flush_seconds": 0.0, "rows_written": 0}
+
+    def configure(self, samples: int, store=None) -> None:
+        with self._lock:
+            self.samples = max(samples, 0)
+            self.store = store
+            self.times = array("d", [0.0] * self.samples)
+            self.spans = array("d", [0.0] * self.samples)
+            self.head = -1
+            self.rates.clear()
+            self.window_bytes.clear()
+            self.top = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.samples > 0
+
+    # ----- collection ---------------------------------------------------------------------
+
+    def record(self, peers: dict[str, WgPeerDump], at: float | None = None) -> None:
+        """Add one sample of the interface counters (a telemetry listener)."""
+        if not self.enabled:
+            return
+        at = time.time() if at is None else at
+        with self._lock:
+            elapsed = at - self.last_time if self.last_time else 0.0
+            self.head = (self.head + 1) % self.samples
+            head = self.head
+            overwritten = self.spans[head]
+            self.times[head] = at
+            self.spans[head] = max(elapsed, 0.0)
+            for public_key in self.rates.keys() - peers.keys():
+                del self.rates[public_key]
+                self.last.pop(public_key, None)
+                self.window_bytes.pop(public_key, None)
+            for public_key, dump in peers.items():
+                previous = self.last.get(public_key)
+                self.last[public_key] = (dump.rx, dump.tx)
+                rings = self.rates.get(public_key)
+                if rings is None:
+                    rings = self.rates[public_key] = (array("f", [0.0] * self.samples), array("f", [0.0] * self.samples))
+                    self.window_bytes[public_key] = 0.0
+                elif overwritten:
+                    self.window_bytes[public_key] -= (rings[0][head] + rings[1][head]) * overwritten
+                if previous is None or elapsed <= 0:
+                    rings[0][head] = rings[1][head] = 0.0
+                    continue
+                # A counter that went backwards was reset (peer re-added): count from zero.
+                rx = dump.rx - previous[0] if dump.rx >= previous[0] else dump.rx
+                tx = dump.tx - previous[1] if dump.tx >= previous[1] else dump.tx
+                rings[0][head] = rx / elapsed
+                rings[1][head] = tx / elapsed
+                # Add back exactly what will be subtracted when this slot is overwritten.
+                self.window_bytes[public_key] += (rings[0][head] + rings[1][head]) * elapsed
+                if rx or tx:
+                    counts = self.pending.setdefault(public_key, [0, 0])
+                    counts[0] += rx
+                    counts[1] += tx
+            self.last_time = at
+            self.top = heapq.nlargest(TOP_MAX, self.window_bytes.items(), key=lambda item: item[1])
+            self.stats["samples"] += 1
+            minute = int(at // 60)
+            if minute != self.minute:
+                if self.minute:
+                    self._roll(self.minute * 60)
+                self.minute = minute
+
+    def _open_windows(self, public_keys: list[str], resolution: int, bucket: int) -> None:
+        """Make sure the windows exist in memory, continuing rows already on disk (restarts)."""
+        missing = [key for key in public_keys if (key, resolution, bucket) not in self.windows]
+        stored: dict[str, bytes] = {}
+        if self.store is not None:
+            for i in range(0, len(missing), _QUERY_CHUNK):
+                rows = self.store.get_traffic_rollups(missing[i:i + _QUERY_CHUNK], resolution, bucket)
+                for public_key, windows in rows.items():
+                    stored.update({public_key: blob for start, blob in windows if start == bucket})
+        slots = ROLLUPS[resolution][0] // resolution
+        for public_key in missing:
+            self.windows[(public_key, resolution, bucket)] = _Window(slots, stored.get(public_key))
+
+    def _roll(self, minute_start: int) -> None:
+        """Move the byte counts of the minute that just ended into the rollup windows."""
+        started = time.perf_counter()
+        for resolution, (span, _retention) in ROLLUPS.items():
+            self._open_windows(list(self.pending), resolution, minute_start - minute_start % span)
+        for public_key, (rx, tx) in self.pending.items():
+            for resolution, (span, _retention) in ROLLUPS.items():
+                bucket = minute_start - minute_start % span
+                slot = (minute_start - bucket) // resolution
+                window = self.windows[(public_key, resolution, bucket)]
+                window.counts[2 * slot] += rx
+                window.counts[2 * slot + 1] += tx
+                window.dirty = True
+        self.pending = {}
+        rows = [(key[0], key[1], key[2], window.counts.tobytes()) for key, window in self.windows.items() if window.dirty]
+        expired = []
+        if minute_start % 3600 == 0:
+            expired = [(resolution, minute_start - retention) for resolution, (_span, retention) in ROLLUPS.items()]
+        try:
+            if self.store is not None and rows:
+                self.store.save_traffic_rollups(rows, expired)
+        except Exception as e:
+            # The windows stay dirty and are written again at the next minute.
+            logging.error(f"Failed to persist traffic rollups: {e}")
+            return
+        for key, window in list(self.windows.items()):
+            window.dirty = False
+            # Windows that ended with this minute are on disk now.
+            if key[2] + ROLLUPS[key[1]][0] <= minute_start + 60:
+                del self.windows[key]
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += len(rows)
+        self.stats["last_flush_seconds"] = time.perf_counter() - started
+
+    # ----- queries ------------------------------------------------------------------------
+
+    def rate(self, public_key: str) -> tuple[float, float]:
+        """Latest rx/tx rate in bytes per second."""
+        rings = self.rates.get(public_key)
+        if rings is None or self.head < 0:
+            return 0.0, 0.0
+        return rings[0][self.head], rings[1][self.head]
+
+    @property
+    def window_seconds(self) -> float:
+        """Time covered by the in-memory ring (and so by the top-talkers totals)."""
+        return sum(self.spans)
+
+    def top_talkers(self, limit: int) -> list[tuple[str, float]]:
+        """Peers that moved the most bytes (rx + tx) over the ring, largest first."""
+        return [(public_key, total) for public_key, total in self.top[:limit] if total > 0.5]
+
+    def recent(self, public_key: str, since: float = 0.0) -> list[tuple[float, float, float]]:
+        """In-memory samples as (time, rx rate, tx rate), oldest first."""
+        rings = self.rates.get(public_key)
+        if rings is None:
+            return []
+        with self._lock:
+            points = []
+            for i in range(1, self.samples + 1):
+                slot = (self.head + i) % self.samples
+                at = self.times[slot]
+                if at and at >= since:
+                    points.append((at, rings[0][slot], rings[1][slot]))
+        return points
+
+    def rollups(self, public_keys: list[str], resolution: int, since: int) -> dict[str, list[tuple[int, int, int]]]:
+        """Rollup points as (slot start, rx bytes, tx bytes) per peer, oldest first, empty slots skipped."""
+        span = ROLLUPS[resolution][0]
+        first_bucket = since - since % span
+        stored: dict[str, dict[int, bytes]] = {key: {} for key in public_keys}
+        if self.store is not None:
+            for i in range(0, len(public_keys), _QUERY_CHUNK):
+                chunk = public_keys[i:i + _QUERY_CHUNK]
+                for public_key, rows in self.store.get_traffic_rollups(chunk, resolution, first_bucket).items():
+                    stored[public_key].update(rows)
+        with self._lock:
+            for (public_key, window_resolution, bucket), window in self.windows.items():
+                if window_resolution == resolution and public_key in stored and bucket >= first_bucket:
+                    stored[public_key][bucket] = window.counts.tobytes()
+        result = {}
+        for public_key, windows in stored.items():
+            points = []
+            for bucket in sorted(windows):
+                counts = array("Q", windows[bucket])
+                for slot in range(len(counts) // 2):
+                    start = bucket + slot * resolution
+                    if start >= since and (counts[2 * slot] or counts[2 * slot + 1]):
+                        points.append((start, counts[2 * slot], counts[2 * slot + 1]))
+            result[public_key] = points
+        return result
+
+
+peer_history = PeerHistory()
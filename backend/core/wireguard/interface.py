@@ -0,0 +1,188 @@
+import subprocess
+from typing import Iterable
+from fastapi import HTTPException
+from backend.core.models import Peer, Service
+from backend.core.config import settings
+from backend.core.intents import intent_log
+from backend.core.journal import undo_journal
+from backend.core.logger import logger as logging
+from backend.core.wireguard.client import WgPeerConfig, wg_client
+from backend.core.wireguard.shards import wg_shards
+from backend.core.wireguard.telemetry import wg_telemetry
+
+
+def _journal_interface(interface: str) -> None:
+    """Record the current peers of ``interface`` so the undo journal can sync them back."""
+    if not undo_journal.active:
+        return
+    configs = [WgPeerConfig(dump.public_key, dump.preshared_key, dump.allowed_ips) for dump in wg_client.dump(interface)]
+
+    def restore() -> None:
+        wg_client.sync_peers(interface, configs)
+        wg_shards.route([ip for config in configs for ip in config.allowed_ips])
+
+    undo_journal.record(restore)
+
+
+def _intend(public_key: str, address: str) -> None:
+    intent_log.touch("peer", public_key)
+    intent_log.touch("address", address)
+    intent_log.persist()
+
+
+def _kernel_peer(interface: str, public_key: str) -> WgPeerConfig | None:
+    """The settings ``interface`` has for ``public_key``, read from the kernel: the telemetry cache may be behind."""
+    for dump in wg_client.dump(interface):
+        if dump.public_key == public_key:
+            return WgPeerConfig(dump.public_key, dump.preshared_key, dump.allowed_ips)
+    return None
+
+
+def _restore_peer(interface: str, public_key: str, address: str, previous: WgPeerConfig | None) -> None:
+    """Put one peer back as it was before a write: absent, or with its previous settings."""
+    if previous is None:
+        wg_client.remove_peers(interface, [public_key])
+        wg_shards.unroute([address])
+    else:
+        wg_client.set_peer(interface, previous.public_key, previous.preshared_key, previous.allowed_ips)
+        wg_shards.route(list(previous.allowed_ips))
+
+
+def flush_wireguard():
+    """Remove all peers from the WireGuard interfaces."""
+    try:
+        intent_log.touch("wireguard")
+        intent_log.persist()
+        for interface in wg_shards.interfaces:
+            peers = wg_client.peers(interface)
+            if not peers:
+                logging.info("No peers to remove from %s.", interface)
+                continue
+            _journal_interface(interface)
+            wg_client.remove_peers(interface, peers)
+            logging.info("All peers removed from %s", interface)
+    except Exception as e:
+        logging.error(f"Failed to flush peers: {e}")
+        raise HTTPException(status_code=500, detail="Failed to flush WireGuard peers")
+
+def apply_to_wg_config(peer: Peer):
+    """Apply the peer configuration to the WireGuard interface."""
+    try:
+        logging.debug(f"Applying WireGuard config for peer: {peer.username}")
+        interface = wg_shards.interface_for(peer.address)
+        previous = _kernel_peer(interface, peer.public_key) if undo_journal.active else None
+        _intend(peer.public_key, peer.address)
+        wg_client.set_peer(interface, peer.public_key, peer.preshared_key, [peer.address])
+        public_key, address = peer.public_key, peer.address
+        undo_journal.record(lambda: _restore_peer(interface, public_key, address, previous))
+        wg_shards.route([peer.address])
+    except Exception as e:
+        logging.error(f"Failed to apply peer config: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to apply peer configuration for {peer}")
+
+def sync_wireguard(peers: list[Peer]):
+    """Make the WireGuard interfaces carry exactly ``peers``, in one operation per interface.
+
+    Unlike flush_wireguard followed by apply_to_wg_config per peer, peers that are already
+    configured the same way are left untouched and keep their sessions.
+    """
+    try:
+        shards: dict[str, list[WgPeerConfig]] = {interface: [] for interface in wg_shards.interfaces}
+        for peer in peers:
+            shards[wg_shards.interface_for(peer.address)].append(
+                WgPeerConfig(peer.public_key, peer.preshared_key, (peer.address,))
+            )
+        intent_log.touch("wireguard")
+        intent_log.persist()
+        for interface, configs in shards.items():
+            _journal_interface(interface)
+            wg_client.sync_peers(interface, configs)
+            logging.info(f"Synchronised {len(configs)} peers on {interface}")
+        wg_shards.route([peer.address for peer in peers])
+    except Exception as e:
+        logging.error(f"Failed to synchronise peers: {e}")
+        raise HTTPException(status_code=500, detail="Failed to synchronise WireGuard peers")
+
+def resync_wireguard_peers(public_keys: Iterable[str], addresses: Iterable[str], peers: list[Peer]):
+    """Bring only the given keys and addresses back in line with ``peers`` (the database).
+
+    Used by startup recovery for the peers named by unfinished intents; every other peer is
+    left as the interfaces have it.
+    """
+    try:
+        by_key = {peer.public_key: peer for peer in peers}
+        by_address = {peer.address: peer for peer in peers}
+        public_keys = list(public_keys)
+        stale = [public_key for public_key in public_keys if public_key not in by_key]
+        if stale:
+            # The shard of a key that is gone is unknown; removing an absent peer is a no-op.
+            for interface in wg_shards.interfaces:
+                wg_client.remove_peers(interface, stale)
+        for public_key in public_keys:
+            peer = by_key.get(public_key)
+            if peer is not None:
+                wg_client.set_peer(wg_shards.interface_for(peer.address), peer.public_key, peer.preshared_key, [peer.address])
+        addresses = list(addresses)
+        wg_shards.route([address for address in addresses if address in by_address])
+        wg_shards.unroute([address for address in addresses if address not in by_address])
+        logging.info(f"Resynchronised {len(public_keys)} WireGuard peers from unfinished writes")
+    except Exception as e:
+        logging.error(f"Failed to resynchronise peers: {e}")
+        raise HTTPException(status_code=500, detail="Failed to resynchronise WireGuard peers")
+
+def remove_from_wg_config(peer: Peer):
+    try:
+        interface = wg_shards.interface_for(peer.address)
+        # Copied now: callers go on to change the peer (key rotation).
+        previous = WgPeerConfig(peer.public_key, peer.preshared_key, (peer.address,))
+        _intend(peer.public_key, peer.address)
+        wg_client.remove_peers(interface, [peer.public_key])
+        address = peer.address
+        undo_journal.record(lambda: _restore_peer(interface, previous.public_key, address, previous))
+        wg_shards.unroute([peer.address])
+    except Exception as e:
+        logging.error(f"Failed to remove peer config: {e}")
+        raise HTTPException(status_code=500, detail="Failed to remove peer configuration")
+
+def generate_wg_config(peer: Peer,private_key:str)->str:
+    """Generate the WireGuard configuration for a peer."""
+    # The port of the interface (shard) this peer is assigned to.
+    endpoint = f"{settings.endpoint.rsplit(':', 1)[0]}:{wg_shards.port_for(peer.address)}"
+    config = f"""[Interface]
+PrivateKey = {private_key}
+Address = {peer.address}
+MTU = {settings.mtu}
+
+[Peer]
+PublicKey = {settings.public_key}
+PresharedKey = {peer.preshared_key}
+Endpoint = {endpoint}
+AllowedIPs = {settings.wg_default_subnet}
+PersistentKeepalive = 15
+"""
+    return config
+
+def getPeerInfo(peer: Peer):
+    try:
+        dump = wg_telemetry.peer(peer.public_key)
+        if dump is not None:
+            peer.tx = dump.tx
+            peer.rx = dump.rx
+            peer.last_handshake = dump.last_handshake
+            if peer.last_handshake == 0:
+                peer.last_handshake = -1
+    except Exception as e:
+        logging.error(f"Failed to get peer info: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get peer info")
+    
+def apply_ip_route():
+    try:
+        logging.info(f"Applying IP route for {settings.wg_default_subnet} via {settings.wg_interface}...")
+        subprocess.run(
+            ["ip", "route", "replace", settings.wg_default_subnet, "dev", settings.wg_interface],
+            check=True
+        )
+        logging.info(f"IP route applied for {settings.wg_default_subnet} via {settings.wg_interface}.")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Failed to apply IP route: {e}")
+        raise HTTPException(status_code=500, detail="Failed to apply IP route")
\ No newline at end of file
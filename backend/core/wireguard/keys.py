@@ -0,0 +1,118 @@
+import base64
+import os
+import queue
+import subprocess
+import threading
+
+from backend.core.logger import logger as logging
+
+try:  # optional dependency: without it keys come from the wg binary
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
+except ImportError:  # pragma: no cover - depends on the image
+    X25519PrivateKey = None
+
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+
+def _generate_in_process() -> dict[str, str]:
+    private = X25519PrivateKey.generate()
+    private_raw = private.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+    public_raw = private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    # A WireGuard preshared key is 32 random bytes, exactly what `wg genpsk` prints.
+    return {"private_key": _b64(private_raw), "public_key": _b64(public_raw), "preshared_key": _b64(os.urandom(32))}
+
+
+def _generate_with_wg() -> dict[str, str]:
+    private_key = subprocess.check_output(["wg", "genkey"]).decode().strip()
+    public_key = subprocess.check_output(["wg", "pubkey"], input=private_key.encode()).decode().strip()
+    preshared_key = subprocess.check_output(["wg", "genpsk"]).decode().strip()
+    return {"private_key": private_key, "public_key": public_key, "preshared_key": preshared_key}
+
+
+def new_keys() -> dict[str, str]:
+    """A fresh private/public key pair and preshared key; raises if generation fails."""
+    if X25519PrivateKey is not None:
+        return _generate_in_process()
+    return _generate_with_wg()
+
+
+class KeyPool:
+    """Bounded queue of ready key material, topped up by a background thread.
+
+    Peer creation takes from the pool and only generates inline when it is empty, so a burst of
+    onboarding requests does not wait on key generation. Each entry is handed out exactly once.
+    A size of 0 disables the pool.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self._keys: queue.Queue = queue.Queue()
+        self._wanted = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.stats: dict[str, int] = {"hits": 0, "misses": 0, "generated": 0}
+
+    def start(self, size: int) -> None:
+        self.size = max(size, 0)
+        if self.size == 0 or self._thread is not None:
+            return
+        self._keys = queue.Queue(maxsize=self.size)
+        self._stop.clear()
+        self._wanted.set()
+        self._thread = threading.Thread(target=self._fill, name="wg-key-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the refill thread, waiting up to ``timeout`` seconds for the key being generated."""
+        thread, self._thread = self._thread, None
+        self._stop.set()
+        self._wanted.set()
+        if thread is None:
+            return
+        thread.join(timeout)
+        if thread.is_alive():
+            logging.warning(f"Key pool refill did not stop within {timeout}s")
+
+    def _fill(self) -> None:
+        while not self._stop.is_set():
+            self._wanted.wait()
+            self._wanted.clear()
+            while not self._stop.is_set() and not self._keys.full():
+                try:
+                    self._keys.put_nowait(new_keys())
+                    self.stats["generated"] += 1
+                except queue.Full:
+                    break
+                except Exception as e:
+                    logging.error(f"Key pool refill failed: {e}")
+                    break
+
+    def take(self) -> dict[str, str]:
+        try:
+            keys = self._keys.get_nowait()
+            self.stats["hits"] += 1
+        except queue.Empty:
+            keys = new_keys()
+            if self.size:
+                self.stats["misses"] += 1
+        if self.size:
+            self._wanted.set()
+        return keys
+
+    @property
+    def available(self) -> int:
+        return self._keys.qsize()
+
+
+key_pool = KeyPool()
+
+
+def generate_keys():
+    try:
+        return key_pool.take()
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        logging.error(f"Key generation failed: {e}")
+        return None
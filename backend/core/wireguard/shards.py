@@ -0,0 +1,104 @@
+import ipaddress
+import re
+import subprocess
+import zlib
+
+from backend.core.logger import logger as logging
+
+WG_SHARD_MODES = ("subnet", "hash")
+
+
+class WgShards:
+    """Spread peers over several WireGuard interfaces, each with its own UDP port and peer table.
+
+    Shard 0 is the configured interface (``wg0``) and keeps the route for the whole overlay
+    subnet; shard ``i`` is ``wg<i>`` listening on ``base port + i`` with the same key pair.
+    Peers are assigned by address, so a key rotation never moves them:
+
+    * ``subnet``: by address block (``/prefix``), so neighbours share an interface;
+    * ``hash``: by a CRC32 of the address, for an even spread.
+
+    Peers on shards other than 0 get a ``/32`` route to their interface, which wins over the
+    overlay route. With one shard (the default) nothing changes.
+
+    Changing the count, mode, prefix or base port reassigns peers and so invalidates the configs
+    already handed out; ``moved`` tells which peers a stored ``layout`` would move.
+    """
+
+    def __init__(self):
+        self.primary = "wg0"
+        self.base_port = 1194
+        self.count = 1
+        self.mode = "subnet"
+        self.prefix = 24
+
+    def configure(self, primary: str, base_port: int, count: int, mode: str = "subnet", prefix: int = 24) -> None:
+        if mode not in WG_SHARD_MODES:
+            raise ValueError(f"Unknown WireGuard shard mode {mode!r}, expected one of {', '.join(WG_SHARD_MODES)}")
+        self.primary = primary
+        self.base_port = base_port
+        self.count = max(count, 1)
+        self.mode = mode
+        self.prefix = prefix
+
+    @property
+    def layout(self) -> tuple[int, str, int, int]:
+        return (self.count, self.mode, self.prefix, self.base_port)
+
+    def moved(self, layout: tuple[int, str, int, int], addresses: list[str]) -> list[str]:
+        """The addresses whose interface or port under ``layout`` differ from the current ones."""
+        count, mode, prefix, base_port = layout
+        previous = WgShards()
+        previous.configure(self.primary, base_port, count, mode, prefix)
+        return [address for address in addresses
+                if previous.index_for(address) != self.index_for(address)
+                or previous.port_for(address) != self.port_for(address)]
+
+    @property
+    def interfaces(self) -> list[str]:
+        stem = re.sub(r"\d+$", "", self.primary)
+        return [self.primary] + [f"{stem}{i}" for i in range(1, self.count)]
+
+    def index_for(self, address: str) -> int:
+        if self.count == 1:
+            return 0
+        value = int(ipaddress.ip_address(address.split("/")[0]))
+        if self.mode == "subnet":
+            return (value >> (32 - self.prefix)) % self.count
+        return zlib.crc32(value.to_bytes(16, "big")) % self.count
+
+    def interface_for(self, address: str) -> str:
+        return self.interfaces[self.index_for(address)]
+
+    def port_for(self, address: str) -> int:
+        return self.base_port + self.index_for(address)
+
+    def ensure_interfaces(self, private_key_path: str, mtu: str) -> None:
+        """Create the extra shard interfaces if they are missing (shard 0 comes from wg-quick)."""
+        for i, interface in enumerate(self.interfaces[1:], start=1):
+            if subprocess.run(["ip", "link", "show", interface], capture_output=True).returncode != 0:
+                subprocess.run(["ip", "link", "add", interface, "type", "wireguard"], check=True)
+            subprocess.run(["wg", "set", interface, "private-key", private_key_path,
+                            "listen-port", str(self.base_port + i)], check=True)
+            subprocess.run(["ip", "link", "set", interface, "mtu", mtu, "up"], check=True)
+            logging.info(f"WireGuard shard {interface} listening on {self.base_port + i}")
+
+    def _routes(self, verb: str, addresses: list[str]) -> None:
+        commands = []
+        for address in addresses:
+            interface = self.interface_for(address)
+            if interface != self.primary:
+                commands.append(f"route {verb} {address.split('/')[0]}/32 dev {interface}")
+        if commands:
+            # One process for any number of routes; a route already gone is not an error on delete.
+            subprocess.run(["ip", "-force", "-batch", "-"], input="\n".join(commands) + "\n", text=True,
+                           check=verb != "del")
+
+    def route(self, addresses: list[str]) -> None:
+        self._routes("replace", addresses)
+
+    def unroute(self, addresses: list[str]) -> None:
+        self._routes("del", addresses)
+
+
+wg_shards = WgShards()
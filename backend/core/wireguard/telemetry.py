@@ -0,0 +1,111 @@
+import bisect
+import threading
+import time
+from typing import Callable
+
+from backend.core.logger import logger as logging
+from backend.core.wireguard.client import WgPeerDump, wg_client
+
+
+class WgTelemetry:
+    """Per-peer transfer and handshake counters from one ``wg show dump`` per interface and interval.
+
+    A background task (see lifespan) calls ``collect`` every ``interval`` seconds and swaps in a
+    new public-key-indexed snapshot, so readers never parse WireGuard output themselves. When the
+    snapshot is older than ``max_age`` (the task is disabled or late), the next reader collects
+    once on behalf of everyone.
+
+    Peers are also kept sorted by latest handshake; a collection only moves the entries whose
+    handshake changed, and ``idle`` bisects to a cutoff instead of scanning every peer.
+    Collections are serialised by ``_lock`` and swap in the updated index whole, so readers
+    never see one half-moved.
+    """
+
+    def __init__(self):
+        self.interval = 0.0
+        self.interfaces: list[str] = []
+        self.peers: dict[str, WgPeerDump] = {}
+        self.collected_at = 0.0
+        self.handshakes: list[tuple[int, str]] = []
+        self._lock = threading.Lock()
+        # Called with (peers, collected_at) after every collection, e.g. peer_history.record.
+        self.listeners: list[Callable[[dict[str, WgPeerDump], float], None]] = []
+        self.stats: dict[str, float] = {"collections": 0, "errors": 0, "last_seconds": 0.0, "peers": 0}
+
+    def configure(self, interval: float, interfaces: list[str]) -> None:
+        self.interval = interval
+        self.interfaces = list(interfaces)
+
+    @property
+    def max_age(self) -> float:
+        # Twice the period leaves room for a slow dump before readers start collecting.
+        return 2 * self.interval if self.interval > 0 else 1.0
+
+    @property
+    def age(self) -> float | None:
+        return time.time() - self.collected_at if self.collected_at else None
+
+    def collect(self) -> None:
+        with self._lock:
+            self._collect()
+
+    def _collect(self) -> None:
+        started = time.perf_counter()
+        try:
+            peers = {dump.public_key: dump for interface in self.interfaces for dump in wg_client.dump(interface)}
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        self.handshakes = self._index_handshakes(self.peers, peers)
+        self.peers = peers
+        self.collected_at = time.time()
+        self.stats["collections"] += 1
+        self.stats["last_seconds"] = time.perf_counter() - started
+        self.stats["peers"] = len(peers)
+        for listener in self.listeners:
+            try:
+                listener(peers, self.collected_at)
+            except Exception as e:
+                logging.error(f"WireGuard telemetry listener failed: {e}")
+
+    def _index_handshakes(self, old: dict[str, WgPeerDump], new: dict[str, WgPeerDump]) -> list[tuple[int, str]]:
+        """The handshake index for ``new``, updated from the one for ``old`` on a copy."""
+        handshakes = list(self.handshakes)
+        for public_key, dump in old.items():
+            current = new.get(public_key)
+            if current is None or current.last_handshake != dump.last_handshake:
+                i = bisect.bisect_left(handshakes, (dump.last_handshake, public_key))
+                if i < len(handshakes) and handshakes[i] == (dump.last_handshake, public_key):
+                    del handshakes[i]
+        for public_key, dump in new.items():
+            previous = old.get(public_key)
+            if previous is None or previous.last_handshake != dump.last_handshake:
+                bisect.insort(handshakes, (dump.last_handshake, public_key))
+        return handshakes
+
+    def idle(self, seconds: float) -> list[tuple[str, int]]:
+        """Peers whose last handshake is older than ``seconds`` (or never happened), oldest first."""
+        cutoff = int(time.time() - seconds)
+        handshakes = self.handshakes
+        end = bisect.bisect_left(handshakes, (cutoff,))
+        return [(public_key, handshake) for handshake, public_key in handshakes[:end]]
+
+    def refresh(self) -> None:
+        """Collect now if the snapshot is too old to be served."""
+        if self.age is None or self.age > self.max_age:
+            with self._lock:
+                # Another reader may have refreshed while we waited.
+                if self.age is None or self.age > self.max_age:
+                    try:
+                        self._collect()
+                    except Exception as e:
+                        logging.error(f"WireGuard telemetry collection failed: {e}")
+                        if self.age is None:
+                            raise
+
+    def peer(self, public_key: str) -> WgPeerDump | None:
+        self.refresh()
+        return self.peers.get(public_key)
+
+
+wg_telemetry = WgTelemetry()
@@ -1 +1,3 @@
-from backend.db.database import Database
\ No newline at end of file
+from backend.db.database import Database
+from backend.db.intents import IntentStore
+from backend.db.rollups import RollupStore
@@ -0,0 +1,117 @@
+import ipaddress
+from bisect import bisect_right
+from typing import Iterable
+
+
+def address_int(address: str) -> int:
+    """The integer stored in ``peers.address_int`` for a peer address."""
+    return int(ipaddress.ip_address(address))
+
+
+def network_range(subnet: str) -> tuple[int, int]:
+    """The ``subnets.network_start``/``network_end`` integers of a subnet: its first and last address."""
+    network = ipaddress.ip_network(subnet, strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+class FreeRanges:
+    """Free host addresses of one subnet as sorted, disjoint, inclusive [start, end] integer intervals."""
+
+    def __init__(self, network_start: int, network_end: int, used: Iterable[int]):
+        # Like ipaddress.hosts(): the network and broadcast addresses are not handed out, except
+        # in /31 and /32 networks where every address is a host.
+        if network_end - network_start >= 3:
+            self.first, self.last = network_start + 1, network_end - 1
+        else:
+            self.first, self.last = network_start, network_end
+        self.hosts = self.last - self.first + 1
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        position = self.first
+        for address in sorted(set(used)):
+            if address < self.first or address > self.last:
+                continue
+            if address > position:
+                self.starts.append(position)
+                self.ends.append(address - 1)
+            position = address + 1
+        if position <= self.last:
+            self.starts.append(position)
+            self.ends.append(self.last)
+        self.free = sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+
+    def first_free(self) -> int | None:
+        return self.starts[0] if self.starts else None
+
+    def claim(self, address: int) -> None:
+        index = bisect_right(self.starts, address) - 1
+        if index < 0 or self.ends[index] < address:
+            return
+        start, end = self.starts[index], self.ends[index]
+        self.free -= 1
+        if start == end:
+            del self.starts[index], self.ends[index]
+        elif address == start:
+            self.starts[index] = address + 1
+        elif address == end:
+            self.ends[index] = address - 1
+        else:
+            self.ends[index] = address - 1
+            self.starts.insert(index + 1, address + 1)
+            self.ends.insert(index + 1, end)
+
+    def release(self, address: int) -> None:
+        if address < self.first or address > self.last:
+            return
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and self.ends[index] >= address:
+            return
+        self.free += 1
+        joins_left = index >= 0 and self.ends[index] == address - 1
+        joins_right = index + 1 < len(self.starts) and self.starts[index + 1] == address + 1
+        if joins_left and joins_right:
+            self.ends[index] = self.ends[index + 1]
+            del self.starts[index + 1], self.ends[index + 1]
+        elif joins_left:
+            self.ends[index] = address
+        elif joins_right:
+            self.starts[index + 1] = address
+        else:
+            self.starts.insert(index + 1, address)
+            self.ends.insert(index + 1, address)
+
+
+class AddressAllocator:
+    """Free addresses of the subnets peers are allocated from, kept between requests.
+
+    A subnet's free ranges are built from the database the first time it is asked for (after a
+    restart or a rollback, see ``reset``) and then kept in step by the peer writes, so handing
+    out the lowest free address is a lookup instead of a scan of every peer. An address taken or
+    given back is applied to every tracked subnet containing it, nested subnets included.
+    """
+
+    def __init__(self):
+        self.subnets: dict[tuple[int, int], FreeRanges] = {}
+
+    def get(self, network: tuple[int, int]) -> FreeRanges | None:
+        return self.subnets.get(network)
+
+    def track(self, network: tuple[int, int], used: Iterable[int]) -> FreeRanges:
+        ranges = self.subnets[network] = FreeRanges(*network, used)
+        return ranges
+
+    def claim(self, address: int) -> None:
+        for (start, end), ranges in self.subnets.items():
+            if start <= address <= end:
+                ranges.claim(address)
+
+    def release(self, address: int) -> None:
+        for (start, end), ranges in self.subnets.items():
+            if start <= address <= end:
+                ranges.release(address)
+
+    def forget(self, network: tuple[int, int]) -> None:
+        self.subnets.pop(network, None)
+
+    def reset(self) -> None:
+        self.subnets = {}
@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+
+class ConnectionManager:
+    """The SQLite connections of one ``Database``: a single writer and one read-only connection per reader thread.
+
+    All writes go through the writer connection. The thread that starts using it for a write (see
+    ``claim``) keeps reading through it until the transaction is committed or rolled back, so a
+    write sees its own changes. Every other thread reads through a read-only connection of its
+    own, opened on first use: in WAL mode those see the last committed state and run in parallel
+    with each other and with the writer instead of queueing on one shared connection.
+
+    ``cache_size_kib`` and ``mmap_size`` are applied to every connection; with ``readers`` off
+    everything goes through the writer, as before.
+    """
+
+    def __init__(self, db_path: str, cache_size_kib: int = 16384, mmap_size: int = 256 * 1024 * 1024, readers: bool = True):
+        self.db_path = db_path
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.readers = readers
+        self.writer = self._open(sqlite3.connect(db_path, check_same_thread=False))
+        self.writer.execute("PRAGMA foreign_keys = ON")
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self._owner: int | None = None
+        self._local = threading.local()
+        self._opened: list[tuple[threading.Thread, sqlite3.Connection]] = []
+        self._registry = threading.Lock()
+        self.stats: dict[str, int] = {"readers_opened": 0, "readers_closed": 0}
+
+    def _open(self, conn: sqlite3.Connection) -> sqlite3.Connection:
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.row_factory = None
+        return conn
+
+    def claim(self) -> sqlite3.Connection:
+        """The writer connection, for a statement that changes the database (or must see a pending change)."""
+        self._owner = threading.get_ident()
+        return self.writer
+
+    def release(self) -> None:
+        """The write was committed or rolled back: the writing thread reads through a reader again."""
+        self._owner = None
+
+    def current(self) -> sqlite3.Connection:
+        """The connection the calling thread reads through."""
+        if not self.readers or self._owner == threading.get_ident():
+            return self.writer
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open_reader()
+        return conn
+
+    def _open_reader(self) -> sqlite3.Connection:
+        uri = f"file:{pathname2url(self.db_path)}?mode=ro"
+        conn = self._open(sqlite3.connect(uri, uri=True, check_same_thread=False))
+        conn.execute("PRAGMA query_only = ON")
+        with self._registry:
+            # Threadpool workers are long-lived; close what threads that have gone left behind.
+            alive = []
+            for thread, opened in self._opened:
+                if thread.is_alive():
+                    alive.append((thread, opened))
+                else:
+                    opened.close()
+                    self.stats["readers_closed"] += 1
+            alive.append((threading.current_thread(), conn))
+            self._opened = alive
+            self.stats["readers_opened"] += 1
+        return conn
+
+    @property
+    def open_readers(self) -> int:
+        return len(self._opened)
+
+    def close(self) -> None:
+        with self._registry:
+            for _, conn in self._opened:
+                conn.close()
+            self.stats["readers_closed"] += len(self._opened)
+            self._opened = []
+        self.writer.close()
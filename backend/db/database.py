@@ -1,22 +1,36 @@
 import ipaddress, sqlite3
 from backend.core.models import Peer, Subnet, Service
 from backend.core.logger import logger as logging
+from backend.db.allocator import AddressAllocator, address_int, network_range
+from backend.db.connections import ConnectionManager
+from backend.db.graph import TopologyGraph
 
 
 class Database:
-    def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path,check_same_thread=False)
-        self.conn.execute("PRAGMA foreign_keys = ON")
-        self.conn.execute("PRAGMA journal_mode=WAL")
-        self.conn.row_factory = None
+    def __init__(self, db_path, cache_size_kib: int = 16384, mmap_size: int = 256 * 1024 * 1024, read_connections: bool = True):
+        self.connections = ConnectionManager(db_path, cache_size_kib, mmap_size, read_connections)
+        self.allocator = AddressAllocator()
+        self.graph = TopologyGraph(lambda: self.conn)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The connection reads go through: the writer inside this thread's write, otherwise this thread's reader."""
+        return self.connections.current()
+
+    @property
+    def writer(self) -> sqlite3.Connection:
+        """The connection writes go through; the calling thread keeps reading through it until commit or rollback."""
+        return self.connections.claim()
 
     def clear_database(self):
         """
         This function clears the entire database.
         """
         try:
-            self.conn.execute("DELETE FROM subnets")
-            self.conn.execute("DELETE FROM peers")
+            self.writer.execute("DELETE FROM subnets")
+            self.writer.execute("DELETE FROM peers")
+            self.allocator.reset()
+            self.graph.clear()
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while clearing database: {e}")
 
@@ -26,7 +40,7 @@ class Database:
         It will raise an error if the database operation fails.
         """
         try:
-            self.conn.execute("BEGIN")
+            self.writer.execute("BEGIN")
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while starting transaction: {e}")
 
@@ -36,7 +50,8 @@ class Database:
         It will raise an error if the database operation fails.
         """
         try:
-            self.conn.commit()
+            self.writer.commit()
+            self.connections.release()
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while committing transaction: {e}")
 
@@ -46,12 +61,49 @@ class Database:
         It will raise an error if the database operation fails.
         """
         try:
-            self.conn.rollback()
+            self.writer.rollback()
+            self.connections.release()
+            # The free addresses and the graph may include changes that were just undone: rebuild them on demand.
+            self.allocator.reset()
+            self.graph.invalidate()
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while rolling back transaction: {e}")
-        
+
+    def savepoint(self, name: str):
+        """
+        This function opens a savepoint inside the current transaction, so that the changes made after it can be undone alone.
+        It will raise an error if the database operation fails.
+        """
+        try:
+            self.writer.execute(f"SAVEPOINT {name}")
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while creating savepoint: {e}")
+
+    def release_savepoint(self, name: str):
+        """
+        This function keeps the changes made since the savepoint as part of the enclosing transaction.
+        It will raise an error if the database operation fails.
+        """
+        try:
+            self.writer.execute(f"RELEASE SAVEPOINT {name}")
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while releasing savepoint: {e}")
+
+    def rollback_to_savepoint(self, name: str):
+        """
+        This function undoes the changes made since the savepoint, leaving the rest of the transaction untouched.
+        It will raise an error if the database operation fails.
+        """
+        try:
+            self.writer.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            self.writer.execute(f"RELEASE SAVEPOINT {name}")
+            self.allocator.reset()
+            self.graph.invalidate()
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while rolling back to savepoint: {e}")
+
     def close(self):
-        self.conn.close()
+        self.connections.close()
 
     def create_peer(self,peer:Peer):
         """
@@ -59,10 +111,12 @@ class Database:
         The fuction returns nothing, but will raise an error if the database operation fails.
         """
         try:
-            self.conn.execute("""
-                INSERT INTO peers (username, public_key, preshared_key, address, x, y)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (peer.username, peer.public_key, peer.preshared_key, peer.address, peer.x, peer.y))
+            cur = self.writer.execute("""
+                INSERT INTO peers (username, public_key, preshared_key, address, address_int, x, y)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (peer.username, peer.public_key, peer.preshared_key, peer.address, address_int(peer.address), peer.x, peer.y))
+            self.allocator.claim(address_int(peer.address))
+            self.graph.add_peer(cur.lastrowid, peer)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while creating peer: {e}")
 
@@ -75,9 +129,13 @@ class Database:
         The function returns nothing, but will raise an error if the database operation fails.
         """
         try:
-            self.conn.execute("""
+            row = self.writer.execute("SELECT address_int FROM peers WHERE public_key = ?", (peer.public_key,)).fetchone()
+            self.writer.execute("""
                 DELETE FROM peers WHERE public_key = ?
             """, (peer.public_key,))
+            if row is not None:
+                self.allocator.release(row[0])
+            self.graph.remove_peer(peer.public_key)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing peer: {e}")
         
@@ -87,11 +145,16 @@ class Database:
         The function returns nothing, but will raise an error if the database operation fails.
         """
         try:
-            self.conn.execute("""
+            row = self.writer.execute("SELECT address_int FROM peers WHERE username = ?", (peer.username,)).fetchone()
+            self.writer.execute("""
                 UPDATE peers
-                SET username = ?, public_key = ?, preshared_key = ?, address = ?, x = ?, y = ?
+                SET username = ?, public_key = ?, preshared_key = ?, address = ?, address_int = ?, x = ?, y = ?
                 WHERE username = ?
-            """, (peer.username, peer.public_key, peer.preshared_key, peer.address, peer.x, peer.y, peer.username))
+            """, (peer.username, peer.public_key, peer.preshared_key, peer.address, address_int(peer.address), peer.x, peer.y, peer.username))
+            if row is not None and row[0] != address_int(peer.address):
+                self.allocator.release(row[0])
+                self.allocator.claim(address_int(peer.address))
+            self.graph.update_peer(peer)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while updating peer: {e}")
         
@@ -103,11 +166,12 @@ class Database:
         The function returns nothing, but will raise an error if the database operation fails.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 UPDATE peers
                 SET x = ?, y = ?
                 WHERE public_key = ?
             """, (peer.x, peer.y, peer.public_key))
+            self.graph.move_peer(peer)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while updating peer coordinates: {e}")
 
@@ -115,22 +179,32 @@ class Database:
         """
         Returns a list of all peers in the database.
         """
-        peers = []
         try:
-            cur = self.conn.execute("""
-                SELECT username, public_key, preshared_key, address, x, y
-                FROM peers
-            """)
-            peers_rows = cur.fetchall()
-            for row in peers_rows:
-                peers.append(Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5]))
-            for peer in peers:
-                hosted_services = self.get_services_by_host(peer)
-                peer.services.update({service.name: service for service in hosted_services})
-
+            return self._get_peers_with_services()
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting all peers: {e}")
-        return peers
+
+    def _get_peers_with_services(self, where: str = "", params: tuple = ()) -> list[Peer]:
+        """
+        Loads the peers matching ``where`` together with the services they host, in a single query:
+        one row per (peer, hosted service), grouped back into Peer objects here.
+        """
+        peers: dict[str, Peer] = {}
+        cur = self.conn.execute(f"""
+            SELECT p.username, p.public_key, p.preshared_key, p.address, p.x, p.y,
+                   s.name, s.department, s.port, s.description, s.protocol
+            FROM peers p
+            LEFT JOIN services s ON s.id = p.id
+            {where}
+            ORDER BY p.id
+        """, params)
+        for row in cur.fetchall():
+            peer = peers.get(row[1])
+            if peer is None:
+                peer = peers[row[1]] = Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5])
+            if row[6] is not None:
+                peer.services[row[6]] = Service(name=row[6], department=row[7], port=row[8], description=row[9], protocol=row[10])
+        return list(peers.values())
     
     def get_avaliable_ip(self, subnet: Subnet) -> str|None:
         """
@@ -138,21 +212,39 @@ class Database:
         It will return the first available IP address that is not already in use.
         """
         try:
-            cur = self.conn.execute("""
-                SELECT address FROM peers
-            """)
-            all_addresses = [row[0] for row in cur.fetchall()]
-            net = ipaddress.ip_network(subnet.subnet, strict=False)
-            used_ips = {ip for ip in all_addresses if ipaddress.ip_address(ip) in net}
-
-            for ip in net.hosts():
-                if str(ip) not in used_ips:
-                    return str(ip)
+            address = self._free_ranges(subnet).first_free()
+            if address is not None:
+                return str(ipaddress.ip_address(address))
             logging.warning(f"No available IPs found in subnet {subnet.subnet}")
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting available IP: {e}")
         return None
 
+    def get_subnet_utilization(self, subnet: Subnet) -> dict[str, int | float]:
+        """
+        This function returns how many host addresses the subnet has, how many are taken by peers and how many are free.
+        """
+        try:
+            ranges = self._free_ranges(subnet)
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting subnet utilization: {e}")
+        used = ranges.hosts - ranges.free
+        return {"hosts": ranges.hosts, "used": used, "free": ranges.free,
+                "utilization": round(used / ranges.hosts, 4) if ranges.hosts else 1.0}
+
+    def _free_ranges(self, subnet: Subnet):
+        """
+        The allocator's free ranges of the subnet, built from the addresses of the peers inside it on first use.
+        """
+        network = network_range(subnet.subnet)
+        ranges = self.allocator.get(network)
+        if ranges is None:
+            cur = self.conn.execute("""
+                SELECT address_int FROM peers WHERE address_int BETWEEN ? AND ?
+            """, network)
+            ranges = self.allocator.track(network, [row[0] for row in cur.fetchall()])
+        return ranges
+
     def is_ip_in_subnet(self, ip: str, subnet: Subnet) -> bool:
         """
         This function checks if an IP address is in a given subnet.
@@ -201,10 +293,11 @@ class Database:
         This function creates an entry in the database for this specific subnet.
         """
         try:
-            self.conn.execute("""
-                INSERT INTO subnets (name, subnet, description, x, y, width, height, rgba)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (subnet.name,subnet.subnet,subnet.description,subnet.x,subnet.y,subnet.width,subnet.height,subnet.rgba))
+            self.writer.execute("""
+                INSERT INTO subnets (name, subnet, network_start, network_end, description, x, y, width, height, rgba)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (subnet.name,subnet.subnet,*network_range(subnet.subnet),subnet.description,subnet.x,subnet.y,subnet.width,subnet.height,subnet.rgba))
+            self.graph.add_subnet(subnet)
             logging.info(f"Created subnet {subnet} in database.")
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while creating subnet: {e}")
@@ -216,9 +309,11 @@ class Database:
         This function deletes a subnet from the database.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM subnets WHERE subnet = ?
             """, (subnet.subnet,))
+            self.allocator.forget(network_range(subnet.subnet))
+            self.graph.remove_subnet(subnet.subnet)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while deleting subnet: {e}")
         return
@@ -229,11 +324,12 @@ class Database:
         The function returns nothing, but will raise an error if the database operation fails.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 UPDATE subnets
                 SET x = ?, y = ?, width = ?, height = ?, rgba = ?
                 WHERE subnet = ?
             """, (subnet.x, subnet.y, subnet.width, subnet.height, subnet.rgba, subnet.subnet))
+            self.graph.update_subnet(subnet)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while updating subnet coordinates, size and color: {e}")
         return
@@ -244,16 +340,9 @@ class Database:
         If the peer does not exist, it will return None.
         """
         try:
-            cur = self.conn.execute("""
-                SELECT username, public_key, preshared_key, address, x, y
-                FROM peers WHERE username = ?
-            """, (username,))
-            row = cur.fetchone()
-            if row:
-                peer = Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5])
-                hosted_services = self.get_services_by_host(peer)
-                peer.services.update({service.name: service for service in hosted_services})
-                return peer
+            peers = self._get_peers_with_services("WHERE p.username = ?", (username,))
+            if peers:
+                return peers[0]
 
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting peer by username: {e}")
@@ -265,16 +354,9 @@ class Database:
         If the peer does not exist, it will return None.
         """
         try:
-            cur = self.conn.execute("""
-                SELECT username, public_key, preshared_key, address, x, y
-                FROM peers WHERE address = ?
-            """, (address,))
-            row = cur.fetchone()
-            if row:
-                peer = Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5])
-                hosted_services = self.get_services_by_host(peer)
-                peer.services.update({service.name: service for service in hosted_services})
-                return peer
+            peers = self._get_peers_with_services("WHERE p.address = ?", (address,))
+            if peers:
+                return peers[0]
 
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting peer by address: {e}")
@@ -315,6 +397,42 @@ class Database:
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting subnet by address: {e}")
         return None
+
+    def get_subnets_nested_in(self, subnet: Subnet) -> list[Subnet]:
+        """
+        This function returns the subnets whose address range lies inside the given subnet, the subnet itself excluded.
+        """
+        try:
+            start, end = network_range(subnet.subnet)
+            cur = self.conn.execute("""
+                SELECT subnet, name, description, x, y, width, height, rgba
+                FROM subnets
+                WHERE network_start BETWEEN ? AND ? AND network_end <= ? AND subnet != ?
+                ORDER BY rowid
+            """, (start, end, end, subnet.subnet))
+            return [Subnet(subnet=row[0], name=row[1], description=row[2], x=row[3], y=row[4], width=row[5], height=row[6], rgba=row[7])
+                    for row in cur.fetchall()]
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting nested subnets: {e}")
+
+    def get_addresses_in_subnets(self) -> dict[str, list[str]]:
+        """
+        This function returns, for every subnet, the addresses of the peers that fall inside its range.
+        Subnets without peers are left out.
+        """
+        addresses: dict[str, list[str]] = {}
+        try:
+            cur = self.conn.execute("""
+                SELECT s.subnet, p.address
+                FROM subnets s
+                JOIN peers p ON p.address_int BETWEEN s.network_start AND s.network_end
+                ORDER BY p.id
+            """)
+            for row in cur.fetchall():
+                addresses.setdefault(row[0], []).append(row[1])
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting addresses in subnets: {e}")
+        return addresses
     
 
     def add_link_from_peer_to_subnet(self, peer: Peer, subnet: Subnet):
@@ -323,11 +441,12 @@ class Database:
         It will create the entry in the peer_subnets table, which is a many-to-many relationship between peers and subnets.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO peers_subnets (peer_id, subnet)
                 VALUES ((SELECT id FROM peers WHERE public_key = ?), ?)
                 ON CONFLICT(peer_id, subnet) DO NOTHING
             """, (peer.public_key, subnet.subnet))
+            self.graph.add_link("peers_subnets", (self.graph.peer_id(peer.public_key), subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding link from peer to subnet: {e}")
         return
@@ -338,9 +457,10 @@ class Database:
         It will delete the entry in the peer_subnets table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM peers_subnets WHERE peer_id = (SELECT id FROM peers WHERE public_key = ?) AND subnet = ?
             """, (peer.public_key, subnet.subnet))
+            self.graph.remove_links("peers_subnets", (self.graph.peer_id(peer.public_key), subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing link from peer to subnet: {e}")
         return
@@ -350,13 +470,15 @@ class Database:
         This function returns a list of subnets that a peer is part of.
         """
         try:
-            subnets = self.get_all_subnets()
-            peer_subnets = []
-            for subnet in subnets:
-                peer_ip_address = ipaddress.ip_address(peer.address)
-                if peer_ip_address in ipaddress.ip_network(subnet.subnet, strict=False):
-                    peer_subnets.append(subnet)
-            return peer_subnets
+            position = address_int(peer.address)
+            cur = self.conn.execute("""
+                SELECT subnet, name, description, x, y, width, height, rgba
+                FROM subnets
+                WHERE network_start <= ? AND network_end >= ?
+                ORDER BY rowid
+            """, (position, position))
+            return [Subnet(subnet=row[0], name=row[1], description=row[2], x=row[3], y=row[4], width=row[5], height=row[6], rgba=row[7])
+                    for row in cur.fetchall()]
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting peers subnet: {e}")
         return None
@@ -387,22 +509,8 @@ class Database:
         This function returns a list of peers in a subnet.
         It will return a list of Peer objects.
         """
-        peers = []
         try:
-            cur = self.conn.execute("""
-                SELECT username, public_key, preshared_key, address, x, y
-                FROM peers
-            """)
-            peers_rows = cur.fetchall()
-            for row in peers_rows:
-                peer = Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5])
-                address = row[3]
-                address_ip = ipaddress.ip_address(address)
-                if address_ip in ipaddress.ip_network(subnet.subnet, strict=False):
-                    hosted_services = self.get_services_by_host(peer)
-                    peer.services.update({service.name: service for service in hosted_services})
-                    if peer not in peers:
-                        peers.append(peer)
+            peers = self._get_peers_with_services("WHERE p.address_int BETWEEN ? AND ?", network_range(subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting peers in subnet: {e}")
         return peers
@@ -415,18 +523,14 @@ class Database:
         services = []
         try:
             cur = self.conn.execute("""
-                SELECT p.username, p.public_key, p.preshared_key, p.address, p.x, p.y
-                FROM peers p
-                JOIN services s ON p.id = s.id
-            """)
-            services_rows = cur.fetchall()
-            for row in services_rows:
-                address = row[3]
-                address_ip = ipaddress.ip_address(address)
-                if address_ip in ipaddress.ip_network(subnet.subnet, strict=False):
-                    host = Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5])
-                    hosted_services = self.get_services_by_host(host)
-                    services.extend(hosted_services)
+                SELECT s.name, s.department, s.port, s.description, s.protocol
+                FROM services s
+                JOIN peers p ON p.id = s.id
+                WHERE p.address_int BETWEEN ? AND ?
+                ORDER BY p.id
+            """, network_range(subnet.subnet))
+            for row in cur.fetchall():
+                services.append(Service(name=row[0], department=row[1], port=row[2], description=row[3], protocol=row[4]))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting services in subnet: {e}")
         return services
@@ -457,7 +561,7 @@ class Database:
         """
         try:
             # Check that the peer exists
-            cur = self.conn.execute("""
+            cur = self.writer.execute("""
                 SELECT id FROM peers WHERE public_key = ?
             """, (peer.public_key,))
             row = cur.fetchone()
@@ -466,10 +570,11 @@ class Database:
             peer_id = row[0]
 
             # Insert into services table using the same ID
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO services (id, name, department, port, description, protocol)
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (peer_id, service.name, service.department, service.port, service.description, service.protocol))
+            self.graph.add_service(peer_id, service)
 
             return service.name
 
@@ -482,11 +587,12 @@ class Database:
         It will create the entry in the peers_services table, which is a many-to-many relationship between peers and services.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO peers_services (peer_id, service_id, service_port)
                 VALUES ((SELECT id FROM peers WHERE public_key = ?), (SELECT id FROM services WHERE name = ?), ?)
                 ON CONFLICT(peer_id, service_id, service_port) DO NOTHING
             """, (peer.public_key, service.name, service.port))
+            self.graph.add_link("peers_services", (self.graph.peer_id(peer.public_key), self.graph.service_id(service.name), service.port))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding link from peer {peer} to service {service}: {e}")
 
@@ -496,9 +602,10 @@ class Database:
         It will delete the entry in the peer_services table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM peers_services WHERE peer_id = (SELECT id FROM peers WHERE public_key = ?) AND service_id = (SELECT id FROM services WHERE name = ?) AND service_port = ?
             """, (peer.public_key, service.name, service.port))
+            self.graph.remove_links("peers_services", (self.graph.peer_id(peer.public_key), self.graph.service_id(service.name), service.port))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing link from peer to service: {e}")
 
@@ -507,9 +614,10 @@ class Database:
         This function deletes a service from the database.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM services WHERE name = ? AND port = ?
             """, (service.name, service.port))
+            self.graph.remove_service(service.name, service.port)
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while deleting service: {e}")
 
@@ -590,6 +698,23 @@ class Database:
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting service host: {e}")
         return None
+
+    def get_service_hosts(self) -> dict[str, Peer]:
+        """
+        This function returns a dictionary with the service name as key and the Peer hosting it as value.
+        """
+        hosts = {}
+        try:
+            cur = self.conn.execute("""
+                SELECT s.name, p.username, p.public_key, p.preshared_key, p.address, p.x, p.y
+                FROM services s
+                JOIN peers p ON p.id = s.id
+            """)
+            for row in cur.fetchall():
+                hosts[row[0]] = Peer(username=row[1], public_key=row[2], preshared_key=row[3], address=row[4], x=row[5], y=row[6])
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting service hosts: {e}")
+        return hosts
     
     def get_services_by_host(self, peer:Peer) -> list[Service]:
         """
@@ -658,10 +783,11 @@ class Database:
         It will create the entry in the links table, which is a many-to-many relationship between peers.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO peers_peers (peer_one_id, peer_two_id)
                 VALUES ((SELECT id FROM peers WHERE public_key = ?), (SELECT id FROM peers WHERE public_key = ?))
             """, (peer1.public_key, peer2.public_key))
+            self.graph.add_link("peers_peers", (self.graph.peer_id(peer1.public_key), self.graph.peer_id(peer2.public_key)))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding link between peers: {e}")
 
@@ -670,11 +796,13 @@ class Database:
         Remove an undirected link between two peers (order-agnostic).
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM peers_peers 
                 WHERE (peer_one_id = (SELECT id FROM peers WHERE public_key = ?) AND peer_two_id = (SELECT id FROM peers WHERE public_key = ?))
                    OR (peer_one_id = (SELECT id FROM peers WHERE public_key = ?) AND peer_two_id = (SELECT id FROM peers WHERE public_key = ?))
             """, (peer1.public_key, peer2.public_key, peer2.public_key, peer1.public_key))
+            one, two = self.graph.peer_id(peer1.public_key), self.graph.peer_id(peer2.public_key)
+            self.graph.remove_links("peers_peers", (one, two), (two, one))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing link between peers: {e}")
 
@@ -756,11 +884,12 @@ class Database:
         It will create the entry in the subnets_subnets table, which is a many-to-many relationship between subnets.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO subnets_subnets (subnet_one, subnet_two)
                 VALUES (?, ?)
                 ON CONFLICT(subnet_one, subnet_two) DO NOTHING
             """, (subnet1.subnet, subnet2.subnet))
+            self.graph.add_link("subnets_subnets", (subnet1.subnet, subnet2.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding link between subnets: {e}")
         
@@ -770,11 +899,12 @@ class Database:
         It will delete the entry in the subnets_subnets table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM subnets_subnets 
                 WHERE (subnet_one = ? AND subnet_two = ?)
                    OR (subnet_one = ? AND subnet_two = ?)
             """, (subnet1.subnet, subnet2.subnet, subnet2.subnet, subnet1.subnet))
+            self.graph.remove_links("subnets_subnets", (subnet1.subnet, subnet2.subnet), (subnet2.subnet, subnet1.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing link between subnets: {e}")
         
@@ -830,11 +960,12 @@ class Database:
         It will create the entry in the subnets_services table, which is a many-to-many relationship between subnets and services.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO subnets_services (subnet, service_id, service_port)
                 VALUES (?, (SELECT id FROM services WHERE name = ?), ?)
                 ON CONFLICT(subnet, service_id, service_port) DO NOTHING
             """, (subnet.subnet, service.name, service.port))
+            self.graph.add_link("subnets_services", (self.graph.service_id(service.name), service.port, subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding link from subnet to service: {e}")
         
@@ -844,9 +975,10 @@ class Database:
         It will delete the entry in the subnets_services table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM subnets_services WHERE subnet = ? AND service_id = (SELECT id FROM services WHERE name = ?) AND service_port = ?
             """, (subnet.subnet, service.name, service.port))
+            self.graph.remove_links("subnets_services", (self.graph.service_id(service.name), service.port, subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing link from subnet to service: {e}")
     
@@ -883,11 +1015,12 @@ class Database:
         It will create the entry in the admin_peers_subnets table, which is a many-to-many relationship between admin peers and subnets.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO admin_peers_subnets (peer_id, subnet)
                 VALUES ((SELECT id FROM peers WHERE public_key = ?), ?)
                 ON CONFLICT(peer_id, subnet) DO NOTHING
             """, (peer.public_key, subnet.subnet))
+            self.graph.add_link("admin_peers_subnets", (self.graph.peer_id(peer.public_key), subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding admin link from peer to subnet: {e}")
         return
@@ -898,9 +1031,10 @@ class Database:
         It will delete the entry in the admin_peers_subnets table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM admin_peers_subnets WHERE peer_id = (SELECT id FROM peers WHERE public_key = ?) AND subnet = ?
             """, (peer.public_key, subnet.subnet))
+            self.graph.remove_links("admin_peers_subnets", (self.graph.peer_id(peer.public_key), subnet.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing admin link from peer to subnet: {e}")
         return
@@ -935,11 +1069,12 @@ class Database:
         It will create the entry in the admin_subnets_subnets table, which is a many-to-many relationship between admin subnets.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO admin_subnets_subnets (subnet_one, subnet_two)
                 VALUES (?, ?)
                 ON CONFLICT(subnet_one, subnet_two) DO NOTHING
             """, (subnet1.subnet, subnet2.subnet))
+            self.graph.add_link("admin_subnets_subnets", (subnet1.subnet, subnet2.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding admin link between subnets: {e}")
 
@@ -949,9 +1084,10 @@ class Database:
         It will delete the entry in the admin_subnets_subnets table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM admin_subnets_subnets WHERE subnet_one = ? AND subnet_two = ?
             """, (subnet1.subnet, subnet2.subnet))
+            self.graph.remove_links("admin_subnets_subnets", (subnet1.subnet, subnet2.subnet))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing admin link between subnets: {e}")
         
@@ -986,11 +1122,12 @@ class Database:
         It will create the entry in the admin_peers_peers table, which is a many-to-many relationship between admin peers.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 INSERT INTO admin_peers_peers (peer_one_id, peer_two_id)
                 VALUES ((SELECT id FROM peers WHERE public_key = ?), (SELECT id FROM peers WHERE public_key = ?))
                 ON CONFLICT(peer_one_id, peer_two_id) DO NOTHING
             """, (peer1.public_key, peer2.public_key))
+            self.graph.add_link("admin_peers_peers", (self.graph.peer_id(peer1.public_key), self.graph.peer_id(peer2.public_key)))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while adding admin link between peers: {e}")
         
@@ -1000,11 +1137,13 @@ class Database:
         It will delete the entry in the admin_peers_peers table.
         """
         try:
-            self.conn.execute("""
+            self.writer.execute("""
                 DELETE FROM admin_peers_peers 
                 WHERE (peer_one_id = (SELECT id FROM peers WHERE public_key = ?) AND peer_two_id = (SELECT id FROM peers WHERE public_key = ?))
                    OR (peer_one_id = (SELECT id FROM peers WHERE public_key = ?) AND peer_two_id = (SELECT id FROM peers WHERE public_key = ?))
             """, (peer1.public_key, peer2.public_key, peer2.public_key, peer1.public_key))
+            one, two = self.graph.peer_id(peer1.public_key), self.graph.peer_id(peer2.public_key)
+            self.graph.remove_links("admin_peers_peers", (one, two), (two, one))
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while removing admin link between peers: {e}")
         
@@ -1032,3 +1171,22 @@ class Database:
         except sqlite3.Error as e:
             raise Exception(f"An error occurred while getting admin links between peers: {e}")
         return links
+
+    def get_peers_by_public_keys(self, public_keys: list[str]) -> dict[str, Peer]:
+        """
+        This function returns a dictionary with the public key as key and the Peer as value, for the given public keys that exist.
+        """
+        peers = {}
+        try:
+            for i in range(0, len(public_keys), 500):
+                chunk = public_keys[i:i + 500]
+                placeholders = ", ".join("?" for _ in chunk)
+                cur = self.conn.execute(f"""
+                    SELECT username, public_key, preshared_key, address, x, y
+                    FROM peers WHERE public_key IN ({placeholders})
+                """, chunk)
+                for row in cur.fetchall():
+                    peers[row[1]] = Peer(username=row[0], public_key=row[1], preshared_key=row[2], address=row[3], x=row[4], y=row[5])
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting peers by public keys: {e}")
+        return peers
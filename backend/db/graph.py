@@ -0,0 +1,439 @@
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Callable
+
+from pydantic import BaseModel
+
+from backend.core.models import Peer, Service, Subnet, Topology
+from backend.db.allocator import address_int, network_range
+
+# The link tables, their columns and what each column refers to: a peer id, a subnet address, or
+# a service as its host peer id ("service") followed by its port ("port"). Rows are kept exactly
+# as SQLite stores them, so deletes cascade the way the foreign keys do.
+LINK_TABLES: dict[str, tuple[tuple[str, str], ...]] = {
+    "peers_subnets": (("peer_id", "peer"), ("subnet", "subnet")),
+    "peers_services": (("peer_id", "peer"), ("service_id", "service"), ("service_port", "port")),
+    "peers_peers": (("peer_one_id", "peer"), ("peer_two_id", "peer")),
+    "subnets_subnets": (("subnet_one", "subnet"), ("subnet_two", "subnet")),
+    "subnets_services": (("service_id", "service"), ("service_port", "port"), ("subnet", "subnet")),
+    "admin_subnets_subnets": (("subnet_one", "subnet"), ("subnet_two", "subnet")),
+    "admin_peers_peers": (("peer_one_id", "peer"), ("peer_two_id", "peer")),
+    "admin_peers_subnets": (("peer_id", "peer"), ("subnet", "subnet")),
+}
+
+
+def _bare(peer: Peer) -> Peer:
+    """A peer as the link queries return it: the peers row only, no services or telemetry."""
+    return Peer(username=peer.username, public_key=peer.public_key, preshared_key=peer.preshared_key,
+                address=peer.address, x=peer.x, y=peer.y)
+
+
+class _State:
+    """One copy of the topology tables, plus the views computed from it since the last write."""
+
+    def __init__(self):
+        self.peers: dict[int, Peer] = {}
+        self.positions: dict[int, int] = {}
+        # (address, peer id), sorted: the peers of a subnet are one bisected slice.
+        self.by_address: list[tuple[int, int]] = []
+        self.by_key: dict[str, int] = {}
+        self.by_username: dict[str, int] = {}
+        self.subnets: dict[str, Subnet] = {}
+        self.ranges: dict[str, tuple[int, int]] = {}
+        # Subnets by range, with their rank in database order, to find those containing an address.
+        self.by_range: dict[tuple[int, int], dict[str, int]] = {}
+        self.ranked = 0
+        self.services: dict[tuple[int, int], Service] = {}
+        self.by_name: dict[str, tuple[int, int]] = {}
+        # dicts used as insertion-ordered sets of rows
+        self.links: dict[str, dict[tuple, None]] = {table: {} for table in LINK_TABLES}
+        self.views: dict[str, Any] = {}
+
+
+class TopologyGraph:
+    """Subnets, peers, services and the eight link tables, kept in memory in front of SQLite.
+
+    The graph is loaded from the database the first time it is read and then written through:
+    every ``Database`` mutation applies the same change here, right after its statement, inside
+    the write-lock section that runs it. Reads are served from memory, and the views they need
+    (peers with their services, the link dictionaries, the whole ``Topology``) are computed once
+    per write and shared until the next one, so callers must treat what they get as read-only.
+    A rolled back transaction or savepoint drops the graph; the next read loads it again.
+
+    ``check`` compares every view with what the SQL getters return, to catch a mutation that
+    is not mirrored here.
+    """
+
+    def __init__(self, connection: Callable[[], sqlite3.Connection]):
+        self.connection = connection
+        self._state: _State | None = None
+        self._loading = threading.Lock()
+        self.stats: dict[str, int | float] = {
+            "hits": 0, "misses": 0, "writes": 0, "rebuilds": 0, "invalidations": 0,
+            "checks": 0, "mismatches": 0, "last_rebuild_seconds": 0.0, "rebuild_seconds": 0.0,
+        }
+
+    # --- loading ---
+
+    def _current(self) -> _State:
+        state = self._state
+        if state is not None:
+            self.stats["hits"] += 1
+            return state
+        with self._loading:
+            if self._state is None:
+                self.stats["misses"] += 1
+                self._state = self._load()
+            return self._state
+
+    def _load(self) -> _State:
+        started = time.perf_counter()
+        conn = self.connection()
+        state = _State()
+        for row in conn.execute("SELECT id, username, public_key, preshared_key, address, x, y FROM peers ORDER BY id"):
+            self._put_peer(state, row[0], Peer(username=row[1], public_key=row[2], preshared_key=row[3], address=row[4], x=row[5], y=row[6]))
+        for row in conn.execute("SELECT subnet, name, description, x, y, width, height, rgba FROM subnets ORDER BY rowid"):
+            self._put_subnet(state, Subnet(subnet=row[0], name=row[1], description=row[2], x=row[3], y=row[4], width=row[5], height=row[6], rgba=row[7]))
+        for row in conn.execute("SELECT id, name, department, port, description, protocol FROM services ORDER BY rowid"):
+            self._put_service(state, row[0], Service(name=row[1], department=row[2], port=row[3], description=row[4], protocol=row[5]))
+        for table, columns in LINK_TABLES.items():
+            names = ", ".join(column for column, _ in columns)
+            state.links[table] = dict.fromkeys(tuple(row) for row in conn.execute(f"SELECT {names} FROM {table} ORDER BY rowid"))
+        elapsed = time.perf_counter() - started
+        self.stats["rebuilds"] += 1
+        self.stats["last_rebuild_seconds"] = elapsed
+        self.stats["rebuild_seconds"] += elapsed
+        return state
+
+    def invalidate(self) -> None:
+        """Forget the graph, e.g. after a rollback; the next read loads it from the database."""
+        if self._state is not None:
+            self.stats["invalidations"] += 1
+        self._state = None
+
+    def clear(self) -> None:
+        """The database was emptied: the graph is known to be empty too."""
+        self._state = _State()
+
+    # --- write-through, called by Database after each statement succeeded ---
+
+    def _writing(self) -> _State | None:
+        state = self._state
+        if state is not None:
+            self.stats["writes"] += 1
+            state.views = {}
+        return state
+
+    def peer_id(self, public_key: str) -> int | None:
+        state = self._state
+        return state.by_key.get(public_key) if state is not None else None
+
+    def service_id(self, name: str) -> int | None:
+        state = self._state
+        key = state.by_name.get(name) if state is not None else None
+        return key[0] if key is not None else None
+
+    def add_peer(self, peer_id: int, peer: Peer) -> None:
+        if (state := self._writing()) is not None:
+            self._put_peer(state, peer_id, _bare(peer))
+
+    def update_peer(self, peer: Peer) -> None:
+        if (state := self._writing()) is None or (peer_id := state.by_username.get(peer.username)) is None:
+            return
+        del state.by_key[state.peers[peer_id].public_key]
+        self._put_peer(state, peer_id, _bare(peer))
+
+    def move_peer(self, peer: Peer) -> None:
+        if (state := self._writing()) is None or (peer_id := state.by_key.get(peer.public_key)) is None:
+            return
+        state.peers[peer_id] = state.peers[peer_id].model_copy(update={"x": peer.x, "y": peer.y})
+
+    def remove_peer(self, public_key: str) -> None:
+        if (state := self._writing()) is None or (peer_id := state.by_key.pop(public_key, None)) is None:
+            return
+        del state.by_username[state.peers.pop(peer_id).username]
+        _discard_sorted(state.by_address, (state.positions.pop(peer_id), peer_id))
+        for key in [key for key in state.services if key[0] == peer_id]:
+            del state.by_name[state.services.pop(key).name]
+        self._cascade(state, lambda role, value: role in ("peer", "service") and value == peer_id)
+
+    def add_subnet(self, subnet: Subnet) -> None:
+        if (state := self._writing()) is not None:
+            self._put_subnet(state, subnet.model_copy())
+
+    def update_subnet(self, subnet: Subnet) -> None:
+        if (state := self._writing()) is None or subnet.subnet not in state.subnets:
+            return
+        state.subnets[subnet.subnet] = state.subnets[subnet.subnet].model_copy(
+            update={"x": subnet.x, "y": subnet.y, "width": subnet.width, "height": subnet.height, "rgba": subnet.rgba})
+
+    def remove_subnet(self, subnet: str) -> None:
+        if (state := self._writing()) is None or state.subnets.pop(subnet, None) is None:
+            return
+        network = state.ranges.pop(subnet)
+        named = state.by_range[network]
+        del named[subnet]
+        if not named:
+            del state.by_range[network]
+        self._cascade(state, lambda role, value: role == "subnet" and value == subnet)
+
+    def add_service(self, peer_id: int, service: Service) -> None:
+        if (state := self._writing()) is not None:
+            self._put_service(state, peer_id, service.model_copy())
+
+    def remove_service(self, name: str, port: int) -> None:
+        if (state := self._writing()) is None or (key := state.by_name.get(name)) is None or key[1] != port:
+            return
+        del state.by_name[name]
+        del state.services[key]
+        for table, columns in LINK_TABLES.items():
+            roles = [role for _, role in columns]
+            if "service" not in roles:
+                continue
+            at = roles.index("service")
+            rows = state.links[table]
+            for row in [row for row in rows if (row[at], row[at + 1]) == key]:
+                del rows[row]
+
+    def add_link(self, table: str, row: tuple) -> None:
+        if (state := self._writing()) is not None:
+            state.links[table][row] = None
+
+    def remove_links(self, table: str, *rows: tuple) -> None:
+        if (state := self._writing()) is not None:
+            for row in rows:
+                state.links[table].pop(row, None)
+
+    @staticmethod
+    def _put_peer(state: _State, peer_id: int, peer: Peer) -> None:
+        state.peers[peer_id] = peer
+        previous = state.positions.get(peer_id)
+        if previous is not None:
+            _discard_sorted(state.by_address, (previous, peer_id))
+        state.positions[peer_id] = address_int(peer.address)
+        insort(state.by_address, (state.positions[peer_id], peer_id))
+        state.by_key[peer.public_key] = peer_id
+        state.by_username[peer.username] = peer_id
+
+    @staticmethod
+    def _put_subnet(state: _State, subnet: Subnet) -> None:
+        state.subnets[subnet.subnet] = subnet
+        network = state.ranges[subnet.subnet] = network_range(subnet.subnet)
+        state.by_range.setdefault(network, {})[subnet.subnet] = state.ranked
+        state.ranked += 1
+
+    @staticmethod
+    def _put_service(state: _State, peer_id: int, service: Service) -> None:
+        state.services[(peer_id, service.port)] = service
+        state.by_name[service.name] = (peer_id, service.port)
+
+    @staticmethod
+    def _cascade(state: _State, matches: Callable[[str, Any], bool]) -> None:
+        for table, columns in LINK_TABLES.items():
+            rows = state.links[table]
+            for row in [row for row in rows if any(matches(role, value) for (_, role), value in zip(columns, row))]:
+                del rows[row]
+
+    # --- reads ---
+
+    @staticmethod
+    def _view(state: _State, name: str, compute: Callable[[_State], Any]) -> Any:
+        view = state.views.get(name)
+        if view is None:
+            view = state.views[name] = compute(state)
+        return view
+
+    def subnets(self) -> list[Subnet]:
+        return self._view(self._current(), "subnets", lambda state: list(state.subnets.values()))
+
+    def services(self) -> list[Service]:
+        return self._view(self._current(), "services", lambda state: list(state.services.values()))
+
+    def peers(self) -> list[Peer]:
+        """Every peer with the services it hosts, like ``Database.get_all_peers``."""
+        return list(self._view(self._current(), "peers", self._peers_with_services).values())
+
+    def peer_by_username(self, username: str) -> Peer | None:
+        state = self._current()
+        peer_id = state.by_username.get(username)
+        return self._view(state, "peers", self._peers_with_services)[peer_id] if peer_id is not None else None
+
+    def peers_in_subnet(self, subnet: str) -> list[Peer]:
+        return self._view(self._current(), "network", self._network).get(subnet, [])
+
+    def subnets_containing(self, peer: Peer) -> list[Subnet]:
+        """The subnets whose range contains the peer's address, like ``Database.get_peers_subnets``."""
+        state = self._current()
+        position = address_int(peer.address)
+        bits = 32 if position < 1 << 32 else 128
+        # Subnets are CIDR blocks: one lookup per prefix length instead of a scan of every range.
+        found: dict[str, int] = {}
+        for prefix in range(bits + 1):
+            size = 1 << (bits - prefix)
+            start = position - position % size
+            found.update(state.by_range.get((start, start + size - 1), {}))
+        return [state.subnets[subnet] for subnet in sorted(found, key=found.__getitem__)]
+
+    def linked_subnets(self, peer: Peer) -> list[Subnet]:
+        """The subnets the peer is linked to, like ``Database.get_links_from_peer_to_subnets``."""
+        state = self._current()
+        peer_id = state.by_key.get(peer.public_key)
+        return [state.subnets[subnet] for member, subnet in state.links["peers_subnets"]
+                if member == peer_id and subnet in state.subnets]
+
+    def links(self) -> dict[str, dict[str, list]]:
+        """The eight link dictionaries of the topology, keyed by their ``Topology`` field."""
+        return self._view(self._current(), "links", self._links)
+
+    def topology(self) -> Topology:
+        """The whole topology, peers without telemetry (tx, rx and last handshake are left at 0)."""
+        return self._view(self._current(), "topology", self._topology)
+
+    def _peers_with_services(self, state: _State) -> dict[int, Peer]:
+        hosted: dict[int, dict[str, Service]] = {}
+        for (peer_id, _), service in state.services.items():
+            hosted.setdefault(peer_id, {})[service.name] = service
+        return {peer_id: peer.model_copy(update={"services": hosted.get(peer_id, {})})
+                for peer_id, peer in state.peers.items()}
+
+    def _network(self, state: _State) -> dict[str, list[Peer]]:
+        peers = self._view(state, "peers", self._peers_with_services)
+        by_address = state.by_address
+        network = {}
+        for subnet, (start, end) in state.ranges.items():
+            members = by_address[bisect_left(by_address, (start,)):bisect_right(by_address, (end, sys.maxsize))]
+            network[subnet] = [peers[peer_id] for peer_id in sorted(peer_id for _, peer_id in members)]
+        return network
+
+    @staticmethod
+    def _links(state: _State) -> dict[str, dict[str, list]]:
+        peers, subnets, services = state.peers, state.subnets, state.services
+
+        def group(table: str, resolve: Callable[[tuple], tuple[str, Any] | None], unique: bool = False) -> dict[str, list]:
+            links: dict[str, list] = {}
+            for row in state.links[table]:
+                resolved = resolve(row)
+                if resolved is None:
+                    continue
+                key, value = resolved
+                linked = links.setdefault(key, [])
+                if not unique or value not in linked:
+                    linked.append(value)
+            return links
+
+        # Rows pointing at a missing peer, subnet or service are dropped, as the SQL joins do.
+        def peer_to_peer(row):
+            return (peers[row[0]].address, peers[row[1]]) if row[0] in peers and row[1] in peers else None
+
+        def subnet_to_subnet(row):
+            return (row[0], subnets[row[1]]) if row[0] in subnets and row[1] in subnets else None
+
+        def peer_to_service(row):
+            service = services.get((row[1], row[2]))
+            return (service.name, peers[row[0]]) if service is not None and row[0] in peers else None
+
+        def subnet_to_service(row):
+            service = services.get((row[0], row[1]))
+            return (row[2], service) if service is not None and row[2] in subnets else None
+
+        def peer_to_subnet(row):
+            return (row[1], peers[row[0]]) if row[0] in peers and row[1] in subnets else None
+
+        def admin_peer_to_subnet(row):
+            return (peers[row[0]].address, subnets[row[1]]) if row[0] in peers and row[1] in subnets else None
+
+        return {
+            "p2p_links": group("peers_peers", peer_to_peer),
+            "service_links": group("peers_services", peer_to_service, unique=True),
+            "subnet_links": group("peers_subnets", peer_to_subnet),
+            "subnet_to_subnet_links": group("subnets_subnets", subnet_to_subnet),
+            "subnet_to_service_links": group("subnets_services", subnet_to_service, unique=True),
+            "admin_peer_to_peer_links": group("admin_peers_peers", peer_to_peer),
+            "admin_peer_to_subnet_links": group("admin_peers_subnets", admin_peer_to_subnet),
+            "admin_subnet_to_subnet_links": group("admin_subnets_subnets", subnet_to_subnet),
+        }
+
+    def _topology(self, state: _State) -> Topology:
+        return Topology(
+            subnets=dict(state.subnets),
+            peers={peer.address: peer for peer in self._view(state, "peers", self._peers_with_services).values()},
+            services={service.name: service for service in state.services.values()},
+            network=self._view(state, "network", self._network),
+            **self._view(state, "links", self._links),
+        )
+
+    # --- consistency and size ---
+
+    def check(self, db) -> list[str]:
+        """Compare every view with the SQL getters of ``db``; returns the names of those that differ."""
+        self.stats["checks"] += 1
+        links = self.links()
+        expected = {
+            "subnets": (self.subnets(), db.get_all_subnets()),
+            "peers": (self.peers(), db.get_all_peers()),
+            "services": (self.services(), db.get_all_services()),
+            "network": ({subnet.subnet: self.peers_in_subnet(subnet.subnet) for subnet in self.subnets()},
+                        {subnet.subnet: db.get_peers_in_subnet(subnet) for subnet in db.get_all_subnets()}),
+            "p2p_links": (links["p2p_links"], db.get_links_from_peer_to_peer()),
+            "service_links": (links["service_links"], db.get_links_from_peers_to_service()),
+            "subnet_links": (links["subnet_links"], db.get_links_from_peer_to_subnet()),
+            "subnet_to_subnet_links": (links["subnet_to_subnet_links"], db.get_links_from_subnet_to_subnet()),
+            "subnet_to_service_links": (links["subnet_to_service_links"], db.get_links_from_subnet_to_service()),
+            "admin_peer_to_peer_links": (links["admin_peer_to_peer_links"], db.get_admin_links_from_peer_to_peer()),
+            "admin_peer_to_subnet_links": (links["admin_peer_to_subnet_links"], db.get_admin_links_from_peer_to_subnet()),
+            "admin_subnet_to_subnet_links": (links["admin_subnet_to_subnet_links"], db.get_admin_links_from_subnet_to_subnet()),
+        }
+        # The SQL getters have no ORDER BY for most of these, so lists are compared as multisets.
+        mismatched = [name for name, (cached, stored) in expected.items() if _plain(cached) != _plain(stored)]
+        if mismatched:
+            self.stats["mismatches"] += 1
+        return mismatched
+
+    def memory(self) -> int:
+        """Approximate size in bytes of the graph and its cached views (0 when not loaded)."""
+        state = self._state
+        return _deep_size(state.__dict__, set()) if state is not None else 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._state is not None
+
+    def counts(self) -> dict[str, int]:
+        state = self._state
+        if state is None:
+            return {"peers": 0, "subnets": 0, "services": 0, "links": 0}
+        return {"peers": len(state.peers), "subnets": len(state.subnets), "services": len(state.services),
+                "links": sum(len(rows) for rows in state.links.values())}
+
+
+def _discard_sorted(items: list, item: tuple) -> None:
+    index = bisect_left(items, item)
+    if index < len(items) and items[index] == item:
+        del items[index]
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return sorted((_plain(item) for item in value), key=repr)
+    return value
+
+
+def _deep_size(value: Any, seen: set[int]) -> int:
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(item, seen) for item in value)
+    elif isinstance(value, BaseModel):
+        size += _deep_size(value.__dict__, seen)
+    return size
@@ -1,5 +1,28 @@
 import sqlite3,os,ipaddress
 from backend.core.config import settings
+from backend.db.database import address_int, network_range
+
+def migrate(cursor):
+    """
+    Brings a database created from an older schema.sql up to date. Every step checks what is
+    already there, so running it on a current database changes nothing.
+    """
+    # Integer address ranges: peers.address_int and subnets.network_start/network_end.
+    peer_columns = {row[1] for row in cursor.execute("PRAGMA table_info(peers)")}
+    if "address_int" not in peer_columns:
+        cursor.execute("ALTER TABLE peers ADD COLUMN address_int INTEGER")
+    subnet_columns = {row[1] for row in cursor.execute("PRAGMA table_info(subnets)")}
+    if "network_start" not in subnet_columns:
+        cursor.execute("ALTER TABLE subnets ADD COLUMN network_start INTEGER")
+        cursor.execute("ALTER TABLE subnets ADD COLUMN network_end INTEGER")
+    peers = cursor.execute("SELECT id, address FROM peers WHERE address_int IS NULL").fetchall()
+    cursor.executemany("UPDATE peers SET address_int = ? WHERE id = ?",
+                       [(address_int(address), peer_id) for peer_id, address in peers])
+    subnets = cursor.execute("SELECT subnet FROM subnets WHERE network_start IS NULL").fetchall()
+    cursor.executemany("UPDATE subnets SET network_start = ?, network_end = ? WHERE subnet = ?",
+                       [(*network_range(subnet), subnet) for (subnet,) in subnets])
+    cursor.execute("CREATE INDEX IF NOT EXISTS peers_address_int ON peers (address_int)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS subnets_network_range ON subnets (network_start, network_end)")
 
 def init_db(db_path):
     
@@ -10,13 +33,14 @@ def init_db(db_path):
     schema_path = os.path.join(os.path.dirname(__file__), "schema.sql")
     with open(schema_path, "r") as f:
         cursor.executescript(f.read())
+    migrate(cursor)
 
     PRESHARED_KEY = os.getenv("PRESHARED_KEY", "X2RHVZ+j12IDqxq8HaKOp77+MRprFo7XxO8LrE9BhxE=")
 
     cursor.execute("""
-    INSERT OR IGNORE INTO subnets (subnet, name, description, x, y, width, height, rgba)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (settings.wg_default_subnet, "Wireguard Subnet", "This is the subnet for the WireGuard configuration.", 300, 300, 600, 300, -220))
+    INSERT OR IGNORE INTO subnets (subnet, network_start, network_end, name, description, x, y, width, height, rgba)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (settings.wg_default_subnet, *network_range(settings.wg_default_subnet), "Wireguard Subnet", "This is the subnet for the WireGuard configuration.", 300, 300, 600, 300, -220))
 
     # fetch for the master peer 
     cursor.execute("SELECT * FROM peers WHERE username = ?", ("master",))
@@ -27,9 +51,9 @@ def init_db(db_path):
         first_ip = str(next(net.hosts()))
         # if the master peer does not exist, create it
         cursor.execute("""
-        INSERT INTO peers (username, address, public_key, preshared_key, x, y)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """, ("master", first_ip, settings.public_key, PRESHARED_KEY, 300, 300))
+        INSERT INTO peers (username, address, address_int, public_key, preshared_key, x, y)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, ("master", first_ip, address_int(first_ip), settings.public_key, PRESHARED_KEY, 300, 300))
 
         cursor.execute("""
                     INSERT OR IGNORE INTO peers_subnets (peer_id, subnet)
@@ -0,0 +1,61 @@
+import sqlite3
+
+
+class IntentStore:
+    """
+    Kernel intents (see backend/core/intents.py), kept in a SQLite file of their own.
+    A request holds the write lock of the main database until it commits, while an intent has to be
+    durable before the kernel is touched, that is before that commit: a separate file has its own lock.
+    """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS kernel_intents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                subjects TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def save_intent(self, intent_id: int | None, created_at: float, subjects: str) -> int:
+        """
+        This function creates an intent row, or replaces the subjects of an existing one, and commits it.
+        It returns the id of the row, and will raise an error if the database operation fails.
+        """
+        try:
+            if intent_id is None:
+                cur = self.conn.execute("INSERT INTO kernel_intents (created_at, subjects) VALUES (?, ?)", (created_at, subjects))
+                intent_id = cur.lastrowid
+            else:
+                self.conn.execute("UPDATE kernel_intents SET subjects = ? WHERE id = ?", (subjects, intent_id))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while saving kernel intent: {e}")
+        return intent_id
+
+    def delete_intents(self, intent_ids: list[int]):
+        """
+        This function deletes the given intent rows and commits.
+        The function returns nothing, but will raise an error if the database operation fails.
+        """
+        try:
+            self.conn.executemany("DELETE FROM kernel_intents WHERE id = ?", [(intent_id,) for intent_id in intent_ids])
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while deleting kernel intents: {e}")
+
+    def get_intents(self) -> list[tuple[int, float, str]]:
+        """
+        This function returns every (id, created_at, subjects) intent row, oldest first.
+        """
+        try:
+            cur = self.conn.execute("SELECT id, created_at, subjects FROM kernel_intents ORDER BY id")
+            return cur.fetchall()
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting kernel intents: {e}")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,73 @@
+import sqlite3
+import threading
+
+
+class RollupStore:
+    """
+    Per-peer traffic rollups (see backend/core/wireguard/history.py), kept in a SQLite file of their own.
+    The collector writes every minute from its own thread, outside the write lock and the write scheduler:
+    in the main database its transactions would queue behind a grouped request commit, and the other way round.
+
+    One row holds a window of fixed-size slots (60 one-minute slots per hour, 24 one-hour slots per day)
+    packed as an array of unsigned 64-bit byte counts, rx and tx interleaved. Keyed by public key so history
+    survives username changes; rows of deleted peers age out with the retention.
+    """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS peer_traffic_rollups (
+                public_key TEXT NOT NULL,
+                resolution INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (public_key, resolution, bucket)
+            )
+        """)
+        self.conn.commit()
+        # The collector writes while requests read history through the same connection.
+        self._lock = threading.Lock()
+
+    def save_traffic_rollups(self, rows: list[tuple[str, int, int, bytes]], expired: list[tuple[int, int]] = ()):
+        """
+        This function stores (public_key, resolution, bucket, data) traffic rollup rows, replacing existing ones,
+        deletes the rows of each (resolution, bucket) in expired whose window starts before bucket, and commits.
+        The function returns nothing, but will raise an error and roll back if the database operation fails.
+        """
+        with self._lock:
+            try:
+                self.conn.executemany("""
+                    INSERT OR REPLACE INTO peer_traffic_rollups (public_key, resolution, bucket, data)
+                    VALUES (?, ?, ?, ?)
+                """, rows)
+                self.conn.executemany("DELETE FROM peer_traffic_rollups WHERE resolution = ? AND bucket < ?", expired)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                raise Exception(f"An error occurred while saving traffic rollups: {e}")
+
+    def get_traffic_rollups(self, public_keys: list[str], resolution: int, since: int) -> dict[str, list[tuple[int, bytes]]]:
+        """
+        This function returns, per public key, the (bucket, data) traffic rollup rows of a resolution starting at or after since, oldest first.
+        """
+        rollups: dict[str, list[tuple[int, bytes]]] = {key: [] for key in public_keys}
+        if not public_keys:
+            return rollups
+        try:
+            placeholders = ", ".join("?" for _ in public_keys)
+            with self._lock:
+                cur = self.conn.execute(f"""
+                    SELECT public_key, bucket, data FROM peer_traffic_rollups
+                    WHERE resolution = ? AND bucket >= ? AND public_key IN ({placeholders})
+                    ORDER BY bucket
+                """, (resolution, since, *public_keys))
+                rows = cur.fetchall()
+            for row in rows:
+                rollups[row[0]].append((row[1], row[2]))
+        except sqlite3.Error as e:
+            raise Exception(f"An error occurred while getting traffic rollups: {e}")
+        return rollups
+
+    def close(self):
+        self.conn.close()
@@ -5,6 +5,8 @@ CREATE TABLE IF NOT EXISTS peers (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT NOT NULL UNIQUE,
     address TEXT NOT NULL UNIQUE,
+    -- address as an integer, so subnet containment is an indexed range lookup (see init_db.migrate)
+    address_int INTEGER,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     public_key TEXT NOT NULL UNIQUE,
     preshared_key TEXT,
@@ -29,6 +31,9 @@ CREATE TABLE IF NOT EXISTS services (
     
 CREATE TABLE IF NOT EXISTS subnets(
     subnet TEXT PRIMARY KEY,
+    -- first and last address of the network as integers, bounds included
+    network_start INTEGER,
+    network_end INTEGER,
     name TEXT NOT NULL UNIQUE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     description TEXT,
@@ -118,4 +123,14 @@ CREATE TABLE IF NOT EXISTS admin_peers_subnets (
     PRIMARY KEY (peer_id, subnet),
     FOREIGN KEY (peer_id) REFERENCES peers(id) ON DELETE CASCADE,
     FOREIGN KEY (subnet) REFERENCES subnets(subnet) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+-- The WireGuard shard layout the issued peer configs were made with (see core/wireguard/shards.py).
+-- A peer's interface and port follow from its address and this layout, so startup compares the
+-- configured layout with it before moving anyone. A single row.
+CREATE TABLE IF NOT EXISTS wg_shard_layout (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    count INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    prefix INTEGER NOT NULL,
+    base_port INTEGER NOT NULL
+);
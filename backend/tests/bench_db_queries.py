@@ -0,0 +1,88 @@
+"""Count the SQL statements and time of the peer getters as the number of peers grows.
+
+The script only touches a throw-away SQLite file, so it can run inside the backend container or
+anywhere the backend package imports:
+
+    docker exec -e PYTHONPATH=/home <container> python3 /home/backend/tests/bench_db_queries.py
+
+For every peer count it fills a fresh database (every third peer hosts two services), then runs
+``get_all_peers``, ``get_peer_by_username``, ``get_peer_by_address``, ``get_peers_in_subnet``,
+``get_services_in_subnet``, ``get_avaliable_ip`` (whose first call builds the subnet's free
+ranges) and the topology graph's ``topology`` (whose first call loads the graph) and prints how many statements each one sent to SQLite and how long it took. The
+statement count of every getter must not depend on the number of peers; the script exits with
+status 1 if it does.
+"""
+import ipaddress
+import os
+import sys
+import tempfile
+import time
+
+from backend.core.models import Peer, Service, Subnet
+from backend.db import Database
+from backend.db.init_db import init_db
+
+SUBNET = "10.249.0.0/16"
+PEER_COUNTS = [int(n) for n in os.environ.get("BENCH_PEERS", "10,100,1000,5000").split(",")]
+
+
+def populate(db: Database, peers: int) -> list[Peer]:
+    hosts = ipaddress.ip_network(SUBNET).hosts()
+    created = []
+    for i in range(peers):
+        peer = Peer(username=f"bench{i}", public_key=f"pub{i}=", preshared_key=f"psk{i}=", address=str(next(hosts)), x=0, y=0)
+        db.create_peer(peer)
+        if i % 3 == 0:
+            for port in (8080, 8443):
+                db.create_service(peer, Service(name=f"svc{i}-{port}", department="bench", port=port))
+        created.append(peer)
+    db.commit_transaction()
+    return created
+
+
+def measure(peers: int) -> dict[str, tuple[int, float]]:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        init_db(path)
+        db = Database(path)
+        created = populate(db, peers)
+        subnet = Subnet(subnet=SUBNET, name="bench", description="", x=0, y=0, width=0, height=0, rgba=0)
+        middle = created[len(created) // 2]
+        getters = {
+            "get_all_peers": db.get_all_peers,
+            "get_peer_by_username": lambda: db.get_peer_by_username(middle.username),
+            "get_peer_by_address": lambda: db.get_peer_by_address(middle.address),
+            "get_peers_in_subnet": lambda: db.get_peers_in_subnet(subnet),
+            "get_services_in_subnet": lambda: db.get_services_in_subnet(subnet),
+            "get_avaliable_ip": lambda: db.get_avaliable_ip(subnet),
+            "graph.topology": db.graph.topology,
+        }
+        results = {}
+        for name, getter in getters.items():
+            statements = []
+            db.conn.set_trace_callback(statements.append)
+            started = time.perf_counter()
+            getter()
+            elapsed = time.perf_counter() - started
+            db.conn.set_trace_callback(None)
+            results[name] = (len(statements), elapsed)
+        db.close()
+    return results
+
+
+def main() -> int:
+    print(f"{'peers':>6} {'getter':>24} {'queries':>8} {'ms':>9}")
+    counts: dict[str, set[int]] = {}
+    for peers in PEER_COUNTS:
+        for name, (queries, elapsed) in measure(peers).items():
+            counts.setdefault(name, set()).add(queries)
+            print(f"{peers:>6} {name:>24} {queries:>8} {elapsed * 1000:>9.2f}")
+    growing = [name for name, seen in counts.items() if len(seen) > 1]
+    if growing:
+        print(f"query count grows with the number of peers: {', '.join(growing)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
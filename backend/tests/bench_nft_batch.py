@@ -0,0 +1,69 @@
+"""Benchmark nftables round-trips with and without per-request batching.
+
+The script rebuilds the ``inet dcv`` table from scratch, so only run it inside a disposable
+backend container (it needs the libnftables binding and CAP_NET_ADMIN):
+
+    docker exec -e PYTHONPATH=/home <container> python3 /home/backend/tests/bench_nft_batch.py
+
+For every peer count it replays the same workload (subnet membership, public flag, a p2p link
+and a service grant per peer) once command by command and once inside ``nft_batch()``, and
+prints the number of queued commands, kernel round-trips and wall-clock time of each run.
+"""
+import ipaddress
+import os
+import sys
+import time
+
+from backend.core.nftables import (
+    add_member,
+    add_p2p_link,
+    ensure_subnet,
+    flush_dcv,
+    grant_service,
+    make_public,
+    nft_batch,
+    nft_stats,
+)
+
+SUBNET = "10.250.0.0/16"
+PEER_COUNTS = [int(n) for n in os.environ.get("BENCH_PEERS", "10,100,1000").split(",")]
+
+
+def workload(peers: int) -> None:
+    hosts = ipaddress.ip_network(SUBNET).hosts()
+    addresses = [str(next(hosts)) for _ in range(peers + 1)]
+    ensure_subnet(SUBNET)
+    for a, b in zip(addresses, addresses[1:]):
+        add_member(SUBNET, a)
+        make_public(SUBNET, a)
+        add_p2p_link(a, b)
+        grant_service(b, a, 8080, "tcp")
+
+
+def measure(peers: int, batched: bool) -> tuple[int, int, float]:
+    flush_dcv()
+    for key in nft_stats:
+        nft_stats[key] = 0
+    started = time.perf_counter()
+    if batched:
+        with nft_batch():
+            workload(peers)
+    else:
+        workload(peers)
+    elapsed = time.perf_counter() - started
+    return nft_stats["commands"], nft_stats["round_trips"], elapsed
+
+
+def main() -> int:
+    print(f"{'peers':>6} {'mode':>9} {'commands':>9} {'round-trips':>12} {'seconds':>9} {'ms/peer':>8}")
+    for peers in PEER_COUNTS:
+        for batched in (False, True):
+            commands, round_trips, elapsed = measure(peers, batched)
+            mode = "batched" if batched else "unbatched"
+            print(f"{peers:>6} {mode:>9} {commands:>9} {round_trips:>12} {elapsed:>9.3f} {elapsed * 1000 / peers:>8.2f}")
+    flush_dcv()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Compare the ruleset size and per-packet cost of the policy modes and the ct mark fast path.
+
+The script rebuilds the ``inet dcv`` table from scratch, so only run it inside a disposable
+backend container (it needs the libnftables binding and CAP_NET_ADMIN):
+
+    docker exec -e PYTHONPATH=/home <container> python3 /home/backend/tests/bench_nft_policy.py
+
+For every subnet count it creates subnets with a few members and public peers each, links every
+subnet to the next one, grants it a tcp/udp service hosted there and grants one admin subnet
+link, once per mode with and without the conntrack mark fast path. It prints the number of rules
+in the table, the number of set elements, the rules a NEW packet walks in the worst case (the
+whole ``wg_base`` and ``wg_allow`` chains before the final drop), the rules an established packet
+walks in ``forward`` and ``fwd_est`` before it is accepted, and the time it took to apply the
+workload.
+"""
+import os
+import sys
+import time
+
+from backend.core.nftables import (
+    add_member,
+    connect_subnets_bidirectional_public,
+    ct_fastpath,
+    dcv_mirror,
+    ensure_subnet,
+    flush_dcv,
+    grant_admin_subnet_to_subnet,
+    grant_subnet_service,
+    make_public,
+    nft_batch,
+    subnet_policy,
+)
+from backend.core.nftables.commands import nft_json
+
+SUBNET_COUNTS = [int(n) for n in os.environ.get("BENCH_SUBNETS", "10,100,500").split(",")]
+MEMBERS = int(os.environ.get("BENCH_MEMBERS", "4"))
+
+
+def subnet(i: int) -> str:
+    return f"10.{200 + i // 256}.{i % 256}.0/24"
+
+
+def workload(subnets: int) -> None:
+    for i in range(subnets):
+        cidr = subnet(i)
+        prefix = cidr.rsplit(".", 1)[0]
+        ensure_subnet(cidr)
+        for host in range(2, 2 + MEMBERS):
+            add_member(cidr, f"{prefix}.{host}")
+        make_public(cidr, f"{prefix}.2")
+    for i in range(subnets - 1):
+        connect_subnets_bidirectional_public(subnet(i), subnet(i + 1))
+        grant_subnet_service(subnet(i), subnet(i + 1).rsplit(".", 1)[0] + ".2", 8080, "both")
+    grant_admin_subnet_to_subnet(subnet(0), subnet(subnets - 1))
+
+
+def chain_lengths() -> tuple[dict[str, int], int]:
+    chains: dict[str, int] = {}
+    elements = 0
+    for item in nft_json("list table inet dcv").get("nftables", []):
+        if "rule" in item:
+            chains[item["rule"]["chain"]] = chains.get(item["rule"]["chain"], 0) + 1
+        if "set" in item:
+            elements += len(item["set"].get("elem", []) or [])
+    return chains, elements
+
+
+def measure(subnets: int, mode: str, fastpath: bool) -> tuple[int, int, int, int, float]:
+    subnet_policy.configure(mode)
+    ct_fastpath.configure(fastpath)
+    flush_dcv()
+    started = time.perf_counter()
+    with nft_batch():
+        workload(subnets)
+    elapsed = time.perf_counter() - started
+    dcv_mirror.load()
+    chains, elements = chain_lengths()
+    new_cost = chains.get("wg_base", 0) + chains.get("wg_allow", 0)
+    # blocked_pairs drop, then either the ct mark accept or the jump into fwd_est
+    established_cost = 2 + chains.get("fwd_est", 0)
+    return sum(chains.values()), elements, new_cost, established_cost, elapsed
+
+
+def main() -> int:
+    print(f"{'subnets':>7} {'mode':>9} {'ct mark':>7} {'rules':>7} {'elements':>9} {'NEW cost':>9} {'EST cost':>9} {'seconds':>8}")
+    for subnets in SUBNET_COUNTS:
+        for mode in ("rules", "compiled"):
+            for fastpath in (False, True):
+                rules, elements, new_cost, established_cost, elapsed = measure(subnets, mode, fastpath)
+                print(f"{subnets:>7} {mode:>9} {'on' if fastpath else 'off':>7} {rules:>7} {elements:>9} {new_cost:>9} {established_cost:>9} {elapsed:>8.3f}")
+    subnet_policy.configure("rules")
+    ct_fastpath.configure(False)
+    flush_dcv()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""Benchmark per-peer WireGuard programming through the ``wg`` binary and through netlink.
+
+The script adds and removes throw-away peers on the live interface, so only run it inside a
+disposable backend container (it needs CAP_NET_ADMIN, and pyroute2 for the netlink column):
+
+    docker exec -e PYTHONPATH=/home <container> python3 /home/backend/tests/bench_wg_client.py
+
+For every peer count it programs that many random peers one by one (public key, preshared key
+and one allowed IP each, like ``apply_to_wg_config``), dumps the interface once and removes the
+peers again, and prints the time of each step per backend.
+"""
+import base64
+import ipaddress
+import os
+import sys
+import time
+
+from backend.core.config import settings
+from backend.core.wireguard.client import NetlinkBackend, SubprocessBackend
+
+SUBNET = "10.251.0.0/16"
+PEER_COUNTS = [int(n) for n in os.environ.get("BENCH_PEERS", "10,100,1000").split(",")]
+
+
+def random_key() -> str:
+    return base64.b64encode(os.urandom(32)).decode()
+
+
+def measure(backend, peers: int) -> tuple[float, float, float]:
+    hosts = ipaddress.ip_network(SUBNET).hosts()
+    keys = [(random_key(), random_key(), str(next(hosts))) for _ in range(peers)]
+    started = time.perf_counter()
+    for public_key, preshared_key, address in keys:
+        backend.set_peer(settings.wg_interface, public_key, preshared_key, [address])
+    applied = time.perf_counter()
+    backend.dump(settings.wg_interface)
+    dumped = time.perf_counter()
+    backend.remove_peers(settings.wg_interface, [public_key for public_key, _, _ in keys])
+    removed = time.perf_counter()
+    return applied - started, dumped - applied, removed - dumped
+
+
+def main() -> int:
+    backends = [SubprocessBackend()]
+    try:
+        backends.append(NetlinkBackend())
+    except Exception as exc:
+        print(f"netlink backend unavailable: {exc}")
+    print(f"{'peers':>6} {'backend':>10} {'apply s':>9} {'ms/peer':>8} {'dump s':>8} {'remove s':>9}")
+    for peers in PEER_COUNTS:
+        for backend in backends:
+            apply_seconds, dump_seconds, remove_seconds = measure(backend, peers)
+            print(f"{peers:>6} {backend.name:>10} {apply_seconds:>9.3f} {apply_seconds / peers * 1000:>8.3f} "
+                  f"{dump_seconds:>8.3f} {remove_seconds:>9.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
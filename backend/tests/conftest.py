@@ -0,0 +1,101 @@
+"""Fixtures of the unit tests (``test_*.py``); the Docker tests in this directory do not use them.
+
+Run from the repository root so that ``backend`` is importable::
+
+    python -m pytest backend/tests
+
+The tests work on a throw-away SQLite file and replace the libnftables client with ``FakeKernel``,
+so they need neither the container nor CAP_NET_ADMIN. The settings are read as in the container,
+``/etc/wireguard/publickey`` included.
+"""
+import json
+import os
+import re
+import tempfile
+
+# Before anything imports the settings: the shared Database opens this path on import.
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="driftcove-tests-"), "driftcove.db")
+
+import pytest
+
+from backend.core.config import settings
+from backend.core.database import db
+from backend.core.nftables import commands
+from backend.core.nftables.mirror import add_set, dcv_mirror
+from backend.db.init_db import init_db
+
+# A script against a running API (see its main), not a test module.
+collect_ignore = ["integration_test.py"]
+
+SET_COMMAND = re.compile(r"^(add|delete|flush) set inet dcv (\S+)")
+ELEMENT_COMMAND = re.compile(r"^(add|delete) element inet dcv (\S+) \{ (.*) \}$")
+
+
+class FakeKernel:
+    """Stands in for ``nft_pool``: keeps the sets of the dcv table and applies each batch atomically.
+
+    A batch containing one of the ``reject_once`` markers is refused as a whole, the first time
+    only. ``batches`` lists every command buffer submitted, accepted or not.
+    """
+
+    def __init__(self):
+        self.sets: dict[str, set[str]] = {}
+        self.batches: list[str] = []
+        self.reject_once: list[str] = []
+
+    def cmd(self, command: str, *, json_output: bool = False, handle_output: bool = False, echo_output: bool = False):
+        if command.startswith("list"):
+            items = [{"set": {"name": name, "elem": sorted(elements)}} for name, elements in self.sets.items()]
+            return 0, json.dumps({"nftables": items}), ""
+        self.batches.append(command)
+        for marker in self.reject_once:
+            if marker in command:
+                self.reject_once.remove(marker)
+                return 1, "", f"Error: rejected {marker}"
+        sets = {name: set(elements) for name, elements in self.sets.items()}
+        for line in command.splitlines():
+            if match := ELEMENT_COMMAND.match(line):
+                verb, name, elements = match.groups()
+                elements = {element.strip() for element in elements.split(",")}
+                if verb == "add":
+                    sets[name] |= elements
+                elif not elements <= sets[name]:
+                    return 1, "", f"Error: deleting absent elements from {name}"
+                else:
+                    sets[name] -= elements
+            elif match := SET_COMMAND.match(line):
+                verb, name = match.groups()
+                if verb == "add":
+                    sets.setdefault(name, set())
+                elif verb == "flush":
+                    sets[name] = set()
+                else:
+                    del sets[name]
+        self.sets = sets
+        return 0, '{"nftables": []}' if json_output else "", ""
+
+
+@pytest.fixture
+def kernel(monkeypatch) -> FakeKernel:
+    """A fake kernel with an empty ``test`` set, and the mirror in step with it."""
+    fake = FakeKernel()
+    monkeypatch.setattr(commands.nft_pool, "cmd", fake.cmd)
+    dcv_mirror.reset()
+    with commands.nft_batch():
+        add_set("test", "type ipv4_addr;")
+    fake.batches.clear()
+    yield fake
+    dcv_mirror.reset()
+
+
+@pytest.fixture
+def database():
+    """The shared ``Database``, freshly initialised and emptied again afterwards."""
+    init_db(settings.db_path)
+    db.graph.invalidate()
+    db.allocator.reset()
+    yield db
+    if db.writer.in_transaction:
+        db.rollback_transaction()
+    db.clear_database()
+    db.commit_transaction()
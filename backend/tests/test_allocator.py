@@ -0,0 +1,126 @@
+from backend.core.models import Peer, Subnet
+from backend.db.allocator import AddressAllocator, FreeRanges, address_int, network_range
+
+
+def intervals(ranges: FreeRanges) -> list[tuple[int, int]]:
+    return list(zip(ranges.starts, ranges.ends))
+
+
+def test_network_and_broadcast_are_not_free():
+    ranges = FreeRanges(*network_range("10.0.0.0/29"), [])
+
+    assert intervals(ranges) == [(address_int("10.0.0.1"), address_int("10.0.0.6"))]
+    assert ranges.hosts == ranges.free == 6
+
+
+def test_every_address_of_a_point_to_point_network_is_a_host():
+    assert intervals(FreeRanges(0, 1, [])) == [(0, 1)]
+    assert intervals(FreeRanges(5, 5, [])) == [(5, 5)]
+
+
+def test_used_addresses_split_the_free_ranges():
+    ranges = FreeRanges(0, 15, [3, 4, 9, 99])
+
+    assert intervals(ranges) == [(1, 2), (5, 8), (10, 14)]
+    assert ranges.free == 11
+
+
+def test_claim_splits_and_shrinks_ranges():
+    ranges = FreeRanges(0, 15, [])
+
+    ranges.claim(7)
+    assert intervals(ranges) == [(1, 6), (8, 14)]
+    ranges.claim(1)
+    ranges.claim(14)
+    assert intervals(ranges) == [(2, 6), (8, 13)]
+    ranges.claim(8)
+    ranges.claim(9)
+    assert intervals(ranges) == [(2, 6), (10, 13)]
+    assert ranges.free == 9
+    assert ranges.first_free() == 2
+
+
+def test_claim_drops_a_single_address_range_and_ignores_taken_addresses():
+    ranges = FreeRanges(0, 7, [2])
+
+    ranges.claim(1)
+    ranges.claim(1)
+    ranges.claim(2)
+    ranges.claim(0)
+
+    assert intervals(ranges) == [(3, 6)]
+    assert ranges.free == 4
+
+
+def test_release_merges_with_neighbours():
+    ranges = FreeRanges(0, 15, [3, 5, 7])
+
+    ranges.release(5)
+    assert intervals(ranges) == [(1, 2), (4, 6), (8, 14)]
+    ranges.release(3)
+    assert intervals(ranges) == [(1, 6), (8, 14)]
+    ranges.release(7)
+    assert intervals(ranges) == [(1, 14)]
+    assert ranges.free == ranges.hosts == 14
+
+
+def test_release_adds_isolated_ranges_and_ignores_free_or_outside_addresses():
+    ranges = FreeRanges(0, 15, range(1, 15))
+
+    ranges.release(9)
+    ranges.release(3)
+    ranges.release(3)
+    ranges.release(0)
+    ranges.release(15)
+
+    assert intervals(ranges) == [(3, 3), (9, 9)]
+    assert ranges.free == 2
+
+
+def test_claim_and_release_round_trip():
+    ranges = FreeRanges(0, 255, [])
+    for address in range(1, 255, 3):
+        ranges.claim(address)
+    for address in range(1, 255, 3):
+        ranges.release(address)
+
+    assert intervals(ranges) == [(1, 254)]
+    assert ranges.free == 254
+
+
+def test_allocator_applies_addresses_to_nested_subnets():
+    allocator = AddressAllocator()
+    outer = allocator.track(network_range("10.0.0.0/16"), [])
+    inner = allocator.track(network_range("10.0.1.0/24"), [])
+    other = allocator.track(network_range("10.1.0.0/24"), [])
+
+    allocator.claim(address_int("10.0.1.1"))
+
+    assert inner.first_free() == address_int("10.0.1.2")
+    assert outer.free == outer.hosts - 1
+    assert other.free == other.hosts
+    allocator.release(address_int("10.0.1.1"))
+    assert inner.first_free() == address_int("10.0.1.1") and outer.free == outer.hosts
+    allocator.forget(network_range("10.0.1.0/24"))
+    assert allocator.get(network_range("10.0.1.0/24")) is None
+
+
+def test_database_hands_out_addresses_and_forgets_them_on_rollback(database):
+    subnet = Subnet(subnet="10.40.0.0/29", name="small")
+    database.create_subnet(subnet)
+    database.commit_transaction()
+    database.begin_transaction()
+    first = database.get_avaliable_ip(subnet)
+    database.create_peer(Peer(username="one", public_key="one-key", preshared_key="psk", address=first, x=0, y=0))
+
+    database.savepoint("write")
+    second = database.get_avaliable_ip(subnet)
+    database.create_peer(Peer(username="two", public_key="two-key", preshared_key="psk", address=second, x=0, y=0))
+    assert database.get_subnet_utilization(subnet)["used"] == 2
+    database.rollback_to_savepoint("write")
+
+    assert (first, second) == ("10.40.0.1", "10.40.0.2")
+    assert database.get_avaliable_ip(subnet) == second
+    assert database.get_subnet_utilization(subnet)["used"] == 1
+    database.rollback_transaction()
+    assert database.get_avaliable_ip(subnet) == first
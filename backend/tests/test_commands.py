@@ -0,0 +1,46 @@
+import pytest
+
+from backend.core.nftables.commands import NftablesCommandError, nft_batch, nft_json, nft_stats, submit_early
+from backend.core.nftables.mirror import add_elements, dcv_mirror, delete_elements
+
+
+def test_a_batch_reaches_the_kernel_as_one_transaction(kernel):
+    with nft_batch():
+        add_elements("test", ["10.0.0.1"])
+        assert nft_json("list table inet dcv")["nftables"][0]["set"]["elem"] == []
+        add_elements("test", ["10.0.0.2"])
+        delete_elements("test", ["10.0.0.1"])
+
+    assert len(kernel.batches) == 1
+    assert kernel.sets["test"] == {"10.0.0.2"}
+
+
+def test_rejected_batch_applies_nothing_and_marks_the_mirror_stale(kernel):
+    kernel.reject_once.append("10.0.0.2")
+    with pytest.raises(NftablesCommandError):
+        with nft_batch():
+            add_elements("test", ["10.0.0.1"])
+            add_elements("test", ["10.0.0.2"])
+
+    assert kernel.sets["test"] == set()
+    assert dcv_mirror.stale
+    assert dcv_mirror.elements("test") == set()
+
+
+def test_absent_elements_are_not_deleted(kernel):
+    with nft_batch():
+        delete_elements("test", ["10.0.0.9"])
+
+    assert kernel.batches == []
+
+
+def test_early_submits_are_counted(kernel):
+    submits = nft_stats["early_submits"]
+    with nft_batch():
+        submit_early("nothing queued")
+        add_elements("test", ["10.0.0.1"])
+        submit_early("test")
+        add_elements("test", ["10.0.0.2"])
+
+    assert nft_stats["early_submits"] == submits + 1
+    assert len(kernel.batches) == 2
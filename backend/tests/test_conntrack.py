@@ -0,0 +1,91 @@
+import errno
+from types import SimpleNamespace
+
+import pytest
+
+from backend.core.nftables.conntrack import ConntrackError, conntrack_revoker
+from backend.core.nftables.mirror import add_elements, dcv_mirror, delete_elements
+from backend.core.state_manager import state_manager
+
+ONE = (0x0A000001, 0x0A000001)  # 10.0.0.1
+
+
+class FakeConntrack:
+    """The pyroute2 ``Conntrack`` calls the revoker makes; each call raises the next of ``failures`` first."""
+
+    def __init__(self, *connections: tuple[str, str], failures: list[Exception | None] = ()):
+        self.entries = [SimpleNamespace(tuple_orig=SimpleNamespace(saddr=s, daddr=d)) for s, d in connections]
+        self.failures = list(failures)
+
+    def _call(self):
+        if self.failures and (failure := self.failures.pop(0)) is not None:
+            raise failure
+
+    def dump_entries(self, mark: int, mark_mask: int):
+        self._call()
+        return list(self.entries)
+
+    def entry(self, command: str, tuple_orig):
+        self._call()
+        self.entries = [entry for entry in self.entries if entry.tuple_orig is not tuple_orig]
+
+    def remaining(self) -> list[tuple[str, str]]:
+        return [(entry.tuple_orig.saddr, entry.tuple_orig.daddr) for entry in self.entries]
+
+
+@pytest.fixture
+def sockets(monkeypatch) -> list[FakeConntrack]:
+    """The sockets the shared revoker opens, in order, with the fast path on."""
+    opened: list[FakeConntrack] = []
+    monkeypatch.setattr(conntrack_revoker, "enabled", True)
+    monkeypatch.setattr(conntrack_revoker, "mark", 1)
+    monkeypatch.setattr(conntrack_revoker, "stats", dict.fromkeys(conntrack_revoker.stats, 0))
+    monkeypatch.setattr(conntrack_revoker, "_socket", None)
+    monkeypatch.setattr(conntrack_revoker, "_conntrack", lambda: conntrack_revoker._socket or opened.pop(0))
+    return opened
+
+
+def test_only_revoked_connections_are_dropped(sockets):
+    sockets.append(FakeConntrack(("10.0.0.1", "10.0.0.9"), ("10.0.0.2", "10.0.0.9")))
+    conntrack = sockets[0]
+
+    conntrack_revoker.revoke([ONE], None)
+
+    assert conntrack.remaining() == [("10.0.0.2", "10.0.0.9")]
+    assert conntrack_revoker.stats["deleted"] == 1 and conntrack_revoker.stats["errors"] == 0
+
+
+def test_entries_gone_since_the_dump_are_skipped(sockets):
+    gone = OSError("No such file or directory")
+    gone.code = errno.ENOENT
+    sockets.append(FakeConntrack(("10.0.0.1", "10.0.0.8"), ("10.0.0.1", "10.0.0.9"), failures=[None, gone]))
+    conntrack = sockets[0]
+
+    conntrack_revoker.revoke([ONE], None)
+
+    assert conntrack.remaining() == [("10.0.0.1", "10.0.0.8")]
+    assert conntrack_revoker.stats["deleted"] == 1 and conntrack_revoker.stats["errors"] == 0
+
+
+def test_failure_falls_back_to_dropping_every_marked_connection(sockets):
+    fresh = FakeConntrack(("10.0.0.1", "10.0.0.9"), ("10.0.0.2", "10.0.0.9"))
+    sockets.extend([FakeConntrack(failures=[OSError("netlink socket closed")]), fresh])
+
+    conntrack_revoker.revoke([ONE], None)
+
+    assert fresh.remaining() == []
+    assert conntrack_revoker.stats["deleted"] == 2 and conntrack_revoker.stats["errors"] == 1
+
+
+def test_write_fails_and_is_undone_when_conntrack_cannot_be_changed(sockets, kernel, database):
+    with state_manager.saved_state():
+        add_elements("test", ["10.0.0.1"])
+    sockets.extend(FakeConntrack(("10.0.0.1", "10.0.0.9"), failures=[OSError("netlink socket closed")]) for _ in range(2))
+
+    with pytest.raises(ConntrackError):
+        with state_manager.saved_state():
+            delete_elements("test", ["10.0.0.1"])
+
+    assert kernel.sets["test"] == {"10.0.0.1"}
+    assert dcv_mirror.elements("test") == {"10.0.0.1"}
+    assert conntrack_revoker.stats["errors"] == 2 and sockets == []
@@ -0,0 +1,92 @@
+from backend.core.models import Peer, Service, Subnet
+
+OUTER = Subnet(subnet="10.20.0.0/16", name="outer")
+INNER = Subnet(subnet="10.20.1.0/24", name="inner")
+OTHER = Subnet(subnet="10.30.0.0/24", name="other")
+ALICE = Peer(username="alice", public_key="alice-key", preshared_key="psk", address="10.20.1.5", x=1, y=2)
+BOB = Peer(username="bob", public_key="bob-key", preshared_key="psk", address="10.30.0.7", x=3, y=4)
+CAROL = Peer(username="carol", public_key="carol-key", preshared_key="psk", address="10.20.9.9", x=5, y=6)
+WEB = Service(port=443, name="web", department="it")
+
+
+def moved(peer: Peer, **changes) -> Peer:
+    return peer.model_copy(update=changes)
+
+
+# Every Database mutator, in an order where each one has something to act on.
+MUTATIONS = [
+    ("create_subnet", lambda db: [db.create_subnet(subnet) for subnet in (OUTER, INNER, OTHER)]),
+    ("create_peer", lambda db: [db.create_peer(peer) for peer in (ALICE, BOB, CAROL)]),
+    ("update_peer", lambda db: db.update_peer(moved(CAROL, address="10.20.1.9"))),
+    ("update_peer_coordinates", lambda db: db.update_peer_coordinates(moved(ALICE, x=10, y=20))),
+    ("update_subnet_coordinates_size_and_color",
+     lambda db: db.update_subnet_coordinates_size_and_color(moved(INNER, width=5, rgba=7))),
+    ("add_link_from_peer_to_subnet", lambda db: db.add_link_from_peer_to_subnet(ALICE, INNER)),
+    ("create_service", lambda db: db.create_service(BOB, WEB)),
+    ("add_link_from_peer_to_service", lambda db: db.add_link_from_peer_to_service(ALICE, WEB)),
+    ("add_link_from_peer_to_peer", lambda db: db.add_link_from_peer_to_peer(ALICE, BOB)),
+    ("add_link_from_subnet_to_subnet", lambda db: db.add_link_from_subnet_to_subnet(INNER, OTHER)),
+    ("add_link_from_subnet_to_service", lambda db: db.add_link_from_subnet_to_service(INNER, WEB)),
+    ("add_admin_link_from_peer_to_subnet", lambda db: db.add_admin_link_from_peer_to_subnet(ALICE, OTHER)),
+    ("add_admin_link_from_subnet_to_subnet", lambda db: db.add_admin_link_from_subnet_to_subnet(OTHER, INNER)),
+    ("add_admin_link_from_peer_to_peer", lambda db: db.add_admin_link_from_peer_to_peer(BOB, ALICE)),
+    ("remove_admin_link_from_peer_to_peer", lambda db: db.remove_admin_link_from_peer_to_peer(BOB, ALICE)),
+    ("remove_admin_link_from_subnet_to_subnet", lambda db: db.remove_admin_link_from_subnet_to_subnet(OTHER, INNER)),
+    ("remove_admin_link_from_peer_to_subnet", lambda db: db.remove_admin_link_from_peer_to_subnet(ALICE, OTHER)),
+    ("remove_link_from_subnet_to_service", lambda db: db.remove_link_from_subnet_to_service(INNER, WEB)),
+    ("remove_link_from_subnet_to_subnet", lambda db: db.remove_link_from_subnet_to_subnet(INNER, OTHER)),
+    ("remove_link_from_peer_to_peer", lambda db: db.remove_link_from_peer_to_peer(ALICE, BOB)),
+    ("remove_link_from_peer_to_service", lambda db: db.remove_link_from_peer_to_service(ALICE, WEB)),
+    ("remove_link_from_peer_to_subnet", lambda db: db.remove_link_from_peer_to_subnet(ALICE, INNER)),
+    ("add_links_again", lambda db: (db.add_link_from_peer_to_service(ALICE, WEB), db.add_link_from_subnet_to_service(OTHER, WEB),
+                                    db.add_link_from_peer_to_subnet(CAROL, OUTER))),
+    ("remove_service", lambda db: db.remove_service(WEB)),
+    ("remove_peer", lambda db: db.remove_peer(CAROL)),
+    ("remove_subnet", lambda db: db.remove_subnet(INNER)),
+    ("clear_database", lambda db: db.clear_database()),
+]
+
+
+def test_graph_matches_the_database_after_every_mutator(database):
+    database.graph.topology()
+    assert database.graph.loaded
+
+    for name, mutate in MUTATIONS:
+        mutate(database)
+        assert database.graph.check(database) == [], name
+        assert database.graph.loaded, name
+    database.commit_transaction()
+
+
+def test_rolled_back_savepoint_drops_the_graph(database):
+    database.create_subnet(OUTER)
+    database.create_peer(ALICE)
+    database.commit_transaction()
+    database.graph.topology()
+
+    database.begin_transaction()
+    database.savepoint("write")
+    database.create_peer(BOB)
+    database.rollback_to_savepoint("write")
+
+    assert not database.graph.loaded
+    assert [peer.username for peer in database.graph.peers()] == ["master", "alice"]
+    assert database.graph.check(database) == []
+    database.rollback_transaction()
+
+
+def test_peers_in_subnet_and_subnets_containing_follow_addresses(database):
+    for subnet in (OUTER, INNER, OTHER):
+        database.create_subnet(subnet)
+    for peer in (ALICE, BOB, CAROL):
+        database.create_peer(peer)
+    database.graph.topology()
+
+    database.update_peer(moved(CAROL, address="10.20.1.9"))
+
+    assert [peer.username for peer in database.graph.peers_in_subnet(INNER.subnet)] == ["alice", "carol"]
+    assert {subnet.subnet for subnet in database.graph.subnets_containing(ALICE)} == {OUTER.subnet, INNER.subnet}
+    for peer in database.get_all_peers():
+        assert database.graph.subnets_containing(peer) == database.get_peers_subnets(peer), peer.username
+    assert database.graph.check(database) == []
+    database.commit_transaction()
@@ -0,0 +1,30 @@
+from backend.core.wireguard.history import PeerHistory
+from backend.db import RollupStore
+
+
+def test_rollups_are_written_while_a_request_holds_the_database(tmp_path, database):
+    store = RollupStore(str(tmp_path / "rollups.db"))
+    history = PeerHistory()
+    history.configure(10, store)
+    history.pending = {"key": [100, 50]}
+    database.begin_transaction()
+    database.writer.execute("UPDATE subnets SET name = name")
+
+    history._roll(7200)
+
+    database.rollback_transaction()
+    assert history.stats["flushes"] == 1
+    assert history.rollups(["key"], 60, 7200) == {"key": [(7200, 100, 50)]}
+    history.configure(10, store)
+    assert history.rollups(["key"], 3600, 0) == {"key": [(7200, 100, 50)]}
+    store.close()
+
+
+def test_expired_rollups_are_deleted_with_the_write(tmp_path):
+    store = RollupStore(str(tmp_path / "rollups.db"))
+    store.save_traffic_rollups([("key", 60, 0, b"\x00" * 16), ("key", 60, 3600, b"\x00" * 16)])
+
+    store.save_traffic_rollups([("key", 60, 7200, b"\x00" * 16)], [(60, 3600)])
+
+    assert [bucket for bucket, _ in store.get_traffic_rollups(["key"], 60, 0)["key"]] == [3600, 7200]
+    store.close()
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from backend.core.intents import IntentLog, intent_log
+from backend.core.nftables.mirror import add_elements
+from backend.core.state_manager import state_manager
+from backend.db import IntentStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = IntentStore(str(tmp_path / "intents.db"))
+    yield store
+    store.close()
+
+
+def test_subjects_are_persisted_once_until_new_ones_are_named(store):
+    log = IntentLog()
+    log.configure(store)
+    log.begin()
+    log.touch("set", "blocked_pairs")
+    log.persist()
+    log.touch("set", "blocked_pairs")
+    log.persist()
+    log.touch("peer", "key")
+    log.persist()
+
+    assert log.stats["intents"] == 1 and log.stats["persists"] == 2
+    [(_, _, subjects)] = store.get_intents()
+    assert json.loads(subjects) == {"set": ["blocked_pairs"], "peer": ["key"]}
+
+
+def test_finish_drops_the_intent(store):
+    log = IntentLog()
+    log.configure(store)
+    log.begin()
+    log.touch("table")
+    log.persist()
+    log.finish()
+
+    assert store.get_intents() == []
+    assert not log.active
+
+
+def test_released_intents_are_merged_for_recovery_and_settled(store):
+    log = IntentLog()
+    log.configure(store)
+    for name in ("a", "b"):
+        log.begin()
+        log.touch("address", name)
+        log.persist()
+        log.release()
+
+    ids, subjects = log.unfinished()
+
+    assert len(ids) == 2 and subjects["address"] == {"a", "b"}
+    log.settle(ids)
+    assert store.get_intents() == [] and log.stats["recovered"] == 2
+
+
+def test_nothing_is_logged_without_a_store():
+    log = IntentLog()
+    log.begin()
+    log.touch("table")
+    log.persist()
+
+    assert log.stats["persists"] == 0
+    assert log.unfinished() == ([], {kind: set() for kind in ("set", "table", "peer", "address", "wireguard")})
+
+
+def test_intent_is_on_disk_before_the_kernel_sees_the_batch(kernel, database, store, monkeypatch):
+    monkeypatch.setattr(intent_log, "store", store)
+    seen: list[list] = []
+    submit = kernel.cmd
+
+    def recording(command, **kwargs):
+        if not command.startswith("list"):
+            seen.append(store.get_intents())
+        return submit(command, **kwargs)
+
+    monkeypatch.setattr("backend.core.nftables.commands.nft_pool.cmd", recording)
+    with state_manager.saved_state():
+        add_elements("test", ["10.0.0.1"])
+
+    assert len(seen) == 1 and json.loads(seen[0][0][2])["set"] == ["test"]
+    assert store.get_intents() == []
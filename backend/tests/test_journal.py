@@ -0,0 +1,123 @@
+import pytest
+
+from backend.core.journal import UndoJournal
+from backend.core.models import Peer
+from backend.core.nftables.commands import current_batch
+from backend.core.nftables.mirror import add_elements, dcv_mirror
+from backend.core.state_manager import state_manager
+from backend.core.wireguard import interface
+from backend.core.wireguard.client import WgPeerDump
+
+
+def test_rollback_runs_inverses_newest_first_without_journaling_them():
+    journal = UndoJournal()
+    undone: list[int] = []
+    journal.begin()
+    for i in range(3):
+        journal.record(lambda i=i: (undone.append(i), journal.record(lambda: undone.append(-1))))
+
+    assert journal.rollback() == []
+    assert undone == [2, 1, 0]
+    assert not journal.active
+
+
+def test_rollback_collects_errors_and_goes_on():
+    journal = UndoJournal()
+    undone: list[str] = []
+    journal.begin()
+    journal.record(lambda: undone.append("first"))
+    journal.record(lambda: 1 / 0)
+
+    errors = journal.rollback()
+
+    assert [type(error) for error in errors] == [ZeroDivisionError]
+    assert undone == ["first"]
+
+
+def test_rollback_to_undoes_only_the_tail_and_keeps_journaling():
+    journal = UndoJournal()
+    undone: list[str] = []
+    journal.begin()
+    journal.record(lambda: undone.append("kept"))
+    mark = journal.mark()
+    journal.record(lambda: undone.append("tail"))
+
+    assert journal.rollback_to(mark) == []
+    assert undone == ["tail"]
+    assert journal.active and journal.mark() == mark
+    journal.rollback()
+    assert undone == ["tail", "kept"]
+
+
+def test_snapshot_is_taken_once_until_undone_past():
+    journal = UndoJournal()
+    taken: list[int] = []
+    restored: list[int] = []
+    journal.begin()
+    journal.record(lambda: None)
+    mark = journal.mark()
+    for _ in range(2):
+        journal.snapshot("table", lambda: taken.append(len(taken)) or len(taken), restored.append)
+    assert taken == [0]
+
+    journal.rollback_to(mark)
+    journal.snapshot("table", lambda: taken.append(len(taken)) or len(taken), restored.append)
+
+    assert restored == [1]
+    assert taken == [0, 1]
+
+
+def test_nothing_is_recorded_outside_a_write():
+    journal = UndoJournal()
+    journal.record(lambda: None)
+
+    assert journal.stats["entries"] == 0
+    assert journal.rollback() == []
+
+
+def test_failed_write_only_undoes_applied_commands_in_the_kernel(kernel, database):
+    with pytest.raises(ValueError):
+        with state_manager.saved_state():
+            add_elements("test", ["10.0.0.1"])
+            current_batch().flush()
+            add_elements("test", ["10.0.0.2"])
+            raise ValueError("write failed")
+
+    assert kernel.batches == ["add element inet dcv test { 10.0.0.1 }", "delete element inet dcv test { 10.0.0.1 }"]
+    assert kernel.sets["test"] == set()
+    assert dcv_mirror.elements("test") == set()
+
+
+def test_failed_savepoint_submits_the_inverses_of_applied_commands(kernel, database):
+    with pytest.raises(KeyError):
+        with state_manager.saved_state():
+            with pytest.raises(ValueError):
+                with state_manager.savepoint():
+                    add_elements("test", ["10.0.0.1"])
+                    current_batch().flush()
+                    raise ValueError("member failed")
+            assert kernel.sets["test"] == set()
+            add_elements("test", ["10.0.0.2"])
+            raise KeyError("group failed")
+
+    assert kernel.sets["test"] == set()
+    assert dcv_mirror.elements("test") == set()
+
+
+def test_failed_write_puts_back_the_peer_the_kernel_had(kernel, database, monkeypatch):
+    wg = {"key": WgPeerDump("key", "old-psk", "", ("10.0.0.5/32",), 0, 0, 0)}
+    monkeypatch.setattr(interface.wg_client, "dump", lambda name: list(wg.values()))
+    monkeypatch.setattr(interface.wg_client, "set_peer", lambda name, key, psk, ips: wg.__setitem__(
+        key, WgPeerDump(key, psk, "", tuple(ips), 0, 0, 0)))
+    monkeypatch.setattr(interface.wg_client, "remove_peers", lambda name, keys: [wg.pop(key) for key in keys])
+    monkeypatch.setattr(interface.wg_shards, "_routes", lambda action, addresses: None)
+    # The telemetry cache has not seen the peer yet.
+    monkeypatch.setattr(interface.wg_telemetry, "peers", {})
+
+    with pytest.raises(ValueError):
+        with state_manager.saved_state():
+            interface.apply_to_wg_config(Peer(username="p", public_key="key", preshared_key="new-psk",
+                                              address="10.0.0.6", x=0, y=0))
+            raise ValueError("write failed")
+
+    assert wg == {"key": WgPeerDump("key", "old-psk", "", ("10.0.0.5/32",), 0, 0, 0)}
@@ -0,0 +1,21 @@
+import itertools
+import threading
+
+from backend.core.wireguard import keys
+from backend.core.wireguard.keys import KeyPool
+
+
+def test_pool_hands_out_each_key_once_and_stop_joins_the_refill(monkeypatch):
+    counter = itertools.count()
+    monkeypatch.setattr(keys, "new_keys", lambda: {"public_key": str(next(counter))})
+    pool = KeyPool()
+    pool.start(2)
+    thread = pool._thread
+
+    taken = [pool.take()["public_key"] for _ in range(4)]
+    pool.stop()
+
+    assert len(set(taken)) == 4
+    assert not thread.is_alive() and pool._thread is None
+    assert thread not in threading.enumerate()
+    assert pool.take()["public_key"] not in taken
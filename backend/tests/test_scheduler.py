@@ -0,0 +1,111 @@
+from backend.core.models import Subnet
+from backend.core.nftables.mirror import add_elements, dcv_mirror
+from backend.core.scheduler import WriteScheduler, _Write
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def subnet_write(database, calls: list[str], name: str, fail: bool = False) -> _Write:
+    """A write creating subnet 10.<n>.0.0/24 and adding 10.<n>.0.1 to the test set."""
+    number = int(name[1:])
+
+    def fn():
+        calls.append(name)
+        database.create_subnet(Subnet(subnet=f"10.{number}.0.0/24", name=name))
+        add_elements("test", [f"10.{number}.0.1"])
+        if fail:
+            raise ValueError(name)
+        return name
+
+    return _Write(fn)
+
+
+def stored_subnets(database) -> set[str]:
+    return {subnet.name for subnet in database.get_all_subnets() if subnet.name.startswith("w")}
+
+
+def test_failed_write_is_undone_alone(kernel, database):
+    calls: list[str] = []
+    group = [subnet_write(database, calls, "w1"), subnet_write(database, calls, "w2", fail=True),
+             subnet_write(database, calls, "w3")]
+    scheduler = WriteScheduler()
+
+    scheduler._run_group(group)
+
+    assert [write.result for write in group] == ["w1", None, "w3"]
+    assert isinstance(group[1].error, ValueError)
+    assert all(write.settled for write in group)
+    assert calls == ["w1", "w2", "w3"]
+    assert stored_subnets(database) == {"w1", "w3"}
+    assert kernel.sets["test"] == {"10.1.0.1", "10.3.0.1"}
+    assert dcv_mirror.elements("test") == kernel.sets["test"]
+    assert len(kernel.batches) == 1
+    assert database.graph.check(database) == []
+
+
+def test_group_commit_failure_reruns_the_other_writes(kernel, database):
+    calls: list[str] = []
+    group = [subnet_write(database, calls, "w1"), subnet_write(database, calls, "w2", fail=True),
+             subnet_write(database, calls, "w3")]
+    kernel.reject_once.append("10.1.0.1")
+    scheduler = WriteScheduler()
+
+    scheduler._run_group(group)
+
+    assert scheduler.stats["regrouped"] == 1
+    assert [write.result for write in group] == ["w1", None, "w3"]
+    assert group[0].error is None and group[2].error is None
+    assert isinstance(group[1].error, ValueError)
+    # The failing write is not run again: its caller already has its outcome.
+    assert calls == ["w1", "w2", "w3", "w1", "w3"]
+    assert stored_subnets(database) == {"w1", "w3"}
+    assert kernel.sets["test"] == {"10.1.0.1", "10.3.0.1"}
+    assert dcv_mirror.elements("test") == kernel.sets["test"]
+    assert database.graph.check(database) == []
+
+
+def test_base_exception_keeps_settled_outcomes(kernel, database, monkeypatch):
+    calls: list[str] = []
+    first, second = subnet_write(database, calls, "w1"), subnet_write(database, calls, "w2")
+    kernel.reject_once.append("10.1.0.1")
+    scheduler = WriteScheduler()
+    run_alone = scheduler._run_alone
+
+    def interrupt_second(write):
+        if write is second:
+            raise Interrupted()
+        run_alone(write)
+
+    monkeypatch.setattr(scheduler, "_run_alone", interrupt_second)
+    scheduler._writes.put(first)
+    scheduler._writes.put(second)
+    scheduler.start(8, 0.0)
+    try:
+        assert first.done.wait(5) and second.done.wait(5)
+    finally:
+        scheduler.stop()
+
+    assert first.error is None and first.result == "w1"
+    assert isinstance(second.error, Interrupted) and second.result is None
+    assert stored_subnets(database) == {"w1"}
+
+
+def test_stop_settles_queued_writes_and_joins_the_worker(kernel, database):
+    calls: list[str] = []
+    writes = [subnet_write(database, calls, f"w{n}") for n in range(1, 4)]
+    scheduler = WriteScheduler()
+    scheduler.start(2, 0.0)
+    worker = scheduler._thread
+    for write in writes[:2]:
+        scheduler._writes.put(write)
+    scheduler.stop()
+    # Queued by a caller that had not seen the stop yet.
+    scheduler._writes.put(writes[2])
+    scheduler._drain()
+
+    assert not worker.is_alive()
+    assert all(write.done.is_set() and write.error is None for write in writes)
+    assert stored_subnets(database) == {"w1", "w2", "w3"}
+    assert scheduler.run(lambda: "inline") == "inline"